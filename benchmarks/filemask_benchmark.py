@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""Benchmark filemask matching with :class:`cronify.matcher.FilemaskIndex`
+against a linear scan of filemask regexes"""
+
+import re
+import fnmatch
+import timeit
+from cronify.matcher import FilemaskIndex
+
+MASK_COUNTS = [10, 100, 1000]
+NUMBER = 2000
+
+
+def make_filemasks(count):
+    """Make a mix of literal, prefix, suffix, glob and datestamp filemasks"""
+    filemasks = []
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            filemasks.append('file_%d.txt' % (i,))
+        elif kind == 1:
+            filemasks.append('prefix_%d_*' % (i,))
+        elif kind == 2:
+            filemasks.append('*.ext%d' % (i,))
+        elif kind == 3:
+            filemasks.append('glob_%d_?.*' % (i,))
+        else:
+            filemasks.append('access_log_%d_YYYYMMDD.*' % (i,))
+    return filemasks
+
+
+def compile_filemask(filemask):
+    """Compile filemask the same way :class:`cronify.cronify.EventHandler` does"""
+    if not 'YYYYMMDD' in filemask:
+        return re.compile(fnmatch.translate(filemask))
+    return re.compile(filemask.replace('YYYYMMDD', r'\d{4}\d{2}\d{2}'))
+
+
+def linear_match(regexes, filename):
+    """Match filename against every regex in turn"""
+    return [regex for regex in regexes if regex.match(filename)]
+
+
+def run(mask_counts=MASK_COUNTS, number=NUMBER):
+    """Run benchmark for each filemask count, return list of result dictionaries"""
+    results = []
+    for count in mask_counts:
+        filemasks = make_filemasks(count)
+        regexes = [compile_filemask(filemask) for filemask in filemasks]
+        index = FilemaskIndex([(filemask, regex, regex)
+                               for filemask, regex in zip(filemasks, regexes)])
+        filenames = ['file_%d.txt' % (count // 2,), 'prefix_1_data',
+                     'archive.ext2', 'access_log_4_20160101.gz', 'nomatch.dat']
+        for filename in filenames:
+            assert sorted(linear_match(regexes, filename), key=regexes.index) == index.match(filename)
+        linear = timeit.timeit(lambda: [linear_match(regexes, filename) for filename in filenames],
+                               number=number)
+        indexed = timeit.timeit(lambda: [index.match(filename) for filename in filenames],
+                                number=number)
+        per_event = float(number * len(filenames))
+        results.append({'masks': count,
+                        'linear_usec': linear / per_event * 1e6,
+                        'indexed_usec': indexed / per_event * 1e6,
+                        'speedup': linear / indexed})
+    return results
+
+
+def main():
+    for result in run():
+        print("%(masks)5d masks: linear %(linear_usec)9.2f usec/event, "
+              "indexed %(indexed_usec)7.2f usec/event, speedup %(speedup).1fx" % result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""Benchmark suite for the event to action pipeline.
+
+Runs filemask index, :meth:`cronify.cronify.EventHandler.handle_event` and
+action argument parsing micro-benchmarks and an end-to-end benchmark of files
+created at a fixed rate in a tmpfs directory. Results are written as JSON and
+can be compared with a previous run's results, eg ::
+
+  python benchmarks/pipeline_benchmark.py -o baseline.json
+  python benchmarks/pipeline_benchmark.py -o new.json --compare baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import platform
+import argparse
+import threading
+import pyinotify
+from cronify import Watcher
+from cronify.cronify import EventHandler
+import filemask_benchmark
+
+MASK_COUNTS = [10, 100, 1000]
+NUMBER = 2000
+E2E_DIR = '/dev/shm/cronify_benchmark'
+E2E_RATE = 200
+E2E_DURATION = 10
+# Relative change in a timing that is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+_action = {'benchmarkAction' : {'cmd' : 'true', 'args' : ['$filename', 'YYYYMMDD']}}
+
+
+class _NullTaskQueue(object):
+
+    """Task queue stand-in that drops tasks, so only event handling is measured"""
+
+    def add_task(self, queue, func, args, limits=()):
+        pass
+
+    def spill_task(self, record):
+        return False
+
+    def set_weight(self, queue, weight):
+        pass
+
+
+def _make_event(name, path='/tmp'):
+    return pyinotify.Event({'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                            'path' : path, 'name' : name, 'dir' : False})
+
+
+def _percentile(values, percent):
+    """Percentile of sorted values"""
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def handle_event_benchmark(mask_counts=MASK_COUNTS, number=NUMBER):
+    """Time :meth:`EventHandler.handle_event` with synthetic events for each filemask count"""
+    results = []
+    for count in mask_counts:
+        filemask_actions = dict((filemask, {'actions' : [_action]})
+                                for filemask in filemask_benchmark.make_filemasks(count))
+        event_handler = EventHandler(filemask_actions, None, task_queue = _NullTaskQueue())
+        events = [_make_event(name) for name in
+                  ['file_%d.txt' % (count // 2,), 'prefix_1_data', 'archive.ext2',
+                   'access_log_4_20160101.gz', 'nomatch.dat']]
+        elapsed = timeit.timeit(lambda: [event_handler.handle_event(event) for event in events],
+                                number=number)
+        results.append({'masks' : count,
+                        'usec' : elapsed / float(number * len(events)) * 1e6})
+    return results
+
+
+def parse_action_args_benchmark(number=NUMBER * 10):
+    """Time expansion of action arguments with and without datestamp parsing"""
+    results = []
+    for name, args in [('filename', ['-v', '$filename']),
+                       ('datestamp', ['-v', '$filename', 'YYYYMMDD'])]:
+        action = {'benchmarkAction' : {'cmd' : 'true', 'args' : args}}
+        event_handler = EventHandler({'access_log_YYYYMMDD.*' : {'actions' : [action]}}, None,
+                                     task_queue = _NullTaskQueue())
+        plan = list(event_handler.action_plans.values())[0][0]
+        event = _make_event('access_log_20160101.gz')
+        elapsed = timeit.timeit(lambda: event_handler._parse_action_args(event, plan), number=number)
+        results.append({'args' : name, 'usec' : elapsed / number * 1e6})
+    return results
+
+
+def end_to_end_benchmark(directory=E2E_DIR, rate=E2E_RATE, duration=E2E_DURATION, num_workers=10):
+    """Create files in directory at rate files per second for duration seconds and measure
+    latency from file creation to action start and sustained throughput"""
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    created, started = {}, {}
+    done = threading.Event()
+    total = int(rate * duration)
+
+    def callback_func(event):
+        started[event.name] = time.time()
+        if len(started) >= total:
+            done.set()
+    watch_data = {directory : {'name' : 'Benchmark watch',
+                               'filemasks' : {'bench_*.dat' : {'actions' : [_action]}}}}
+    watcher = Watcher(watch_data, callback_func = callback_func, num_workers = num_workers)
+    try:
+        start_time = time.time()
+        for i in range(total):
+            delay = start_time + float(i) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            name = 'bench_%d.dat' % (i,)
+            created[name] = time.time()
+            open(os.path.join(directory, name), 'w').close()
+        done.wait(duration + 60)
+        end_time = max(started.values()) if started else time.time()
+        # Let last actions finish before stopping watcher
+        while len(watcher.task_queue):
+            time.sleep(.1)
+        time.sleep(1)
+    finally:
+        watcher.cleanup()
+        shutil.rmtree(directory)
+    latencies = sorted(started[name] - created[name] for name in started)
+    result = {'rate' : rate, 'files' : total, 'handled' : len(started),
+              'throughput' : len(started) / (end_time - start_time)}
+    if latencies:
+        result.update({'latency_p50_msec' : _percentile(latencies, 50) * 1e3,
+                       'latency_p90_msec' : _percentile(latencies, 90) * 1e3,
+                       'latency_p99_msec' : _percentile(latencies, 99) * 1e3,
+                       'latency_max_msec' : latencies[-1] * 1e3})
+    return result
+
+
+def run(end_to_end=True, **e2e_kwargs):
+    """Run benchmark suite, return results dictionary"""
+    results = {'python' : platform.python_version(),
+               'time' : time.time(),
+               'results' : {'filemask_index' : filemask_benchmark.run(),
+                            'handle_event' : handle_event_benchmark(),
+                            'parse_action_args' : parse_action_args_benchmark()}}
+    if end_to_end:
+        results['results']['end_to_end'] = end_to_end_benchmark(**e2e_kwargs)
+    return results
+
+
+def _timings(results):
+    """Flatten timings of results into a dictionary of name -> value. Lower is better for all"""
+    timings = {}
+    for benchmark, result in results['results'].items():
+        for entry in (result if isinstance(result, list) else [result]):
+            key = ','.join('%s=%s' % (name, entry[name]) for name in ('masks', 'args') if name in entry)
+            for name, value in entry.items():
+                if name.endswith('usec') or name.endswith('msec'):
+                    timings['%s[%s].%s' % (benchmark, key, name)] = value
+    return timings
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Compare timings of results with baseline results
+
+    :rtype: list
+    :returns: List of (name, baseline value, value, relative change) tuples of regressed timings"""
+    timings, baseline_timings = _timings(results), _timings(baseline)
+    regressions = []
+    for name in sorted(timings):
+        if name not in baseline_timings or not baseline_timings[name]:
+            continue
+        change = (timings[name] - baseline_timings[name]) / baseline_timings[name]
+        print("%-60s %12.2f %12.2f %+7.1f%%" % (name, baseline_timings[name], timings[name], change * 100))
+        if change > threshold:
+            regressions.append((name, baseline_timings[name], timings[name], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help = "Write JSON results to file")
+    parser.add_argument('--compare', help = "Compare with JSON results of a previous run, "
+                        "exit with status 1 on regressions")
+    parser.add_argument('--no-end-to-end', action = 'store_true', help = "Skip end-to-end benchmark")
+    parser.add_argument('--directory', default = E2E_DIR, help = "Directory for end-to-end benchmark, "
+                        "should be on tmpfs")
+    parser.add_argument('--rate', type = int, default = E2E_RATE, help = "Files created per second")
+    parser.add_argument('--duration', type = int, default = E2E_DURATION, help = "Seconds to create files for")
+    args = parser.parse_args()
+    results = run(end_to_end = not args.no_end_to_end, directory = args.directory,
+                  rate = args.rate, duration = args.duration)
+    if args.output:
+        with open(args.output, 'w') as fileh:
+            json.dump(results, fileh, indent = 2, sort_keys = True)
+    else:
+        print(json.dumps(results, indent = 2, sort_keys = True))
+    if args.compare:
+        with open(args.compare) as fileh:
+            regressions = compare(results, json.load(fileh))
+        for name, baseline_value, value, change in regressions:
+            print("Regression in %s: %.2f -> %.2f (%+.1f%%)" % (name, baseline_value, value, change * 100))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Accumulation of files for batched action invocation"""
+
+import time
+import logging
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH_SIZE = 100
+DEFAULT_MAX_BATCH_LATENCY_MS = 1000
+
+BatchConfig = namedtuple('BatchConfig', ['max_batch_size', 'max_batch_latency', 'stdin'])
+"""Batch settings of an action. max_batch_latency is in seconds"""
+
+BatchEntry = namedtuple('BatchEntry', ['event', 'action_args', 'actions', 'index', 'journal_id', 'claim'])
+"""File added to a batch, with expanded action arguments and the action sequence,
+or :class:`cronify.graph.GraphRun`, it continues with after the batch has run"""
+
+
+def parse_batch_config(data):
+    """Parse action's batch configuration
+
+    :param data: Batch configuration, either True for defaults or a dictionary with \
+    optional max_batch_size, max_batch_latency_ms and stdin keys
+    :rtype: :class:`BatchConfig`"""
+    if not data:
+        return
+    if data is True:
+        data = {}
+    return BatchConfig(int(data.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE)),
+                       data.get('max_batch_latency_ms', DEFAULT_MAX_BATCH_LATENCY_MS) / 1000.0,
+                       bool(data.get('stdin', False)))
+
+
+class Batcher(object):
+
+    """Accumulates batch entries per action until the batch is full or its
+    oldest entry has waited max_batch_latency"""
+
+    def __init__(self, scheduler, flush_func):
+        """
+        :param scheduler: Scheduler used to flush batches that reach their maximum latency
+        :type scheduler: :class:`cronify.scheduler.Scheduler`
+        :param flush_func: Called with (plan, entries) from a thread pool worker \
+        when a batch reaches its maximum latency
+        """
+        self.scheduler, self.flush_func = scheduler, flush_func
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, plan, entry):
+        """Add entry to plan's current batch
+
+        :rtype: list
+        :returns: Entries of batch if it is now full and should be run by the caller, \
+        otherwise None"""
+        with self._lock:
+            batch = self._batches.get(id(plan))
+            if batch is None:
+                timer = self.scheduler.schedule(time.time() + plan.batch.max_batch_latency,
+                                                self._flush_due, plan)
+                batch = self._batches[id(plan)] = (timer, [])
+            batch[1].append(entry)
+            if len(batch[1]) < plan.batch.max_batch_size:
+                return
+            del self._batches[id(plan)]
+        self.scheduler.cancel(batch[0])
+        return batch[1]
+
+    def _flush_due(self, plan):
+        with self._lock:
+            batch = self._batches.pop(id(plan), None)
+        if batch:
+            logger.debug("Batch of action %s reached maximum latency with %s files", plan.name, len(batch[1]),)
+            self.flush_func(plan, batch[1])
@@ -0,0 +1,91 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Python callable actions, run in a worker thread or in a process pool.
+
+A callable action names its entry point as ``module:function`` and is called
+with its expanded arguments and a dictionary of file metadata, eg ::
+
+  def process(args, file_metadata):
+      pathname = file_metadata['pathname']
+
+It returns None or 0 on success. Any other integer is treated as a failed
+action's exit code, as is raising an exception."""
+
+import logging
+import importlib
+import threading
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+_entry_points = {}
+
+
+def load_entry_point(entry_point):
+    """Import callable named by entry point in module:function format
+
+    :raises: :mod:`ImportError` or :mod:`AttributeError` if callable cannot be found, \
+    :mod:`ValueError` if entry point is not in module:function format"""
+    if entry_point not in _entry_points:
+        module_name, _, attr = entry_point.partition(':')
+        if not module_name or not attr:
+            raise ValueError("Entry point %s is not in module:function format" % (entry_point,))
+        func = importlib.import_module(module_name)
+        for name in attr.split('.'):
+            func = getattr(func, name)
+        if not callable(func):
+            raise ValueError("Entry point %s is not callable" % (entry_point,))
+        _entry_points[entry_point] = func
+    return _entry_points[entry_point]
+
+
+def call_entry_point(entry_point, args, file_metadata):
+    """Call entry point with args and file metadata. Used by process pool workers,
+    which import the entry point themselves so that only its name is pickled"""
+    return load_entry_point(entry_point)(args, file_metadata)
+
+
+class ProcessPool(object):
+
+    """Pool of worker processes for CPU bound callable actions. Processes are only
+    started when the first action is run in the pool"""
+
+    def __init__(self, processes=None):
+        """
+        :param processes: Number of worker processes. Defaults to number of CPUs
+        :type processes: int
+        """
+        self.processes = processes
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def call(self, entry_point, args, file_metadata):
+        """Call entry point in a worker process and wait for its result"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            pool = self._pool
+        return pool.apply_async(call_entry_point, (entry_point, args, file_metadata)).get()
+
+    def close(self):
+        """Stop worker processes. They are started again if another action is run"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,143 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Catch-up scan for files written to watched directories while cronify was not
+running. Each watched directory has a persisted high-water mark - the time up to
+which its files are known to have been seen"""
+
+import os
+import stat
+import json
+import Queue
+import logging
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCAN_WORKERS = 8
+
+
+class CatchupState(object):
+
+    """High-water marks of watched directories, persisted to a JSON file"""
+
+    def __init__(self, state_file):
+        """
+        :param state_file: Path to JSON file marks are kept in
+        :type state_file: str
+        """
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        try:
+            with open(state_file) as fileh:
+                self.marks = json.load(fileh)
+        except IOError:
+            self.marks = {}
+        except ValueError:
+            logger.error("Catch-up state file %s is corrupt, starting without high-water marks", state_file,)
+            self.marks = {}
+
+    def get(self, watch):
+        """High-water mark of watched directory in seconds since the epoch, or None"""
+        return self.marks.get(watch)
+
+    def save(self, watches, mark):
+        """Set high-water mark of watched directories to mark and write state file
+
+        :param watches: Watched directories to set mark of
+        :param mark: Time in seconds since the epoch all files of watches up to are known to have been seen
+        :type mark: float
+        """
+        with self._lock:
+            for watch in watches:
+                self.marks[watch] = mark
+            tmp_file = self.state_file + '.tmp'
+            with open(tmp_file, 'w') as fileh:
+                json.dump(self.marks, fileh)
+                fileh.flush()
+                os.fsync(fileh.fileno())
+            os.rename(tmp_file, self.state_file)
+
+
+def _list_dir(dirpath):
+    """List directory entries as (name, is_dir, is_file, mtime) tuples without following symlinks"""
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            is_file = not is_dir and entry.is_file(follow_symlinks=False)
+            yield entry.name, is_dir, is_file, entry.stat(follow_symlinks=False).st_mtime if is_file else None
+        return
+    for name in os.listdir(dirpath):
+        st = os.lstat(os.path.join(dirpath, name))
+        yield name, stat.S_ISDIR(st.st_mode), stat.S_ISREG(st.st_mode), st.st_mtime
+
+
+def scan_new_files(roots, since, until, recurse=False, num_workers=DEFAULT_SCAN_WORKERS, exclude=None):
+    """Find regular files in roots modified after since and at or before until.
+
+    Directories are listed in parallel by up to num_workers threads. Uses :func:`os.scandir`
+    or the scandir package if available, which saves a stat call per directory entry.
+
+    :param roots: Directories to scan
+    :type roots: list
+    :param since: Time in seconds since the epoch, exclusive
+    :param until: Time in seconds since the epoch, inclusive
+    :param recurse: Scan sub-directories
+    :param exclude: Optional function returning True for sub-directories not to scan
+    :rtype: list
+    :returns: List of (directory path, file name, modified time) tuples sorted by modified time"""
+    found = []
+    directories = Queue.Queue()
+
+    def worker():
+        while True:
+            dirpath = directories.get()
+            if dirpath is None:
+                return
+            try:
+                for name, is_dir, is_file, mtime in _list_dir(dirpath):
+                    if is_dir and recurse:
+                        subdir = os.path.join(dirpath, name)
+                        if not (exclude and exclude(subdir)):
+                            directories.put(subdir)
+                    elif is_file and since < mtime <= until:
+                        found.append((mtime, dirpath, name))
+            except OSError as ex:
+                logger.warning("Could not scan directory %s - %s", dirpath, ex,)
+            finally:
+                directories.task_done()
+
+    for root in roots:
+        directories.put(root)
+    threads = [threading.Thread(target=worker, name='CatchupScan')
+               for _ in range(num_workers if recurse else min(num_workers, len(roots)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    directories.join()
+    for thread in threads:
+        directories.put(None)
+    found.sort()
+    return [(dirpath, name, mtime) for mtime, dirpath, name in found]
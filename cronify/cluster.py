@@ -0,0 +1,334 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Coordination of cronify instances watching a shared directory, eg on NFS.
+
+With cluster configured for a watch, an instance claims each file for a filemask
+before performing the filemask's actions, and only the instance whose claim
+succeeds performs them. Claims are leases, renewed while the claiming instance
+is running. Claims of instances that stop renewing them expire and are taken
+over by other instances, which perform the actions again. Completed claims are
+kept for done_ttl seconds so that instances seeing a file later, eg in a
+catch-up scan, do not repeat its actions. A file that is modified is claimed
+anew.
+
+Instances' clocks must be synchronised to well within lease_ttl.
+
+Claims are kept in a directory on the shared filesystem by default, see
+:class:`DirectoryClaimStore`. Other stores subclass :class:`ClaimStore` and are
+configured as ``store: module:Class``."""
+
+import os
+import json
+import time
+import uuid
+import errno
+import socket
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from callables import load_entry_point
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_TTL = 60
+DEFAULT_DONE_TTL = 86400
+_CLAIM_SUFFIX = '.claim'
+
+ClusterConfig = namedtuple('ClusterConfig', ['claim_dir', 'lease_ttl', 'done_ttl', 'store'])
+"""Cluster settings of a watch. TTLs are in seconds. Store is an optional \
+module:Class entry point of a :class:`ClaimStore`"""
+
+Claim = namedtuple('Claim', ['key', 'token'])
+"""Claim of a file. A claim without a token is not held, eg because the store could not be reached"""
+
+
+def parse_cluster_config(data):
+    """Parse watch's cluster configuration
+
+    :param data: Dictionary with claim_dir and optional lease_ttl, done_ttl and store keys
+    :raises: :mod:`ValueError` if neither claim_dir nor store is set
+    :rtype: :class:`ClusterConfig`"""
+    if not data:
+        return
+    if not data.get('claim_dir') and not data.get('store'):
+        raise ValueError("Cluster configuration requires claim_dir or store")
+    return ClusterConfig(data.get('claim_dir'), float(data.get('lease_ttl', DEFAULT_LEASE_TTL)),
+                         float(data.get('done_ttl', DEFAULT_DONE_TTL)), data.get('store'))
+
+
+def make_claim_store(config, node_id=None):
+    """Make claim store for cluster configuration
+
+    :type config: :class:`ClusterConfig`
+    :rtype: :class:`ClaimStore`"""
+    store_class = load_entry_point(config.store) if config.store else DirectoryClaimStore
+    return store_class(config, node_id)
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def claim_key(filemask, relpath, pathname):
+    """Claim key of a version of a file for filemask. Files are identified by their path
+    relative to the watched directory, which may be mounted at different paths on different
+    hosts, and versions by size and modified time
+
+    :rtype: str"""
+    try:
+        st = os.stat(pathname)
+        version = '%d:%r' % (st.st_size, st.st_mtime,)
+    except OSError:
+        version = ''
+    return hashlib.sha1(b'\0'.join(_to_bytes(part) for part in (filemask, relpath, version))).hexdigest()
+
+
+class ClaimStore(object):
+
+    """Base class of claim stores. Claim info is a dictionary with the filemask, path and mask keys
+    needed to take over expired claims. Claims held by a store are renewed until released"""
+
+    def __init__(self, config, node_id=None):
+        """
+        :param config: Cluster configuration
+        :type config: :class:`ClusterConfig`
+        :param node_id: Identifier of this instance. Defaults to host name and process id
+        """
+        self.config = config
+        self.node_id = node_id or '%s:%s' % (socket.gethostname(), os.getpid(),)
+
+    def claim(self, key, info):
+        """Claim key
+
+        :rtype: :class:`Claim`
+        :returns: Claim, or None if key is claimed by another instance or is done"""
+        raise NotImplementedError
+
+    def release(self, claim):
+        """Mark claim as done. Done claims are kept for the configured done_ttl"""
+        raise NotImplementedError
+
+    def expired(self):
+        """Claims whose lease has expired without being released
+
+        :rtype: list
+        :returns: List of (key, claim data) tuples. Claim data includes the claim's info"""
+        raise NotImplementedError
+
+    def take_over(self, key, data):
+        """Claim key of expired claim, as returned by :meth:`expired`
+
+        :rtype: :class:`Claim`
+        :returns: Claim, or None if another instance took it over first"""
+        raise NotImplementedError
+
+    def close(self):
+        """Stop renewing claims"""
+
+    def retire(self):
+        """Stop renewing claims once claims held have been released, for stores replaced
+        while actions still hold their claims. Closes store by default"""
+        self.close()
+
+
+class DirectoryClaimStore(ClaimStore):
+
+    """Claims kept as files in a directory on the shared filesystem.
+
+    A claim file is made by hard linking a temporary file to the claim's name, which
+    is atomic on NFS as well as on local filesystems. Claim files' modified times are
+    set to their expiry, so expired claims are found without reading every claim"""
+
+    def __init__(self, config, node_id=None):
+        ClaimStore.__init__(self, config, node_id)
+        self.claim_dir = config.claim_dir
+        if not os.path.isdir(self.claim_dir):
+            os.makedirs(self.claim_dir)
+        self._held = {}
+        self._lock = threading.Lock()
+        self._retired = False
+        self._start_renewal()
+
+    def _start_renewal(self):
+        self._closed = threading.Event()
+        self._renew_thread = threading.Thread(target=self._renew_target_thread, args=(self._closed,),
+                                              name='ClaimRenewer')
+        self._renew_thread.daemon = True
+        self._renew_thread.start()
+
+    def _stop_renewal(self, force=False):
+        """Stop renewal thread, unless claims are held and force is not set"""
+        with self._lock:
+            if self._held and not force:
+                return
+            thread, self._renew_thread = self._renew_thread, None
+            self._closed.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _path(self, key):
+        return os.path.join(self.claim_dir, key + _CLAIM_SUFFIX)
+
+    def _write(self, key, data):
+        """Write claim data to a new temporary file with modified time set to claim's expiry
+
+        :returns: Temporary file name"""
+        tmp_file = os.path.join(self.claim_dir, '.%s.%s.tmp' % (key, uuid.uuid4().hex,))
+        with open(tmp_file, 'w') as fileh:
+            json.dump(data, fileh)
+        os.utime(tmp_file, (data['expires'], data['expires']))
+        return tmp_file
+
+    def _read(self, path):
+        try:
+            with open(path) as fileh:
+                return json.load(fileh)
+        except (IOError, OSError, ValueError):
+            return
+
+    def claim(self, key, info):
+        data = dict(info, node = self.node_id, token = uuid.uuid4().hex, done = False,
+                    expires = time.time() + self.config.lease_ttl)
+        tmp_file = self._write(key, data)
+        try:
+            os.link(tmp_file, self._path(key))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+            # Link may have succeeded on an NFS server even if its reply was lost
+            if os.stat(tmp_file).st_nlink != 2:
+                return
+        finally:
+            os.unlink(tmp_file)
+        with self._lock:
+            self._held[key] = data
+            # Claims made after the store was closed or retired are renewed until released
+            if self._renew_thread is None:
+                self._start_renewal()
+        return Claim(key, data['token'])
+
+    def release(self, claim):
+        with self._lock:
+            data = self._held.get(claim.key)
+            if not claim.token or not data or data['token'] != claim.token:
+                return
+            del self._held[claim.key]
+        data = dict(data, done = True, expires = time.time() + self.config.done_ttl)
+        try:
+            self._replace(claim.key, data)
+        except (IOError, OSError) as ex:
+            logger.error("Could not mark claim of %s as done - %s", data['path'], ex,)
+        if self._retired:
+            self._stop_renewal()
+
+    def _replace(self, key, data):
+        """Replace claim file with data if claim is still held by this instance
+
+        :rtype: bool"""
+        current = self._read(self._path(key))
+        if not current or current['token'] != data['token']:
+            logger.warning("Claim of %s for filemask %s was taken over by %s",
+                           data['path'], data['filemask'], current['node'] if current else 'another instance',)
+            return False
+        os.rename(self._write(key, data), self._path(key))
+        return True
+
+    def _renew_target_thread(self, closed):
+        while not closed.wait(self.config.lease_ttl / 3.0):
+            with self._lock:
+                held = list(self._held.items())
+            expires = time.time() + self.config.lease_ttl
+            for key, data in held:
+                data = dict(data, expires = expires)
+                try:
+                    renewed = self._replace(key, data)
+                except (IOError, OSError) as ex:
+                    logger.error("Could not renew claim of %s - %s", data['path'], ex,)
+                    continue
+                with self._lock:
+                    if key not in self._held or self._held[key]['token'] != data['token']:
+                        continue
+                    if renewed:
+                        self._held[key] = data
+                    else:
+                        del self._held[key]
+            if self._retired:
+                self._stop_renewal()
+
+    def expired(self):
+        now, expired = time.time(), []
+        for name in os.listdir(self.claim_dir):
+            if not name.endswith(_CLAIM_SUFFIX):
+                continue
+            path = os.path.join(self.claim_dir, name)
+            try:
+                if os.stat(path).st_mtime >= now:
+                    continue
+            except OSError:
+                continue
+            data = self._read(path)
+            if not data or data['expires'] >= now:
+                continue
+            key = name[:-len(_CLAIM_SUFFIX)]
+            if data['done']:
+                self._remove(key, data)
+                continue
+            expired.append((key, data))
+        return expired
+
+    def take_over(self, key, data):
+        if not self._remove(key, data):
+            return
+        logger.info("Taking over expired claim of %s for filemask %s from %s",
+                    data['path'], data['filemask'], data['node'],)
+        return self.claim(key, dict((name, data[name]) for name in ('filemask', 'path', 'mask')))
+
+    def _remove(self, key, data):
+        """Remove claim file if it still has data's token. The file is renamed first, so
+        only one instance removes it, and restored if it turns out to be a newer claim
+
+        :rtype: bool"""
+        path = self._path(key)
+        tombstone = os.path.join(self.claim_dir, '.%s.%s.removed' % (key, uuid.uuid4().hex,))
+        try:
+            os.rename(path, tombstone)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            current = self._read(tombstone)
+            if current and current['token'] != data['token']:
+                try:
+                    os.link(tombstone, path)
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        raise
+                return False
+            return True
+        finally:
+            os.unlink(tombstone)
+
+    def close(self):
+        self._stop_renewal(force=True)
+
+    def retire(self):
+        with self._lock:
+            self._retired = True
+        self._stop_renewal()
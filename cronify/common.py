@@ -17,16 +17,80 @@
 
 """Common components for cronify package. Configuration reading, event codes"""
 
+import os
 import yaml
+import hashlib
+import logging
 from pyinotify import EventsCodes
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+# libyaml's loader parses several times faster than the pure Python one
+try:
+    from yaml import CSafeLoader as _YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as _YAMLLoader
+
+logger = logging.getLogger(__name__)
 
 CFG_FILE = "/etc/cronify.yaml"
 _MASKS = EventsCodes.ALL_FLAGS["IN_CLOSE_WRITE"] | EventsCodes.ALL_FLAGS["IN_MOVED_FROM"]
+# Changed when the structure of cached configuration changes
+_CONFIG_CACHE_VERSION = 1
 
 def read_cfg(cfg_fileh):
     """Read cfg file, return configuration as dictionary
     :rtype: dict
     :return: watch_data dictionary"""
-    data = yaml.load(cfg_fileh)
+    data = yaml.load(cfg_fileh, Loader=_YAMLLoader)
     cfg_fileh.close()
     return data
+
+def cfg_key(content):
+    """Cache key of configuration file content
+
+    :rtype: str"""
+    return hashlib.sha1(content).hexdigest()
+
+
+class ConfigCache(object):
+
+    """Validated configuration with timezones resolved, pickled to a file and keyed by
+    the hash of the configuration file it was read from. Loading configuration from the
+    cache skips YAML parsing, validation and timezone lookups.
+
+    The cache file is unpickled, so must only be writable by cronify's user"""
+
+    def __init__(self, cache_file):
+        """
+        :param cache_file: Path to cache file
+        :type cache_file: str
+        """
+        self.cache_file = cache_file
+
+    def get(self, key):
+        """Cached configuration for key, or None if cache is missing, stale or unreadable
+
+        :rtype: dict"""
+        try:
+            with open(self.cache_file, 'rb') as fileh:
+                version, cached_key, watch_data = pickle.load(fileh)
+        except IOError:
+            return
+        except Exception as ex:
+            logger.warning("Could not read configuration cache %s, ignoring it - %s", self.cache_file, ex,)
+            return
+        if version != _CONFIG_CACHE_VERSION or cached_key != key:
+            return
+        return watch_data
+
+    def put(self, key, watch_data):
+        """Write validated configuration for key to cache"""
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as fileh:
+                pickle.dump((_CONFIG_CACHE_VERSION, key, watch_data), fileh, 2)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError, pickle.PicklingError) as ex:
+            logger.warning("Could not write configuration cache %s - %s", self.cache_file, ex,)
@@ -19,7 +19,9 @@
 """Main cronify package. Contains main Watcher class and EventHandler"""
 
 
+import io
 import os
+import yaml
 import pyinotify
 import time
 import fnmatch
@@ -32,10 +34,33 @@ import datetime
 import re
 import signal
 import asyncore
+import tempfile
 import threading
-from common import read_cfg, CFG_FILE, _MASKS
+from collections import OrderedDict, namedtuple
+from common import read_cfg, CFG_FILE, _MASKS, ConfigCache, cfg_key
+from matcher import FilemaskIndex
+from scheduler import Scheduler
+from journal import Journal
+from output import OutputCapture, get_output_file, stream_output
+from pool import FairQueue, ConcurrencyLimit
+from batch import Batcher, BatchEntry, parse_batch_config
+from catchup import CatchupState, scan_new_files
+from metrics import Metrics
+from callables import ProcessPool, load_entry_point
+from spawner import SpawnServer
+from graph import ActionGraph, GraphRun
+from spill import SpillQueue
+from tree import WatchTree
+from poller import Poller, BACKENDS, BACKEND_INOTIFY, BACKEND_POLL, parse_poll_config
+from cluster import Claim, claim_key, make_claim_store, parse_cluster_config
+from fingerprint import FingerprintCache, file_fingerprint, parse_dedup_config
+from tracing import Tracer, TimedAsyncNotifier, TimedAsyncioNotifier, monotonic
 
 logger = logging.getLogger(__name__)
+# Returned by EventHandler._do_action when action was added to a batch
+_BATCHED = object()
+# Returned by EventHandler._do_action when action failed or could not be run
+_FAILED = object()
 
 def _setup_logger(_logger):
     """Setup default logger"""
@@ -48,15 +73,79 @@ def _setup_logger(_logger):
     _logger.setLevel(logging.DEBUG)
     tp_logger.setLevel(logging.DEBUG)
 
-def run_script(cmd_args):
-    """Run cmd line script
+def _find_executable(cmd):
+    """Find cmd in PATH, return absolute path of executable or None if not found"""
+    if os.path.sep in cmd:
+        return cmd
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        cmd_path = os.path.join(path, cmd)
+        if os.path.isfile(cmd_path) and os.access(cmd_path, os.X_OK):
+            return cmd_path
+
+def run_script(cmd_args, stdout_capture=None, stderr_capture=None, stdin_data=None, spawner=None):
+    """Run cmd line script. Output is streamed to captures as it is read
+    so memory use is bounded regardless of output size
     :type: list
     :param cmd_args: List of cmd and arguments to run, eg ['ls', '-l']
+    :type stdout_capture: :class:`cronify.output.OutputCapture`
+    :param stdout_capture: Optional capture for stdout. Defaults to keeping tail of output only
+    :type stderr_capture: :class:`cronify.output.OutputCapture`
+    :param stderr_capture: Optional capture for stderr. Defaults to keeping tail of output only
+    :type stdin_data: str
+    :param stdin_data: Optional data to write to script's stdin
+    :type spawner: :class:`cronify.spawner.SpawnServer`
+    :param spawner: Optional spawn server to launch script with. Script is run as \
+    a child process if not set or if spawn server is not running
     :rtype: tuple
-    :returns: returncode, stdout, stderr"""
-    proc = subprocess.Popen(cmd_args, shell=False, stdout=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    return proc.returncode, stdout, stderr
+    :returns: returncode, stdout tail, stderr tail"""
+    stdout_capture = stdout_capture or OutputCapture(cmd_args[0], 'stdout', log=False)
+    stderr_capture = stderr_capture or OutputCapture(cmd_args[0], 'stderr', log=False)
+    proc = None
+    if spawner:
+        try:
+            proc = spawner.spawn(cmd_args, stdin = stdin_data is not None)
+        except (IOError, OSError) as ex:
+            logger.warning("Could not launch %s with spawn server, running it directly - %s", cmd_args[0], ex,)
+    if proc is None:
+        proc = subprocess.Popen(cmd_args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                stdin=subprocess.PIPE if stdin_data is not None else None)
+    if stdin_data is not None:
+        # Written from another thread so a script producing output before reading
+        # all its input cannot deadlock
+        stdin_thread = threading.Thread(target = _write_stdin, args = (proc.stdin, stdin_data))
+        stdin_thread.daemon = True
+        stdin_thread.start()
+    stream_output(proc, {proc.stdout : stdout_capture, proc.stderr : stderr_capture})
+    proc.wait()
+    return proc.returncode, stdout_capture.tail, stderr_capture.tail
+
+
+def _write_stdin(stdin, data):
+    """Write data to process stdin and close it"""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    try:
+        stdin.write(data)
+    except IOError:
+        pass
+    finally:
+        try:
+            stdin.close()
+        except IOError:
+            pass
+
+
+ActionPlan = namedtuple('ActionPlan', ['name', 'action', 'cmd', 'args', 'filename_positions',
+                                       'datestamp_positions', 'start_time', 'end_time', 'error',
+                                       'limits', 'batch', 'dedup', 'func', 'process_pool', 'filemask'])
+"""Action compiled from configuration. Per event only placeholder arguments at
+filename_positions and datestamp_positions are filled in. Limits are the watcher,
+filemask and action concurrency limits that apply to the action. Batch is the
+action's :class:`cronify.batch.BatchConfig` if it is run for batches of files.
+Dedup is the filemask's :class:`cronify.fingerprint.DedupConfig` if its actions
+are skipped for unchanged files. Func is the imported Python callable of callable
+actions, whose cmd is their entry point, and process_pool is True if it is run in
+the process pool. Filemask is the pattern of the filemask the action belongs to"""
 
 
 class EventHandler(pyinotify.ProcessEvent):
@@ -70,6 +159,12 @@ class EventHandler(pyinotify.ProcessEvent):
     _datestamp_re = r'\d{4}\d{2}\d{2}'
     _datestamp_rc = re.compile(_datestamp_re)
     _datestamp_keyword_fmt = ( 'YYYYMMDD', '%Y%m%d' )
+    _debounce_keyword = 'debounce_ms'
+    _max_concurrency_keyword = 'max_concurrency'
+    _dedup_keyword = 'dedup'
+    _callable_keyword = 'callable'
+    _depends_on_keyword = 'depends_on'
+    _on_failure_keyword = 'on_failure'
     
     # filemasks_actions = {
     # 'somefile.txt' : [ { 'action1' : { 'cmd' : 'echo', <..> }, 'actionN' : <..> } ],
@@ -78,14 +173,96 @@ class EventHandler(pyinotify.ProcessEvent):
     def __init__(self, filemask_actions, thread_pool,
                  callback_func=None,
                  file_tz=None,
-                 local_tz=None):
+                 local_tz=None,
+                 scheduler=None,
+                 journal=None,
+                 watch=None,
+                 max_debounce_entries=100000,
+                 output_dir=None,
+                 task_queue=None,
+                 max_concurrency=None,
+                 weight=None,
+                 previous_handler=None,
+                 max_recent_entries=100000,
+                 metrics=None,
+                 tracer=None,
+                 fingerprints=None,
+                 process_pool=None,
+                 spawner=None,
+                 claim_store=None):
         pyinotify.ProcessEvent.__init__(self)
         self.filemask_actions, self.thread_pool = filemask_actions, thread_pool
+        self.scheduler = scheduler if scheduler is not None else Scheduler(thread_pool)
+        self.metrics = metrics if metrics else Metrics()
+        self.tracer = tracer
+        self.fingerprints = fingerprints if fingerprints is not None else FingerprintCache()
+        self.process_pool = process_pool if process_pool else ProcessPool()
+        self.spawner = spawner
+        # Claims files before actions are performed when watched directory is shared with other instances
+        self.claim_store = claim_store
+        self.task_queue = task_queue if task_queue is not None else FairQueue(thread_pool, self.metrics)
+        self._events_received = self.metrics.events.labels(watch)
+        self._match_time = self.metrics.match_time.labels(watch)
+        self._deferred = self.metrics.deferred.labels(watch)
+        self.batcher = Batcher(self.scheduler, self._queue_batch)
+        if weight or previous_handler:
+            self.task_queue.set_weight(watch, weight or 1)
+        self.max_concurrency = max_concurrency
+        # Reuse unchanged compiled actions of the handler being replaced so that actions
+        # it has already queued count against the same concurrency limits
+        if previous_handler and previous_handler.max_concurrency == max_concurrency:
+            self.watcher_limits = previous_handler.watcher_limits
+            previous_filemasks = dict((filemask.pattern, filemask) for filemask in previous_handler.filemask_actions)
+        else:
+            self.watcher_limits = (ConcurrencyLimit(max_concurrency, watch),) if max_concurrency else ()
+            previous_filemasks = {}
+        self.journal, self.watch = journal, watch
+        self.output_dir = output_dir
         self.callback_func = callback_func
+        self.filemask_index = FilemaskIndex()
+        # Compiled regexes of this handler's filemasks by filemask, reused from the handler
+        # being replaced so that reloads only compile new filemasks
+        self._filemask_regexes = {}
+        previous_regexes = previous_handler._filemask_regexes if previous_handler else {}
+        self.action_plans = {}
+        # Dependency graphs of filemasks whose actions have depends_on
+        self.action_graphs = {}
         for filemask in self.filemask_actions.copy():
-            new_filemask = self._parse_filemask(filemask)
+            new_filemask = self._parse_filemask(filemask, previous_regexes)
             self.filemask_actions[new_filemask] = self.filemask_actions[filemask]
             del self.filemask_actions[filemask]
+            self.filemask_index.add(filemask, new_filemask, new_filemask, rebuild=False)
+            previous_filemask = previous_filemasks.get(new_filemask.pattern)
+            if previous_filemask is not None and \
+                    previous_handler.filemask_actions[previous_filemask] == self.filemask_actions[new_filemask]:
+                self.action_plans[new_filemask] = previous_handler.action_plans[previous_filemask]
+                self.action_graphs[new_filemask] = previous_handler.action_graphs.get(previous_filemask)
+                continue
+            filemask_limits = self.watcher_limits + self._make_limits(self.filemask_actions[new_filemask], filemask)
+            dedup = self._make_dedup(self.filemask_actions[new_filemask], filemask)
+            self.action_plans[new_filemask], self.action_graphs[new_filemask] = self._make_action_graph(
+                self.filemask_actions[new_filemask], filemask, tuple(
+                    self._compile_action(action_name, action, action[action_name], filemask_limits, dedup,
+                                         new_filemask.pattern)
+                    for action in self.filemask_actions[new_filemask]['actions']
+                    for action_name in action))
+        self.filemask_index.rebuild()
+        self._filemask_patterns = dict((filemask.pattern, filemask) for filemask in self.filemask_actions)
+        # Configured filemasks by compiled pattern, for naming output files
+        self._filemask_names = dict((regex.pattern, filemask)
+                                    for filemask, regex in self._filemask_regexes.items())
+        # Debounce window in seconds per filemask and pending events keyed by (filemask, pathname),
+        # in order of last update
+        self.debounce = dict((filemask, self.filemask_actions[filemask][self._debounce_keyword] / 1000.0)
+                             for filemask in self.filemask_actions
+                             if self.filemask_actions[filemask].get(self._debounce_keyword))
+        self.max_debounce_entries = max_debounce_entries
+        self._debounced = OrderedDict()
+        self._debounce_lock = threading.Lock()
+        # Time files were last handled, in order of last update, for resync after lost events
+        self.max_recent_entries = max_recent_entries
+        self._recent = OrderedDict()
+        self._recent_lock = threading.Lock()
         self.file_tz = file_tz
         self.local_tz = local_tz
         logger.debug("Got local tz %s", (self.local_tz,))
@@ -101,32 +278,252 @@ class EventHandler(pyinotify.ProcessEvent):
         self.handle_event(event)
     
     def handle_event(self, event):
-        """Check triggered event against filemask, do actions if filemask is accepted"""
-        for filemask in self.filemask_actions:
-            if not filemask.match(event.name):
-                logger.debug("Filename %s did not match filemask pattern %s", event.name, filemask.pattern,)
-                continue
+        """Check triggered event against filemasks, do actions for each filemask that is accepted"""
+        self._events_received.inc()
+        self._record_event(event)
+        start_time = time.time()
+        filemasks = self.filemask_index.match(event.name)
+        self._match_time.observe(time.time() - start_time)
+        matched = monotonic() if self.tracer else None
+        for filemask in filemasks:
             logger.debug("Matched filename %s with filemask %s from event %s", event.name, filemask.pattern, event.maskname,)
-            self.thread_pool.add_task_to_queue(self.do_actions, event, self.filemask_actions[filemask]['actions'])
+            if filemask in self.debounce:
+                self._debounce_event(filemask, event)
+                continue
+            self._queue_actions(filemask, event,
+                                self.tracer.start(self.watch, filemask.pattern, event, matched) if self.tracer else None)
+
+    def _record_event(self, event):
+        """Record time file of event was handled"""
+        now = time.time()
+        with self._recent_lock:
+            self._recent.pop(event.pathname, None)
+            self._recent[event.pathname] = now
+            if len(self._recent) > self.max_recent_entries:
+                self._recent.popitem(last=False)
+
+    def resync(self, since, directories=()):
+        """Rescan directories after events have been lost. Files modified after since that have
+        not been handled since they were last modified are handled as if an event was received.
+
+        Only directories with events since `since` are scanned in addition to the given ones.
+
+        :param since: Time in seconds since the epoch events may have been lost from
+        :type since: float
+        :param directories: Additional directories to scan, eg the watched directory
+        :rtype: int
+        :returns: Number of files handled"""
+        with self._recent_lock:
+            recent_dirs = set(os.path.dirname(pathname) for pathname, handled in self._recent.items()
+                              if handled >= since)
+        handled_files = 0
+        for dirpath, name, mtime in scan_new_files(sorted(recent_dirs.union(directories)), since, time.time()):
+            pathname = os.path.join(dirpath, name)
+            with self._recent_lock:
+                if self._recent.get(pathname, 0) >= mtime:
+                    continue
+            self.handle_event(pyinotify.Event({'wd' : -1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                                               'path' : dirpath, 'name' : name, 'dir' : False}))
+            handled_files += 1
+        return handled_files
+
+    def _queue_actions(self, filemask, event, trace=None, claim=None):
+        """Journal and queue filemask's actions for event, or spill them if the task queue is full"""
+        journal_id = self.journal.add(self.watch, filemask.pattern, event) if self.journal else None
+        # Claims are renewed while held so claimed actions are not spilled
+        if claim is None and self.task_queue.spill_task(
+                (self.watch, filemask.pattern, event.path, event.name, event.mask, journal_id)):
+            if trace:
+                trace.mark('spilled')
+                self.tracer.finish(trace)
+            return
+        self._start_actions(filemask, event, journal_id, trace, claim)
+
+    def unspill(self, pattern, path, name, mask, journal_id=None):
+        """Queue actions of filemask for event read back from spill queue"""
+        event = pyinotify.Event({'wd' : -1, 'mask' : mask, 'cookie' : 0,
+                                 'path' : path, 'name' : name, 'dir' : False})
+        filemask = self._filemask_patterns.get(pattern)
+        if filemask is None:
+            logger.warning("Filemask %s of watcher %s is no longer configured, dropping spilled actions for %s",
+                           pattern, self.watch, event.pathname,)
+            if journal_id is not None:
+                self.journal.complete(journal_id)
+            return
+        self._start_actions(filemask, event, journal_id)
+
+    def _start_actions(self, filemask, event, journal_id=None, trace=None, claim=None):
+        if self.action_graphs.get(filemask):
+            self.run_graph(self.action_graphs[filemask], event, journal_id, trace, claim)
+            return
+        self.queue_actions(event, self.action_plans[filemask], journal_id, trace = trace, claim = claim)
+
+    def take_over_claims(self):
+        """Take over expired claims of other instances and perform their actions
+
+        :rtype: int
+        :returns: Number of claims taken over"""
+        taken_over = 0
+        for key, data in self.claim_store.expired():
+            if data['filemask'] not in self._filemask_patterns:
+                continue
+            claim = self.claim_store.take_over(key, data)
+            if not claim:
+                continue
+            path, name = os.path.split(os.path.join(self.watch, data['path']))
+            self._queue_actions(self._filemask_patterns[data['filemask']],
+                                pyinotify.Event({'wd' : -1, 'mask' : data['mask'], 'cookie' : 0,
+                                                 'path' : path, 'name' : name, 'dir' : False}),
+                                claim = claim)
+            taken_over += 1
+        return taken_over
+
+    def _claim(self, filemask, event):
+        """Claim event's file for filemask
+
+        :rtype: :class:`cronify.cluster.Claim`
+        :returns: Claim, or None if file is claimed by another instance"""
+        relpath = os.path.relpath(event.pathname, self.watch)
+        key = claim_key(filemask, relpath, event.pathname)
+        try:
+            claim = self.claim_store.claim(key, {'filemask' : filemask, 'path' : relpath, 'mask' : event.mask})
+        except (IOError, OSError) as ex:
+            logger.error("Could not claim %s, performing actions without claim - %s", event.pathname, ex,)
+            return Claim(key, None)
+        if not claim:
+            logger.info("File %s is claimed by another instance for filemask %s, skipping actions",
+                        event.pathname, filemask,)
+        return claim
+
+    def queue_actions(self, event, actions, journal_id=None, start=0, scheduled=False, trace=None, claim=None):
+        """Add actions to this watcher's task queue. They are run by a thread pool worker
+        once all the concurrency limits of actions from start onwards have a free token.
+        Takes the same arguments as :meth:`do_actions`"""
+        limits = tuple(set(limit for plan in actions[start:] for limit in plan.limits))
+        if trace:
+            trace.mark('queued')
+        self.task_queue.add_task(self.watch, self.do_actions,
+                                 (event, actions, journal_id, start, scheduled, trace, claim), limits)
+
+    def _debounce_event(self, filemask, event):
+        """Hold event until no other event for the same file and filemask has been seen
+        for the filemask's debounce window. Only the last event of the window triggers actions"""
+        key = (filemask, event.pathname)
+        deadline = time.time() + self.debounce[filemask]
+        overflow = None
+        with self._debounce_lock:
+            entry = self._debounced.pop(key, None)
+            if entry:
+                entry[0], entry[1] = deadline, event
+            else:
+                entry = [deadline, event]
+                self.scheduler.schedule(deadline, self._flush_debounced, key)
+                if len(self._debounced) >= self.max_debounce_entries:
+                    overflow = self._debounced.popitem(last=False)
+            self._debounced[key] = entry
+        if overflow:
+            logger.warning("Debounce table is full, triggering actions for %s early", overflow[0][1],)
+            self._queue_actions(overflow[0][0], overflow[1][1])
+
+    def _flush_debounced(self, key):
+        """Trigger actions for debounced event if its window has passed, otherwise wait until it has"""
+        with self._debounce_lock:
+            entry = self._debounced.get(key)
+            if not entry:
+                return
+            if entry[0] > time.time():
+                self.scheduler.schedule(entry[0], self._flush_debounced, key)
+                return
+            del self._debounced[key]
+        self._queue_actions(key[0], entry[1])
     
-    def _parse_action_args(self, event, action_args):
-        """Parse action_args, return args with expanded keywords and file metadata
+    def _make_limits(self, data, name):
+        """Make concurrency limit if max_concurrency is set in configuration data
+
+        :rtype: tuple"""
+        if not data.get(self._max_concurrency_keyword):
+            return ()
+        return (ConcurrencyLimit(data[self._max_concurrency_keyword], name),)
+
+    def _make_dedup(self, data, filemask):
+        """Make filemask's dedup configuration if dedup is set in its configuration data
+
+        :rtype: :class:`cronify.fingerprint.DedupConfig`"""
+        try:
+            return parse_dedup_config(filemask, data.get(self._dedup_keyword))
+        except (ValueError, TypeError, AttributeError):
+            logger.error("Filemask %s has invalid dedup configuration %s, not deduplicating",
+                         filemask, data.get(self._dedup_keyword),)
+
+    def _make_action_graph(self, data, filemask, plans):
+        """Make action graph of filemask's action plans if any of its actions have depends_on.
+        Actions are not run if their dependencies are invalid
+
+        :rtype: tuple
+        :returns: Action plans, :class:`cronify.graph.ActionGraph` or None"""
+        depends_on = [action[action_name].get(self._depends_on_keyword)
+                      for action in data['actions'] for action_name in action]
+        if not [names for names in depends_on if names]:
+            return plans, None
+        try:
+            return plans, ActionGraph(plans, [[names] if isinstance(names, basestring) else names or []
+                                              for names in depends_on],
+                                      data.get(self._on_failure_keyword, 'skip'))
+        except (ValueError, TypeError) as ex:
+            logger.error("Filemask %s has invalid action dependencies, not running its actions - %s", filemask, ex,)
+            return tuple(plan._replace(error = "invalid depends_on") for plan in plans), None
+
+    def _compile_action(self, action_name, action, action_data, limits=(), dedup=None, filemask=None):
+        """Compile action configuration into an :class:`ActionPlan`"""
+        args = tuple(action_data['args'])
+        func, error = None, None
+        if self._callable_keyword in action_data:
+            cmd = action_data[self._callable_keyword]
+            try:
+                func = load_entry_point(cmd)
+            except (ImportError, AttributeError, ValueError) as ex:
+                logger.error("Action %s callable %s could not be loaded - %s", action_name, cmd, ex,)
+                error = "callable %s could not be loaded" % (cmd,)
+        else:
+            cmd = _find_executable(action_data['cmd'])
+            if not cmd:
+                logger.warning("Action %s command %s not found in PATH", action_name, action_data['cmd'],)
+                cmd = action_data['cmd']
+        try:
+            metadata = self._parse_action_metadata(action_data)
+        except (ValueError, AttributeError):
+            logger.error("Action %s has invalid start_time/end_time %s/%s, expected format HH:MM:SS",
+                         action_name, action_data.get('start_time'), action_data.get('end_time'),)
+            metadata, error = {}, "invalid start_time/end_time"
+        try:
+            batch = parse_batch_config(action_data.get('batch'))
+        except (ValueError, TypeError, AttributeError):
+            logger.error("Action %s has invalid batch configuration %s", action_name, action_data.get('batch'),)
+            batch, error = None, "invalid batch configuration"
+        return ActionPlan(action_name, action, cmd, args,
+                          tuple(i for i, arg in enumerate(args) if arg == self._filename_keyword),
+                          tuple(i for i, arg in enumerate(args) if arg == self._datestamp_keyword_fmt[0]),
+                          metadata.get('start_time'), metadata.get('end_time'), error,
+                          limits + self._make_limits(action_data, action_name), batch, dedup,
+                          func, bool(action_data.get('process_pool')), filemask)
+
+    def _parse_action_args(self, event, plan):
+        """Fill in action plan's placeholder args, return args with expanded keywords and file metadata
         with data required to perform actions"""
         file_metadata = {}
-        for i in range(len(action_args)):
-            arg = action_args[i]
-            arg.strip()
-            if arg == self._filename_keyword:
-                action_args[i] = event.pathname
-            elif arg == self._datestamp_keyword_fmt[0]:
-                file_datestamp = self._parse_datestamp(event.name)
-                if not file_datestamp:
-                    logger.debug("Could not parse datestamp from filename, falling back to file's modified time")
-                    file_datestamp = datetime.date.fromtimestamp(os.stat(event.pathname).st_mtime)
-                logger.debug("Parsed datestamp %s for file %s", file_datestamp.strftime(self._datestamp_keyword_fmt[1]),
-                            event.pathname,)
+        action_args = list(plan.args)
+        for i in plan.filename_positions:
+            action_args[i] = event.pathname
+        if plan.datestamp_positions or (plan.start_time is not None and plan.end_time is not None):
+            file_datestamp = self._parse_datestamp(event.name)
+            if not file_datestamp:
+                logger.debug("Could not parse datestamp from filename, falling back to file's modified time")
+                file_datestamp = datetime.date.fromtimestamp(os.stat(event.pathname).st_mtime)
+            logger.debug("Parsed datestamp %s for file %s", file_datestamp.strftime(self._datestamp_keyword_fmt[1]),
+                         event.pathname,)
+            for i in plan.datestamp_positions:
                 action_args[i] = file_datestamp.strftime(self._datestamp_keyword_fmt[1])
-                file_metadata['datestamp'] = file_datestamp
+            file_metadata['datestamp'] = file_datestamp
         return action_args, file_metadata
 
     def _parse_action_metadata(self, action):
@@ -141,11 +538,21 @@ class EventHandler(pyinotify.ProcessEvent):
                 logger.debug("Parsed action end time %s", (metadata['end_time'],))
         return metadata
 
-    def _parse_filemask(self, filemask):
-        """Parse filemask constraints like datestamp in filename and return compiled regex for filemask matching"""
+    def _parse_filemask(self, filemask, previous_regexes=None):
+        """Parse filemask constraints like datestamp in filename and return compiled regex for filemask matching.
+
+        :param previous_regexes: Compiled regexes by filemask of the handler being replaced, reused if present
+        :type previous_regexes: dict"""
+        regex = previous_regexes.get(filemask) if previous_regexes else None
+        if regex is not None:
+            self._filemask_regexes[filemask] = regex
+            return regex
         if not self._datestamp_keyword_fmt[0] in filemask:
-            return re.compile(fnmatch.translate(filemask))
-        return re.compile(filemask.replace(self._datestamp_keyword_fmt[0], self._datestamp_re))
+            regex = re.compile(fnmatch.translate(filemask))
+        else:
+            regex = re.compile(filemask.replace(self._datestamp_keyword_fmt[0], self._datestamp_re))
+        self._filemask_regexes[filemask] = regex
+        return regex
 
     def _parse_isoformat_time(self, isotime):
         """Parse isotime string into a datetime object
@@ -169,19 +576,173 @@ class EventHandler(pyinotify.ProcessEvent):
             logger.debug("Parsed file datestamp from date in filename - %s from %s", file_datestamp, filename,)
         return datetime.date(file_datestamp.year, file_datestamp.month, file_datestamp.day)
 
-    def do_actions(self, event, actions):
-        """Perform actions"""
-        logger.debug("Starting actions %s", (actions,))
-        [self._do_action(event, action, action_data) for action in actions
-         for action_data in action.itervalues()]
+    def do_actions(self, event, actions, journal_id=None, start=0, scheduled=False, trace=None, claim=None):
+        """Perform actions
+
+        :param actions: Action plans to perform, in sequence
+        :type actions: tuple of :class:`ActionPlan`
+        :param journal_id: Journal entry id of actions, if journaled
+        :param start: Index of first action to perform
+        :param scheduled: First action was deferred by the scheduler and is now due
+        :param trace: Lifecycle trace of actions, if event is traced
+        :type trace: :class:`cronify.tracing.Trace`
+        :param claim: Claim of event's file, if already claimed. File is claimed before \
+        the first action if a claim store is configured
+        :type claim: :class:`cronify.cluster.Claim`"""
+        logger.debug("Starting actions %s", ([plan.name for plan in actions],))
+        if trace:
+            trace.mark('pickup')
+        self._do_actions(event, actions, start, scheduled, journal_id, trace, claim)
+
+    def _do_actions(self, event, actions, start, scheduled, journal_id, trace=None, claim=None):
+        """Perform actions in sequence. If an action's start time is in the future,
+        it and the actions after it are handed to the scheduler and the worker is released"""
+        dedup = actions[0].dedup
+        fingerprint = self._fingerprint(event, dedup) if dedup and start == 0 and not scheduled else None
+        failed = False
+        try:
+            if fingerprint and fingerprint in self.fingerprints:
+                logger.info("File %s is unchanged since actions of filemask %s last ran, skipping actions",
+                            event.pathname, dedup.filemask,)
+                return
+            if self.claim_store and claim is None and start == 0 and not scheduled:
+                claim = self._claim(actions[0].filemask, event)
+                if not claim:
+                    return
+            for i in range(start, len(actions)):
+                fire_time = self._do_action(event, actions[i], scheduled=scheduled and i == start,
+                                            continuation=(actions, i, journal_id, claim), trace=trace)
+                if fire_time is _FAILED:
+                    failed = True
+                    continue
+                if fire_time is _BATCHED:
+                    journal_id, claim = None, None
+                    return
+                if fire_time is not None:
+                    self._deferred.inc()
+                    if journal_id:
+                        self.journal.defer(journal_id, i, fire_time)
+                    if trace:
+                        trace.mark('deferred', actions[i].name)
+                    self.scheduler.schedule(fire_time, self.queue_actions, event, actions, journal_id, i, True,
+                                            trace, claim)
+                    journal_id, trace, claim = None, None, None
+                    return
+            if fingerprint and not failed:
+                self.fingerprints.add(fingerprint, dedup.ttl)
+        finally:
+            if journal_id:
+                self.journal.complete(journal_id)
+            if claim:
+                self.claim_store.release(claim)
+            if trace:
+                self.tracer.finish(trace)
+
+    def _fingerprint(self, event, dedup):
+        """Fingerprint cache key of event's file, or None if file cannot be read"""
+        try:
+            return (self.watch, dedup.filemask, file_fingerprint(event.pathname, dedup.content_hash))
+        except (IOError, OSError) as ex:
+            logger.debug("Could not fingerprint file %s - %s", event.pathname, ex,)
+
+    def run_graph(self, graph, event, journal_id=None, trace=None, claim=None):
+        """Perform actions of action graph. Actions without dependencies are queued, others are queued
+        once the actions they depend on are done. Each action is a separate task so independent actions
+        run in parallel
+
+        :param graph: Graph of actions to perform
+        :type graph: :class:`cronify.graph.ActionGraph`
+        :param journal_id: Journal entry id of actions, if journaled
+        :param trace: Lifecycle trace of actions, if event is traced
+        :type trace: :class:`cronify.tracing.Trace`
+        :param claim: Claim of event's file, if already claimed
+        :type claim: :class:`cronify.cluster.Claim`"""
+        run = GraphRun(graph, event, journal_id, trace, claim)
+        if graph.plans[0].dedup or (self.claim_store and not claim):
+            # Fingerprinting reads the file and claiming writes to the claim store, so are done by a worker
+            self.task_queue.add_task(self.watch, self._start_graph, (run,), ())
+            return
+        self._start_graph(run)
+
+    def _start_graph(self, run):
+        dedup = run.graph.plans[0].dedup
+        if dedup:
+            run.fingerprint = self._fingerprint(run.event, dedup)
+            if run.fingerprint and run.fingerprint in self.fingerprints:
+                logger.info("File %s is unchanged since actions of filemask %s last ran, skipping actions",
+                            run.event.pathname, dedup.filemask,)
+                run.fingerprint = None
+                self._finish_graph(run)
+                return
+        if self.claim_store and not run.claim:
+            run.claim = self._claim(run.graph.plans[0].filemask, run.event)
+            if not run.claim:
+                self._finish_graph(run)
+                return
+        for index in run.start():
+            self._queue_graph_action(run, index)
+
+    def _queue_graph_action(self, run, index, scheduled=False):
+        plan = run.graph.plans[index]
+        if run.trace:
+            run.trace.mark('queued', plan.name)
+        self.task_queue.add_task(self.watch, self._do_graph_action, (run, index, scheduled), plan.limits)
+
+    def _do_graph_action(self, run, index, scheduled):
+        """Perform action of graph run, then queue actions depending on it that are ready"""
+        plan = run.graph.plans[index]
+        if run.trace:
+            run.trace.mark('pickup', plan.name)
+        try:
+            fire_time = self._do_action(run.event, plan, scheduled=scheduled,
+                                        continuation=(run, index, None, None), trace=run.trace)
+        except Exception:
+            logger.exception("Action %s for %s raised exception", plan.name, run.event.pathname,)
+            fire_time = _FAILED
+        if fire_time is _BATCHED:
+            return
+        if fire_time is not None and fire_time is not _FAILED:
+            self._deferred.inc()
+            if run.trace:
+                run.trace.mark('deferred', plan.name)
+            self.scheduler.schedule(fire_time, self._queue_graph_action, run, index, True)
+            return
+        self._graph_action_done(run, index, fire_time is _FAILED)
 
-    def _do_action(self, event, action, action_data):
-        """Perform a single action"""
-        action_metadata = self._parse_action_metadata(action_data)
-        action_args, file_metadata = self._parse_action_args(event, action_data['args'][:])
+    def _graph_action_done(self, run, index, failed):
+        ready, finished = run.complete(index, failed)
+        for i in ready:
+            self._queue_graph_action(run, i)
+        if finished:
+            self._finish_graph(run)
+
+    def _finish_graph(self, run):
+        if run.fingerprint and not run.failed:
+            self.fingerprints.add(run.fingerprint, run.graph.plans[0].dedup.ttl)
+        if run.journal_id:
+            self.journal.complete(run.journal_id)
+        if run.claim:
+            self.claim_store.release(run.claim)
+        if run.trace:
+            self.tracer.finish(run.trace)
+
+    def _do_action(self, event, plan, scheduled=False, continuation=None, trace=None):
+        """Perform a single action
+
+        :param continuation: (actions, index, journal_id, claim) of the action sequence this action is part of, \
+        or (:class:`cronify.graph.GraphRun`, index, None, None) for actions of a graph. Required for batched \
+        actions, which continue the sequence or graph once their batch has run
+        :rtype: float
+        :returns: Time in seconds since the epoch action should be run at if \
+        its start time is in the future, :data:`_BATCHED` if action was added to a batch, \
+        :data:`_FAILED` if action failed, otherwise None"""
+        if plan.error:
+            logger.error("Not running action %s with %s", plan.name, plan.error,)
+            return _FAILED
+        action_args, file_metadata = self._parse_action_args(event, plan)
         logger.debug("Made expanded action arguments %s", (action_args,))
-        action_args.insert(0, action_data['cmd'])
-        if action_metadata and 'start_time' in action_metadata and 'end_time' in action_metadata:
+        action_args.insert(0, plan.cmd)
+        if not scheduled and plan.start_time is not None and plan.end_time is not None:
             utc = datetime.datetime.utcnow()
             now = datetime.datetime(utc.year, utc.month, utc.day, utc.hour, utc.minute, utc.second,
                                     tzinfo = pytz.utc)
@@ -196,41 +757,190 @@ class EventHandler(pyinotify.ProcessEvent):
                 logger.debug("No local_tz config, using system timezone")
                 # now is UTC, need naive datetime
                 now = datetime.datetime.now()
-            start_time = datetime.datetime(file_metadata['datestamp'].year, file_metadata['datestamp'].month,
-                                           file_metadata['datestamp'].day, action_metadata['start_time'].hour,
-                                           action_metadata['start_time'].minute, action_metadata['start_time'].second)
-            end_time = datetime.datetime(file_metadata['datestamp'].year, file_metadata['datestamp'].month,
-                                         file_metadata['datestamp'].day, action_metadata['end_time'].hour,
-                                         action_metadata['end_time'].minute, action_metadata['end_time'].second)
+            start_time = datetime.datetime.combine(file_metadata['datestamp'], plan.start_time)
+            end_time = datetime.datetime.combine(file_metadata['datestamp'], plan.end_time)
             if now < start_time:
-                logger.info("Action start time %s is in the future, waiting for %s hh:mm:SS",
-                            start_time, start_time - now,)
-                time.sleep((start_time - now).seconds)
+                delay = start_time - now
+                logger.info("Action start time %s is in the future, scheduling to run in %s hh:mm:SS",
+                            start_time, delay,)
+                return time.time() + delay.days * 86400 + delay.seconds
             elif now > start_time and now > end_time:
                 logger.info("Action start time %s is in the past and end time %s has passed, not triggering action",
                             start_time, end_time)
                 return
+        if plan.batch and continuation:
+            actions, index, journal_id, claim = continuation
+            if journal_id:
+                # Replay from this action if daemon is restarted before batch has run
+                self.journal.defer(journal_id, index, None)
+            if trace:
+                trace.mark('batched', plan.name)
+            entries = self.batcher.add(plan, BatchEntry(event, action_args, actions, index, journal_id, claim))
+            if entries:
+                self.run_batch(plan, entries)
+            return _BATCHED
         if self.callback_func:
             self.callback_func(event)
-        returncode, stdout, stderr = run_script(action_args)
-        logger.info("Got result from action %s - %s", action_data, stdout,)
+        file_metadata['pathname'] = event.pathname
+        if self._run_action(plan, action_args, trace = trace, file_metadata = file_metadata):
+            return _FAILED
+
+    def _run_action(self, plan, action_args, stdin_data=None, trace=None, file_metadata=None):
+        """Run action command or callable with expanded arguments and log result
+
+        :rtype: int
+        :returns: Action's exit code"""
+        start_time = time.time()
+        if trace:
+            trace.mark('spawn', plan.name)
+        if plan.func:
+            returncode = self._call_action(plan, action_args[1:], file_metadata or {})
+        else:
+            stdout_capture, stderr_capture = [self._make_output_capture(plan, stream)
+                                              for stream in ('stdout', 'stderr')]
+            returncode, stdout, stderr = run_script(action_args, stdout_capture, stderr_capture, stdin_data,
+                                                    self.spawner)
+            logger.info("Got result from action %s - exit code %s, %s bytes of stdout, %s bytes of stderr",
+                        plan.action[plan.name], returncode, stdout_capture.bytes, stderr_capture.bytes,)
+            if returncode:
+                logger.error("Action %s failed with exit code %s, stderr %s",
+                             plan.action, returncode, stderr,)
+        if trace:
+            trace.mark('exit', plan.name)
+        self.metrics.action_duration.labels(self.watch, plan.name).observe(time.time() - start_time)
+        self.metrics.action_exit_codes.labels(self.watch, plan.name, returncode).inc()
+        return returncode
+
+    def _call_action(self, plan, action_args, file_metadata):
+        """Call action's Python callable in this worker thread, or in the process pool if configured
+
+        :rtype: int
+        :returns: Integer returned by callable, 1 if it raised an exception, otherwise 0"""
+        try:
+            if plan.process_pool:
+                result = self.process_pool.call(plan.cmd, action_args, file_metadata)
+            else:
+                result = plan.func(action_args, file_metadata)
+        except Exception:
+            logger.exception("Action %s callable %s raised exception", plan.name, plan.cmd,)
+            return 1
+        returncode = result if isinstance(result, int) and not isinstance(result, bool) and result else 0
+        logger.info("Got result from action %s callable %s - %s", plan.name, plan.cmd, result,)
         if returncode:
-            logger.error("Action %s failed with exit code %s, stderr %s",
-                         action, returncode, stderr,)
+            logger.error("Action %s callable %s failed with exit code %s", plan.name, plan.cmd, returncode,)
+        return returncode
+
+    def _queue_batch(self, plan, entries):
+        """Queue batch that has reached its maximum latency, subject to the action's concurrency limits"""
+        self.task_queue.add_task(self.watch, self.run_batch, (plan, entries), plan.limits)
+
+    def run_batch(self, plan, entries):
+        """Run batched action once for all files in entries, then continue each file's action sequence.
+
+        File names are either expanded in place of the \$filename argument or, with the stdin batch option,
+        written to the command's stdin one per line. Other arguments are expanded from the first file"""
+        pathnames = [entry.event.pathname for entry in entries]
+        action_args = [plan.cmd]
+        for i, arg in enumerate(entries[0].action_args[1:]):
+            if i not in plan.filename_positions:
+                action_args.append(arg)
+            elif not plan.batch.stdin:
+                action_args.extend(pathnames)
+        logger.debug("Running batch of %s files for action %s", len(entries), plan.name,)
+        if self.callback_func:
+            for entry in entries:
+                self.callback_func(entry.event)
+        failed = True
+        try:
+            failed = bool(self._run_action(
+                plan, action_args,
+                stdin_data = ''.join(pathname + '\n' for pathname in pathnames) if plan.batch.stdin else None,
+                file_metadata = {'pathnames' : pathnames}))
+        finally:
+            for entry in entries:
+                if isinstance(entry.actions, GraphRun):
+                    self._graph_action_done(entry.actions, entry.index, failed)
+                elif entry.index + 1 < len(entry.actions):
+                    self.queue_actions(entry.event, entry.actions, entry.journal_id, entry.index + 1,
+                                       claim = entry.claim)
+                else:
+                    if entry.journal_id:
+                        self.journal.complete(entry.journal_id)
+                    if entry.claim:
+                        self.claim_store.release(entry.claim)
+
+    def _make_output_capture(self, plan, stream):
+        """Make output capture for action's stream. Output goes to rotating output files per watcher,
+        filemask and action if an output directory is configured, otherwise it is logged in chunks"""
+        if not self.output_dir:
+            return OutputCapture(plan.name, stream)
+        filemask = self._filemask_names.get(plan.filemask, plan.filemask or '')
+        return OutputCapture(plan.name, stream, log = False,
+                             output_file = get_output_file(self.output_dir, self.watch or '', filemask,
+                                                           plan.name, stream))
+
+
+class _DefaultProcessEvent(pyinotify.ProcessEvent):
+
+    """Notifier's default processing function. Receives events not belonging to a watch,
+    such as inotify queue overflows"""
+
+    def __init__(self, overflow_func):
+        pyinotify.ProcessEvent.__init__(self)
+        self.overflow_func = overflow_func
+
+    def process_IN_Q_OVERFLOW(self, event):
+        self.overflow_func(event)
+
+    def process_default(self, event):
+        pass
 
 
 class Watcher(object):
     
-    """Watcher class to watch a directory and trigger actions"""
+    """Watcher class to watch a directory and trigger actions.
+
+    Event, action and queue metrics are available from the watcher's ``metrics``
+    registry, see :class:`cronify.metrics.Metrics`"""
     
     _req_data_fields = [ 'name', 'filemasks' ]
     _req_filemask_fields = [ 'actions' ]
-    _req_action_fields = [ 'cmd', 'args' ]
+    _req_action_fields = [ 'args' ]
+    # Actions run either a command or a Python callable
+    _action_cmd_fields = [ 'cmd', 'callable' ]
     _req_time_fields = ['start_time', 'end_time']
+    # Seconds between saves of catch-up high-water marks and fingerprints, and seconds
+    # marks are kept behind the current time to allow for events still being read
+    _checkpoint_interval = 60
+    _catchup_slack = 5
+    # Seconds before an overflow events may have been lost from, and seconds to wait
+    # for further overflows before resyncing
+    _overflow_window = 60
+    _resync_delay = 1
+    # Seconds between checks for expired claims of other instances, for watches with cluster configured
+    _claim_check_interval = 15
+    # Seconds between scans of directories left out of the watch budget
+    _scan_interval = 30
+    # Settings of recursive watchers that require their directory tree to be walked again when changed
+    _tree_fields = ['recurse', 'exclude_dirs', 'max_depth', 'backend', 'poll']
     
     def __init__(self, watch_data,
                  callback_func=None,
-                 num_workers=10):
+                 num_workers=10,
+                 journal_file=None,
+                 loop=None,
+                 output_dir=None,
+                 catchup_file=None,
+                 max_queued_events=None,
+                 trace_hooks=None,
+                 trace_sample_rate=1.0,
+                 fingerprint_file=None,
+                 num_processes=None,
+                 spawn_server=False,
+                 max_queued_tasks=None,
+                 spill_dir=None,
+                 max_watches=None,
+                 config_cache_file=None):
         """
         Start a watcher with watch data
         
@@ -241,6 +951,51 @@ class Watcher(object):
         There should be only one positional parameter in callback_func for the event object to be passed in
         :type callback_func: function
         :param num_workers: Number of worker threads in actions worker queue
+        :param journal_file: Optional path to journal file. Queued and scheduled actions are \
+        recorded in the journal and actions left pending by a previous run are replayed on startup
+        :type journal_file: str
+        :param loop: Optional asyncio event loop. When given, the inotify file descriptor is read \
+        by the event loop instead of an asyncore thread. Use with :meth:`run`.
+        :type loop: :mod:`asyncio.AbstractEventLoop`
+        :param output_dir: Optional directory to write action stdout and stderr to, in per action \
+        rotating files. Action output is logged if not set
+        :type output_dir: str
+        :param catchup_file: Optional path to file high-water marks of watched directories are kept in. \
+        When set, files modified in watched directories while cronify was not running trigger their \
+        actions on startup. A directory's files are only scanned once it has a high-water mark, ie from \
+        the second startup with it configured
+        :type catchup_file: str
+        :param max_queued_events: Optional size of kernel inotify event queue to set. \
+        Requires root privileges. Events beyond the queue size are lost, after which \
+        directories with recent activity are rescanned
+        :type max_queued_events: int
+        :param trace_hooks: Optional list of callables to pass lifecycle traces of events to, \
+        see :mod:`cronify.tracing`. Called from worker threads once an event's actions are done
+        :type trace_hooks: list
+        :param trace_sample_rate: Fraction of events to trace when trace_hooks are given
+        :type trace_sample_rate: float
+        :param fingerprint_file: Optional path to file fingerprints of files processed by filemasks \
+        with dedup configured are persisted to
+        :type fingerprint_file: str
+        :param num_processes: Number of worker processes for callable actions configured \
+        with process_pool. Defaults to number of CPUs. Processes are started on first use
+        :type num_processes: int
+        :param spawn_server: Launch action commands from a spawn server process, see \
+        :mod:`cronify.spawner`, instead of forking this process for each action
+        :type spawn_server: bool
+        :param max_queued_tasks: Optional maximum number of tasks queued in memory. Beyond it, \
+        new events' actions are spilled to segment files in spill_dir and read back in order as \
+        the queue drains
+        :type max_queued_tasks: int
+        :param spill_dir: Directory to spill tasks to. Defaults to a temporary directory
+        :type spill_dir: str
+        :param max_watches: Optional maximum number of inotify watches of all watchers. Defaults \
+        to the kernel's max_user_watches. Directories of recursive watchers beyond it are scanned \
+        for new files periodically instead of being watched
+        :type max_watches: int
+        :param config_cache_file: Optional path to cache of validated configuration used when \
+        configuration is re-read from file on reload, see :func:`load_cfg`
+        :type config_cache_file: str
 
         For example ::
         
@@ -256,60 +1011,196 @@ class Watcher(object):
                         }}}}
         
         """
-        self.watch_managers, self.notifiers = [], []
+        self.watch_manager, self.notifier = None, None
+        self.event_handlers, self.watch_descriptors = {}, {}
         self.callback_func = callback_func
+        self.loop, self._run_future = loop, None
+        self.output_dir = output_dir
+        self.config_cache_file = config_cache_file
+        self.asyncore_thread, self._channel_map = None, None
         if not self.check_watch_data(watch_data):
             logger.critical("Bad configuration, cannot start")
             sys.exit(1)
         self.watch_data = watch_data
         [self._check_timezone_info(self.watch_data[watch]) for watch in self.watch_data]
+        # Started before worker threads
+        self.spawner = SpawnServer() if spawn_server else None
         self.thread_pool = threadpool.ThreadPool(num_workers=num_workers)
+        self.metrics = Metrics()
+        self.tracer = Tracer(trace_hooks, trace_sample_rate) if trace_hooks else None
+        # Temporary spill directory is removed on cleanup
+        self._spill_tmp_dir = tempfile.mkdtemp(prefix='cronify-spill-') \
+                              if max_queued_tasks and not spill_dir else None
+        self.spill = SpillQueue(spill_dir or self._spill_tmp_dir) if max_queued_tasks else None
+        self.task_queue = FairQueue(self.thread_pool, self.metrics, max_queued=max_queued_tasks,
+                                    spill=self.spill, unspill_func=self._unspill)
+        self.scheduler = Scheduler(self.thread_pool)
+        self._add_gauges()
+        self.journal = Journal(journal_file) if journal_file else None
+        self.catchup = CatchupState(catchup_file) if catchup_file else None
+        self.fingerprints = FingerprintCache(cache_file = fingerprint_file)
+        self.process_pool = ProcessPool(num_processes)
+        self._checkpoint_timer = None
+        # Claim stores of watches with cluster configured
+        self.claim_stores, self._claim_timer = {}, None
+        self.overflows = 0
+        self._resync_since, self._resync_lock = None, threading.Lock()
+        self._check_inotify_limits(max_queued_events)
+        if not max_watches:
+            try:
+                max_watches = pyinotify.max_user_watches.value
+            except (IOError, OSError):
+                pass
+        self.max_watches = max_watches
+        # Directory trees of recursive watchers
+        self.watch_trees, self._scan_timer = {}, None
+        # Pollers of watchers with poll backend
+        self.pollers = {}
         self.start_watchers(self.watch_data)
+        if self.journal:
+            self.replay_journal()
         signal.signal(signal.SIGUSR1, self.reload_signal_handler)
-        self.asyncore_thread = None
 
-    def _asyncore_target_thread(self):
-        """Target function for per watcher asyncore loop thread"""
-        while True:
-            asyncore.loop()
+    def _add_gauges(self):
+        """Add gauges of watcher state to metrics registry"""
+        self.metrics.gauge('cronify_queued_tasks', 'Tasks waiting in task queue', self.task_queue.depths, ('queue',))
+        self.metrics.gauge('cronify_scheduled_tasks', 'Deferred actions and timers waiting in scheduler',
+                           lambda: len(self.scheduler))
+        self.metrics.gauge('cronify_watches', 'inotify watches',
+                           lambda: len(self.watch_manager.watches) if self.watch_manager else 0)
+        self.metrics.gauge('cronify_inotify_overflows', 'inotify event queue overflows', lambda: self.overflows)
+        self.metrics.gauge('cronify_polled_dirs', 'Directories polled by watchers with poll backend',
+                           lambda: sum(len(poller) for poller in list(self.pollers.values())))
+        self.metrics.gauge('cronify_unwatched_dirs', 'Directories scanned as they did not fit in the watch budget',
+                           lambda: sum(len(tree.unwatched) for tree in list(self.watch_trees.values())))
+        if self.spill is not None:
+            self.metrics.gauge('cronify_spilled_tasks', 'Tasks waiting in spill files',
+                               lambda: len(self.spill))
+            self.metrics.gauge('cronify_spill_bytes', 'Bytes of spill files waiting to be read',
+                               lambda: self.spill.backlog_bytes)
+            self.metrics.gauge('cronify_spilled_tasks_total', 'Tasks spilled since startup',
+                               lambda: self.spill.spilled)
+
+    def _unspill(self, record):
+        """Queue actions of task record read back from spill queue"""
+        event_handler = self.event_handlers.get(record[0])
+        if event_handler is None:
+            logger.warning("Watcher %s is no longer configured, dropping spilled actions for %s",
+                           record[0], os.path.join(record[2], record[3]),)
+            if self.journal and record[5] is not None:
+                self.journal.complete(record[5])
+            return
+        event_handler.unspill(*record[1:])
+
+    def _check_inotify_limits(self, max_queued_events=None):
+        """Set kernel inotify queue size if given and log inotify limits"""
+        if max_queued_events:
+            try:
+                pyinotify.max_queued_events.value = max_queued_events
+            except (IOError, OSError) as ex:
+                logger.error("Could not set inotify max_queued_events to %s - %s", max_queued_events, ex,)
+        try:
+            logger.info("inotify limits - max_queued_events %s, max_user_watches %s, max_user_instances %s",
+                        pyinotify.max_queued_events.value, pyinotify.max_user_watches.value,
+                        pyinotify.max_user_instances.value,)
+        except (IOError, OSError) as ex:
+            logger.warning("Could not read inotify limits - %s", ex,)
+
+    def handle_overflow(self, event):
+        """Count inotify queue overflow and schedule resync of directories with recent activity.
+        Overflows before the resync has run are resynced together"""
+        self.overflows += 1
+        logger.warning("inotify event queue overflowed, events have been lost. %s overflows so far",
+                       self.overflows,)
+        with self._resync_lock:
+            if self._resync_since is not None:
+                return
+            self._resync_since = time.time() - self._overflow_window
+        self.scheduler.schedule(time.time() + self._resync_delay, self._resync)
+
+    def _resync(self):
+        """Rescan directories with events since the first unsynced overflow. Idle directories
+        are not scanned, files lost from them are found by catch-up scans on restart"""
+        with self._resync_lock:
+            since, self._resync_since = self._resync_since, None
+        for watcher, event_handler in list(self.event_handlers.items()):
+            handled_files = event_handler.resync(since)
+            logger.info("Resync of %s after inotify queue overflow found %s unhandled files",
+                        watcher, handled_files,)
+
+    def _asyncore_target_thread(self, channel_map):
+        """Target function for asyncore loop thread.
+        Returns once the notifier's channel is removed from channel_map"""
+        asyncore.loop(timeout = 1, use_poll = True, map = channel_map)
+
+    def run(self):
+        """Run watcher on its asyncio event loop until :meth:`cleanup` is called.
+        Returns a future to wait on, eg ::
+
+          watcher = Watcher(watch_data, loop = asyncio.get_event_loop())
+          await watcher.run()
+
+        :rtype: :mod:`asyncio.Future`
+        """
+        if not self.loop:
+            raise ValueError("Watcher was not started with an asyncio event loop")
+        if not self._run_future:
+            self._run_future = self.loop.create_future()
+        return self._run_future
+
+    def _set_run_result(self):
+        if self._run_future and not self._run_future.done():
+            self._run_future.set_result(None)
 
     def reload_signal_handler(self, signalnum, frame):
         """Signal handler for reloading configuration file and watchers"""
         logger.info("Reloading watchers from configuration file %s", (CFG_FILE,))
         self.update_watchers()
 
-    def check_watch_data(self, watch_data):
-        """Check that watch_data is valid
+    @classmethod
+    def check_watch_data(cls, watch_data):
+        """Check that watch_data is valid, in a single pass over its watchers, filemasks and actions
         
         :rtype: bool
         :return: True if watch_data is valid, False otherwise
         """
-        if not self._check_data_fields(watch_data, self._req_data_fields):
+        if not cls._check_data_fields(watch_data, cls._req_data_fields):
             return False
         try:
-            if False in [False for watch in watch_data
-                         if not self._check_data_fields(watch_data[watch]['filemasks'],
-                                                        self._req_filemask_fields)]:
-                return False
-            if False in [False for watch in watch_data for filemask in watch_data[watch]['filemasks']
-             if not watch_data[watch]['filemasks'][filemask]['actions']]:
-                return False
-            if False in [False for watch in watch_data for filemask in watch_data[watch]['filemasks']
-                         for action in watch_data[watch]['filemasks'][filemask]['actions']
-                         if not self._check_data_fields(action, self._req_action_fields)]:
-                return False
-            if False in [False for watch in watch_data for filemask in watch_data[watch]['filemasks']
-                         for action in watch_data[watch]['filemasks'][filemask]['actions']
-                         if (self._req_time_fields[0] in action.values()[0]
-                             or self._req_time_fields[1] in action.values()[0])
-                         and not self._check_data_fields(action, self._req_time_fields)]:
-                return False
+            for watch in watch_data:
+                filemasks = watch_data[watch]['filemasks']
+                if not cls._check_data_fields(filemasks, cls._req_filemask_fields):
+                    return False
+                for filemask in filemasks:
+                    actions = filemasks[filemask]['actions']
+                    if not actions:
+                        logger.critical("Filemask %s of %s has no actions", filemask, watch,)
+                        return False
+                    for action in actions:
+                        if not cls._check_action(action):
+                            return False
         except TypeError:
             logger.critical("Missing required configuration, exiting")
             return False
         return True
 
-    def _check_data_fields(self, data, req_fields):
+    @classmethod
+    def _check_action(cls, action):
+        """Check action has its required fields, exactly one of a command or a callable
+        and both or neither of start and end times"""
+        if not cls._check_data_fields(action, cls._req_action_fields):
+            return False
+        action_data = action.values()[0]
+        if len([field for field in cls._action_cmd_fields if field in action_data]) != 1:
+            logger.critical("Actions require exactly one of %s", cls._action_cmd_fields,)
+            return False
+        if (cls._req_time_fields[0] in action_data or cls._req_time_fields[1] in action_data) \
+                and not cls._check_data_fields(action, cls._req_time_fields):
+            return False
+        return True
+
+    @classmethod
+    def _check_data_fields(cls, data, req_fields):
         """Check for required data fields
         
         :type: dict
@@ -331,30 +1222,309 @@ class Watcher(object):
         return True
 
     def start_watchers(self, watch_data):
-        """Go through watch_data and start watchers"""
+        """Go through watch_data and start watchers.
+
+        All directories are watched by a single inotify instance. Each watch is added with
+        its watcher's :class:`EventHandler` as processing function, so pyinotify routes events
+        to the right handler by watch descriptor"""
+        # Scheduler and journal are stopped by cleanup, watchers can be started again after it
+        self.scheduler.start()
+        if self.journal:
+            self.journal.open()
+        if not self.watch_manager:
+            self._start_notifier()
+        pending = set(os.path.join(entry.path, entry.name) for entry in self.journal.pending()) \
+            if self.catchup and self.journal else set()
+        start_time = time.time()
         for watcher in watch_data:
-            watch_dir = self._check_dir(watcher)
-            if not watch_dir:
-                logger.critical("Desired directory to watch %s does not exist or is not a directory. Exiting.", (watcher,))
-                sys.exit(1)
-            recurse = watch_data[watcher]['recurse'] if 'recurse' in watch_data[watcher] else False
-            watch_manager = pyinotify.WatchManager()
-            local_tz = watch_data[watcher]['local_tz'] if 'local_tz' in watch_data[watcher] else None
-            notifier = pyinotify.AsyncNotifier(watch_manager, EventHandler(watch_data[watcher]['filemasks'].copy(),
-                                                                           self.thread_pool,
-                                                                           callback_func = self.callback_func,
-                                                                           local_tz = local_tz
-                                                                           ))
-            watch_manager.add_watch(watch_dir, _MASKS, rec = recurse, auto_add = True)
-            logger.info("Started watching directory %s with filemasks and actions %s, recurse %s..",
-                        watch_dir,
-                        watch_data[watcher]['filemasks'],
-                        recurse,)
-            self.notifiers.append(notifier)
-            self.watch_managers.append(watch_manager)
-        self.asyncore_thread = threading.Thread(target = self._asyncore_target_thread)
-        self.asyncore_thread.daemon = True
-        self.asyncore_thread.start()
+            # Files modified after watch is added are seen by inotify
+            watched_at = time.time()
+            self._add_watch(watcher, watch_data[watcher])
+            if self.catchup and self.catchup.get(watcher) is not None:
+                self._catchup_watch(watcher, watch_data[watcher], watched_at, pending)
+        if self.catchup:
+            self.catchup.save(watch_data, start_time)
+        if self.catchup or self.fingerprints.cache_file:
+            if self._checkpoint_timer:
+                self.scheduler.cancel(self._checkpoint_timer)
+            self._checkpoint_timer = self.scheduler.schedule(time.time() + self._checkpoint_interval,
+                                                             self._checkpoint)
+
+    def _catchup_watch(self, watcher, data, watched_at, pending=()):
+        """Trigger actions for files of watcher modified between its high-water mark and
+        the time its watch was added. Files with actions pending in the journal are skipped"""
+        since = self.catchup.get(watcher)
+        tree = self.watch_trees.get(watcher)
+        files = scan_new_files([self._check_dir(watcher)], since, watched_at,
+                               recurse = data['recurse'] if 'recurse' in data else False,
+                               exclude = tree.excluded if tree else None)
+        logger.info("Catch-up scan of %s found %s files modified since %s",
+                    watcher, len(files), datetime.datetime.fromtimestamp(since),)
+        event_handler = self.event_handlers[watcher]
+        for dirpath, name, _ in files:
+            if os.path.join(dirpath, name) in pending:
+                continue
+            event_handler.handle_event(pyinotify.Event({'wd' : -1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                                                        'path' : dirpath, 'name' : name, 'dir' : False}))
+
+    def _checkpoint(self):
+        """Periodically save state while watchers are running"""
+        if not self.watch_manager:
+            return
+        self._save_state()
+        self._checkpoint_timer = self.scheduler.schedule(time.time() + self._checkpoint_interval,
+                                                         self._checkpoint)
+
+    def _take_over_claims(self):
+        """Periodically take over expired claims of other instances"""
+        if not self.watch_manager:
+            self._claim_timer = None
+            return
+        for watcher, event_handler in list(self.event_handlers.items()):
+            if not event_handler.claim_store:
+                continue
+            try:
+                taken_over = event_handler.take_over_claims()
+            except (IOError, OSError) as ex:
+                logger.error("Could not check claims of watcher %s - %s", watcher, ex,)
+                continue
+            if taken_over:
+                logger.info("Took over %s expired claims of watcher %s", taken_over, watcher,)
+        self._claim_timer = self.scheduler.schedule(time.time() + self._claim_check_interval,
+                                                    self._take_over_claims)
+
+    def _get_claim_store(self, watcher, data):
+        """Get claim store of watcher if it has cluster configured. Store is replaced if its
+        configuration has changed"""
+        try:
+            config = parse_cluster_config(data.get('cluster'))
+        except (ValueError, TypeError, AttributeError) as ex:
+            logger.error("Watcher %s has invalid cluster configuration %s, not claiming files - %s",
+                         watcher, data.get('cluster'), ex,)
+            return
+        store = self.claim_stores.get(watcher)
+        if store and store.config == config:
+            return store
+        if store:
+            # Actions of the handler being replaced may still hold claims of store
+            store.retire()
+            del self.claim_stores[watcher]
+        if not config:
+            return
+        try:
+            store = self.claim_stores[watcher] = make_claim_store(config)
+        except (IOError, OSError, ImportError, AttributeError, ValueError) as ex:
+            logger.error("Could not make claim store of watcher %s, not claiming files - %s", watcher, ex,)
+            return
+        if not self._claim_timer:
+            self._claim_timer = self.scheduler.schedule(time.time() + self._claim_check_interval,
+                                                        self._take_over_claims)
+        return store
+
+    def _save_state(self):
+        """Advance high-water marks of watched directories and save fingerprints"""
+        try:
+            if self.catchup:
+                self.catchup.save(list(self.event_handlers), time.time() - self._catchup_slack)
+            if self.fingerprints.cache_file:
+                self.fingerprints.save()
+        except (IOError, OSError) as ex:
+            logger.error("Could not save watcher state - %s", ex,)
+
+    def _make_event_handler(self, watcher, data, previous_handler=None):
+        """Make event handler for watcher's configuration data"""
+        return EventHandler(data['filemasks'].copy(),
+                            self.thread_pool,
+                            callback_func = self.callback_func,
+                            local_tz = data['local_tz'] if 'local_tz' in data else None,
+                            scheduler = self.scheduler,
+                            journal = self.journal,
+                            watch = watcher,
+                            output_dir = self.output_dir,
+                            task_queue = self.task_queue,
+                            max_concurrency = data.get('max_concurrency'),
+                            weight = data.get('weight'),
+                            previous_handler = previous_handler,
+                            metrics = self.metrics,
+                            tracer = self.tracer,
+                            fingerprints = self.fingerprints,
+                            process_pool = self.process_pool,
+                            spawner = self.spawner,
+                            claim_store = self._get_claim_store(watcher, data)
+                            )
+
+    def _add_watch(self, watcher, data):
+        """Add inotify watch, or poller for watchers with poll backend, for watcher's directory
+        with a new event handler"""
+        watch_dir = self._check_dir(watcher)
+        if not watch_dir:
+            logger.critical("Desired directory to watch %s does not exist or is not a directory. Exiting.", (watcher,))
+            sys.exit(1)
+        recurse = data['recurse'] if 'recurse' in data else False
+        event_handler = self._make_event_handler(watcher, data)
+        if data.get('backend', BACKEND_INOTIFY) not in BACKENDS:
+            logger.error("Watcher %s has unknown backend %s, using %s", watcher, data['backend'], BACKEND_INOTIFY,)
+        if data.get('backend') == BACKEND_POLL:
+            self._add_poller(watcher, watch_dir, data, event_handler,
+                             self._make_watch_tree(watcher, watch_dir, data) if recurse else None)
+        elif recurse:
+            tree = self._make_watch_tree(watcher, watch_dir, data)
+            self.watch_descriptors[watcher] = self._watch_tree(tree, event_handler)
+            self.watch_trees[watcher] = tree
+            if self._scan_timer is None:
+                self._scan_timer = self.scheduler.schedule(time.time() + self._scan_interval,
+                                                           self._scan_unwatched)
+        else:
+            self.watch_descriptors[watcher] = self.watch_manager.add_watch(watch_dir, _MASKS, proc_fun = event_handler,
+                                                                           rec = False, auto_add = True)
+        logger.info("Started watching directory %s with filemasks and actions %s, recurse %s..",
+                    watch_dir, data['filemasks'], recurse,)
+        self.event_handlers[watcher] = event_handler
+
+    def _add_poller(self, watcher, watch_dir, data, event_handler, tree=None):
+        """Poll watcher's directory instead of watching it with inotify. Invalid poll settings are
+        replaced by defaults"""
+        try:
+            config = parse_poll_config(data.get('poll'))
+        except (ValueError, TypeError, AttributeError) as ex:
+            logger.error("Watcher %s has invalid poll configuration %s, using defaults - %s",
+                         watcher, data.get('poll'), ex,)
+            config = parse_poll_config(None)
+        poller = Poller(watch_dir, event_handler, config, tree)
+        poller.start()
+        self.pollers[watcher] = poller
+        self.watch_descriptors[watcher] = {}
+        if tree:
+            self.watch_trees[watcher] = tree
+
+    def _make_watch_tree(self, watcher, watch_dir, data):
+        """Make directory tree of recursive watcher. Invalid exclusion settings are ignored"""
+        try:
+            return WatchTree(watch_dir, data.get('exclude_dirs'), data.get('max_depth'), self._watch_budget)
+        except ValueError as ex:
+            logger.error("Watcher %s has invalid directory exclusions, watching all sub-directories - %s",
+                         watcher, ex,)
+            return WatchTree(watch_dir, budget_func = self._watch_budget)
+
+    def _watch_budget(self):
+        """True while another inotify watch fits in the watch budget"""
+        return not self.max_watches or len(self.watch_manager.watches) < self.max_watches
+
+    def _watch_tree(self, tree, event_handler):
+        """Add inotify watches for directories of tree. Directories that do not fit in the
+        watch budget, or could not be watched, are left to scanning
+
+        :rtype: dict
+        :returns: Watch descriptors by directory path"""
+        wds = {}
+        for dirpath in tree.walk():
+            wd = self.watch_manager.add_watch(dirpath, _MASKS, proc_fun = event_handler, rec = False,
+                                              auto_add = True, exclude_filter = tree.exclude_filter
+                                              ).get(dirpath) if self._watch_budget() else None
+            if wd is None or wd < 0:
+                tree.add_unwatched(dirpath)
+                continue
+            wds[dirpath] = wd
+        if tree.unwatched:
+            logger.warning("Watching %s directories of %s, %s directory trees are scanned every %s seconds",
+                           len(wds), tree.root, len(tree.unwatched), self._scan_interval,)
+        return wds
+
+    def _scan_unwatched(self):
+        """Periodically handle files of directories left out of the watch budget modified since
+        their last scan. Files modified within the catch-up slack are left to the next scan
+        so that files still being written are not handled"""
+        if not self.watch_manager or not self.watch_trees:
+            self._scan_timer = None
+            return
+        until = time.time() - self._catchup_slack
+        for watcher, tree in list(self.watch_trees.items()):
+            event_handler = self.event_handlers.get(watcher)
+            if event_handler is None or not tree.unwatched or until <= tree.scanned_until:
+                continue
+            files = scan_new_files(tree.unwatched_dirs(), tree.scanned_until, until, recurse = True,
+                                   exclude = tree.excluded)
+            tree.scanned_until = until
+            for dirpath, name, _ in files:
+                event_handler.handle_event(pyinotify.Event({'wd' : -1, 'mask' : pyinotify.IN_CLOSE_WRITE,
+                                                            'cookie' : 0, 'path' : dirpath, 'name' : name,
+                                                            'dir' : False}))
+        self._scan_timer = self.scheduler.schedule(time.time() + self._scan_interval, self._scan_unwatched)
+
+    def _handler_watches(self, event_handler):
+        """Watches, including automatically added sub-directory watches, that have event_handler
+        as processing function"""
+        return [watch_ for watch_ in self.watch_manager.watches.values() if watch_.proc_fun is event_handler]
+
+    def _remove_watch(self, watcher):
+        """Remove all inotify watches of watcher. Its already queued actions are still run"""
+        event_handler = self.event_handlers.pop(watcher)
+        del self.watch_descriptors[watcher]
+        self.watch_trees.pop(watcher, None)
+        if watcher in self.pollers:
+            self.pollers.pop(watcher).close()
+        self.watch_manager.rm_watch([watch_.wd for watch_ in self._handler_watches(event_handler)], quiet = True)
+        logger.info("Stopped watching directory %s", watcher,)
+
+    def _replace_event_handler(self, watcher, data):
+        """Swap event handler of watcher's existing inotify watches for one made from new
+        configuration data. Events already in flight are handled by the previous handler"""
+        previous_handler = self.event_handlers[watcher]
+        event_handler = self._make_event_handler(watcher, data, previous_handler = previous_handler)
+        for watch_ in self._handler_watches(previous_handler):
+            watch_.proc_fun = event_handler
+        if watcher in self.pollers:
+            self.pollers[watcher].event_handler = event_handler
+        self.event_handlers[watcher] = event_handler
+        logger.info("Updated filemasks and actions of directory %s to %s", watcher, data['filemasks'],)
+
+    def _start_notifier(self):
+        """Start watch manager and notifier, reading events either from asyncio event loop
+        or from an asyncore loop thread"""
+        self.watch_manager = pyinotify.WatchManager()
+        if self.loop:
+            self.notifier = TimedAsyncioNotifier(self.watch_manager, self.loop,
+                                                 default_proc_fun = _DefaultProcessEvent(self.handle_overflow))
+        else:
+            self._channel_map = {}
+            self.notifier = TimedAsyncNotifier(self.watch_manager, _DefaultProcessEvent(self.handle_overflow),
+                                               channel_map = self._channel_map)
+            self.asyncore_thread = threading.Thread(target = self._asyncore_target_thread,
+                                                    args = (self._channel_map,))
+            self.asyncore_thread.daemon = True
+            self.asyncore_thread.start()
+        if self.tracer:
+            self.tracer.notifier = self.notifier
+
+    def replay_journal(self):
+        """Queue or schedule actions left pending in journal by a previous run"""
+        entries = self.journal.pending()
+        if not entries:
+            return
+        logger.info("Replaying %s pending actions from journal %s", len(entries), self.journal.journal_file,)
+        filemasks = dict(((watch, filemask.pattern), (event_handler, filemask))
+                         for watch, event_handler in self.event_handlers.items()
+                         for filemask in event_handler.filemask_actions)
+        for entry in entries:
+            if not (entry.watch, entry.filemask) in filemasks:
+                logger.warning("Watcher %s with filemask %s is no longer configured, dropping pending actions for %s",
+                               entry.watch, entry.filemask, os.path.join(entry.path, entry.name),)
+                self.journal.complete(entry.id)
+                continue
+            event_handler, filemask = filemasks[(entry.watch, entry.filemask)]
+            event = pyinotify.Event({'wd' : -1, 'mask' : entry.mask, 'cookie' : 0,
+                                     'path' : entry.path, 'name' : entry.name, 'dir' : False})
+            if event_handler.action_graphs.get(filemask):
+                # Progress through graphs is not journaled, all of their actions are run again
+                event_handler.run_graph(event_handler.action_graphs[filemask], event, entry.id)
+                continue
+            actions = event_handler.action_plans[filemask]
+            scheduled = entry.fire_time is not None
+            if scheduled and entry.fire_time > time.time():
+                self.scheduler.schedule(entry.fire_time, event_handler.queue_actions, event, actions,
+                                        entry.id, entry.action_index, scheduled)
+            else:
+                event_handler.queue_actions(event, actions, entry.id, entry.action_index, scheduled)
 
     def update_watchers(self, watch_data=None):
         """
@@ -362,11 +1532,11 @@ class Watcher(object):
         Watch data is re-read from cfg file if not provided
         """
         if not watch_data:
-            watch_data = read_cfg(open(CFG_FILE, 'r'))
-        if not watch_data:
-            logger.error("Could not read configuration file or invalid configuration in file")
-            return
-        if not self.check_watch_data(watch_data):
+            watch_data = load_cfg(CFG_FILE, self.config_cache_file)
+            if not watch_data:
+                logger.error("Could not read configuration file or invalid configuration in file")
+                return
+        elif not self.check_watch_data(watch_data):
             logger.error("Invalid configuration found, cannot continue with watcher reload")
             return
         for watcher in watch_data:
@@ -374,17 +1544,46 @@ class Watcher(object):
             if not watch_dir:
                 logger.critical("Desired directory to watch %s does not exist or is not a directory, cannot continue with watcher reload.",
                                 (watcher,))
-        self.cleanup()
-        self.start_watchers(watch_data)
+                return
+        [self._check_timezone_info(watch_data[watch]) for watch in watch_data]
+        if not self.watch_manager:
+            self.start_watchers(watch_data)
+        else:
+            self._reload_watchers(watch_data)
         self.watch_data = watch_data
         logger.info("Watchers finished reloading..")
 
-    def _check_timezone_info(self, watch_data):
+    def _reload_watchers(self, watch_data):
+        """Apply difference between current and new watch data to running watchers.
+
+        Watches of removed directories are removed and new directories watched. Directories with
+        changed configuration get a new event handler on their existing inotify watches, unless
+        their recurse, exclude_dirs or max_depth settings changed, so unchanged directory trees
+        are not walked again.
+        Unchanged watchers are left as they are"""
+        for watcher in [watcher for watcher in self.event_handlers if watcher not in watch_data]:
+            self._remove_watch(watcher)
+        for watcher in watch_data:
+            if watcher not in self.event_handlers:
+                self._add_watch(watcher, watch_data[watcher])
+                continue
+            data, previous_data = watch_data[watcher], self.watch_data.get(watcher, {})
+            if data == previous_data:
+                continue
+            if [field for field in self._tree_fields if data.get(field) != previous_data.get(field)]:
+                self._remove_watch(watcher)
+                self._add_watch(watcher, data)
+                continue
+            self._replace_event_handler(watcher, data)
+
+    @classmethod
+    def _check_timezone_info(cls, watch_data):
         """Check if we have timezone configuration in watch data, parse if needed"""
         if not 'file_tz' in watch_data and not 'local_tz' in watch_data:
             return
         for tz_key in ['file_tz', 'local_tz']:
-            if tz_key in watch_data:
+            # Timezones of configuration loaded from cache are already parsed
+            if tz_key in watch_data and isinstance(watch_data[tz_key], basestring):
                 try:
                     watch_data[tz_key] = pytz.timezone(watch_data[tz_key])
                 except pytz.UnknownTimeZoneError:
@@ -404,10 +1603,80 @@ class Watcher(object):
     def cleanup(self):
         """Stop watchers, shutdown notifiers"""
         logger.info("Got cleanup signal, shutting down notifiers..")
-        [wm.rm_watch(wm.watches.keys()) for wm in self.watch_managers]
-        [notifier.stop() for notifier in self.notifiers]
-        self.watch_managers, self.notifiers = [], []
-        del self.asyncore_thread
+        if self.event_handlers:
+            self._save_state()
+        self._stop_watchers()
+        # Deferred actions and timers are not run while watchers are stopped
+        self.scheduler.stop()
+        self.process_pool.close()
+        if self.spill is not None:
+            if len(self.spill):
+                logger.warning("Dropping %s spilled tasks on shutdown", len(self.spill),)
+            self.spill.close()
+            if self._spill_tmp_dir:
+                os.rmdir(self._spill_tmp_dir)
+        for store in self.claim_stores.values():
+            store.close()
+        if self.spawner:
+            self.spawner.close()
+        if self.journal:
+            self.journal.flush()
+            self.journal.close()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._set_run_result)
+
+    def _stop_watchers(self):
+        """Remove all watches and stop notifier"""
+        if self.watch_manager:
+            self.watch_manager.rm_watch(self.watch_manager.watches.keys())
+            if not self.loop:
+                # Ends asyncore loop thread
+                self.notifier.del_channel()
+            self.notifier.stop()
+        for poller in self.pollers.values():
+            poller.close()
+        self.watch_manager, self.notifier = None, None
+        self.event_handlers, self.watch_descriptors = {}, {}
+        self.watch_trees, self.pollers = {}, {}
+        self.asyncore_thread, self._channel_map = None, None
+
+def load_cfg(cfg_file=CFG_FILE, cache_file=None):
+    """Read configuration file, validate it and parse its timezones.
+
+    With cache_file, validated configuration is cached keyed by the hash of the
+    configuration file and loaded from the cache while the file is unchanged,
+    see :class:`cronify.common.ConfigCache`
+
+    :param cfg_file: Path to YAML configuration file
+    :type cfg_file: str
+    :param cache_file: Optional path to configuration cache file
+    :type cache_file: str
+    :rtype: dict
+    :returns: Watch data, or None if configuration could not be read or is invalid"""
+    try:
+        with open(cfg_file, 'rb') as fileh:
+            content = fileh.read()
+    except IOError as ex:
+        logger.error("Could not read configuration file %s - %s", cfg_file, ex,)
+        return
+    cache = ConfigCache(cache_file) if cache_file else None
+    key = cfg_key(content)
+    watch_data = cache.get(key) if cache else None
+    if watch_data is not None:
+        logger.debug("Loaded configuration of %s from cache %s", cfg_file, cache_file,)
+        return watch_data
+    try:
+        watch_data = read_cfg(io.BytesIO(content))
+    except yaml.YAMLError as ex:
+        logger.error("Could not parse configuration file %s - %s", cfg_file, ex,)
+        return
+    if not Watcher.check_watch_data(watch_data):
+        return
+    for watch in watch_data:
+        Watcher._check_timezone_info(watch_data[watch])
+    if cache:
+        cache.put(key, watch_data)
+    return watch_data
 
 def _callback_func(event):
     """Test function for callback_func optional parameter of Watcher class"""
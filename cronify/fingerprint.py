@@ -0,0 +1,132 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Fingerprints of files whose actions have run successfully, used to skip
+actions for files that have not changed since"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 86400
+DEFAULT_MAX_ENTRIES = 100000
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+DedupConfig = namedtuple('DedupConfig', ['filemask', 'content_hash', 'ttl'])
+"""Deduplication settings of a filemask. ttl is in seconds"""
+
+
+def parse_dedup_config(filemask, data):
+    """Parse filemask's dedup configuration
+
+    :param data: Dedup configuration, either True for defaults or a dictionary with \
+    optional content_hash and ttl keys
+    :rtype: :class:`DedupConfig`"""
+    if not data:
+        return
+    if data is True:
+        data = {}
+    return DedupConfig(filemask, bool(data.get('content_hash', False)), float(data.get('ttl', DEFAULT_TTL)))
+
+
+def file_fingerprint(pathname, content_hash=False):
+    """Fingerprint of file - (device, inode, size, modified time), or (size, SHA-1 digest
+    of contents) with content_hash. A content fingerprint is unchanged when a file is
+    rewritten with the same contents
+
+    :raises: :mod:`OSError` or :mod:`IOError` if file cannot be read
+    :rtype: tuple"""
+    if not content_hash:
+        st = os.stat(pathname)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    digest, size = hashlib.sha1(), 0
+    with open(pathname, 'rb') as fileh:
+        while True:
+            data = fileh.read(_HASH_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            size += len(data)
+    return (size, digest.hexdigest())
+
+
+class FingerprintCache(object):
+
+    """Bounded LRU cache of fingerprints with per entry expiry, optionally persisted to a JSON file"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, cache_file=None):
+        """
+        :param max_entries: Maximum number of fingerprints kept. Least recently used are evicted first
+        :type max_entries: int
+        :param cache_file: Optional file to load fingerprints from and save them to
+        :type cache_file: str
+        """
+        self.max_entries, self.cache_file = max_entries, cache_file
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_file:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            expiry = self._entries.pop(key, None)
+            if expiry is None or expiry < time.time():
+                return False
+            self._entries[key] = expiry
+            return True
+
+    def add(self, key, ttl=DEFAULT_TTL):
+        """Add fingerprint key, expiring after ttl seconds"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.time() + ttl
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """Write unexpired fingerprints to cache file"""
+        now = time.time()
+        with self._lock:
+            entries = [[list(key), expiry] for key, expiry in self._entries.items() if expiry >= now]
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as fileh:
+            json.dump(entries, fileh)
+        os.rename(tmp_file, self.cache_file)
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as fileh:
+                entries = json.load(fileh)
+        except IOError:
+            return
+        except ValueError:
+            logger.error("Fingerprint cache file %s is corrupt, starting with empty cache", self.cache_file,)
+            return
+        now = time.time()
+        for key, expiry in entries[-self.max_entries:]:
+            if expiry >= now:
+                self._entries[tuple(tuple(part) if isinstance(part, list) else part for part in key)] = expiry
+        logger.debug("Loaded %s fingerprints from %s", len(self._entries), self.cache_file,)
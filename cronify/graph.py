@@ -0,0 +1,156 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Dependency graphs of a filemask's actions.
+
+When any of a filemask's actions has ``depends_on``, its actions form a graph
+instead of a sequence. Actions run as soon as all actions they depend on are
+done, so independent actions run in parallel. What happens to the rest of the
+graph when an action fails depends on the filemask's ``on_failure`` setting:
+
+* ``skip`` - actions depending on the failed action, directly or not, are skipped. Default
+* ``continue`` - actions depending on the failed action run regardless
+* ``abort`` - no more actions are started"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+ON_FAILURE_SKIP, ON_FAILURE_CONTINUE, ON_FAILURE_ABORT = 'skip', 'continue', 'abort'
+ON_FAILURE = (ON_FAILURE_SKIP, ON_FAILURE_CONTINUE, ON_FAILURE_ABORT)
+PENDING, RUNNING, SUCCEEDED, FAILED, SKIPPED = 'pending', 'running', 'succeeded', 'failed', 'skipped'
+
+
+class ActionGraph(object):
+
+    """Dependencies between a filemask's action plans"""
+
+    def __init__(self, plans, depends_on, on_failure=ON_FAILURE_SKIP):
+        """
+        :param plans: Filemask's action plans
+        :type plans: tuple of :class:`cronify.cronify.ActionPlan`
+        :param depends_on: Names of actions each plan depends on, in the same order as plans
+        :type depends_on: list
+        :param on_failure: One of :data:`ON_FAILURE`
+        :raises: :mod:`ValueError` on duplicate or unknown action names, dependency \
+        cycles or unknown on_failure setting
+        """
+        if on_failure not in ON_FAILURE:
+            raise ValueError("on_failure must be one of %s, got %s" % (', '.join(ON_FAILURE), on_failure,))
+        indexes = {}
+        for i, plan in enumerate(plans):
+            if plan.name in indexes:
+                raise ValueError("Action name %s is not unique" % (plan.name,))
+            indexes[plan.name] = i
+        prerequisites = []
+        for plan, names in zip(plans, depends_on):
+            for name in names:
+                if name not in indexes:
+                    raise ValueError("Action %s depends on unknown action %s" % (plan.name, name,))
+            prerequisites.append(tuple(sorted(set(indexes[name] for name in names))))
+        self.plans, self.on_failure = plans, on_failure
+        self.prerequisites = tuple(prerequisites)
+        self.dependents = tuple(tuple(j for j in range(len(plans)) if i in prerequisites[j])
+                                for i in range(len(plans)))
+        self.roots = tuple(i for i in range(len(plans)) if not prerequisites[i])
+        self._check_cycles()
+
+    def _check_cycles(self):
+        waiting = [len(prerequisites) for prerequisites in self.prerequisites]
+        ready, visited = list(self.roots), 0
+        while ready:
+            i = ready.pop()
+            visited += 1
+            for j in self.dependents[i]:
+                waiting[j] -= 1
+                if not waiting[j]:
+                    ready.append(j)
+        if visited < len(self.plans):
+            raise ValueError("Action dependencies have a cycle between %s" % (
+                ', '.join(plan.name for i, plan in enumerate(self.plans) if waiting[i]),))
+
+
+class GraphRun(object):
+
+    """Progress of one event's actions through an :class:`ActionGraph`. Thread safe"""
+
+    def __init__(self, graph, event, journal_id=None, trace=None, claim=None):
+        """
+        :param graph: Graph of actions to run
+        :type graph: :class:`ActionGraph`
+        :param event: Event actions are run for
+        :param journal_id: Journal entry id of actions, if journaled
+        :param trace: Lifecycle trace of actions, if event is traced
+        :param claim: Claim of event's file, if claimed
+        """
+        self.graph, self.event, self.journal_id, self.trace = graph, event, journal_id, trace
+        self.claim = claim
+        # Fingerprint of file to record once all actions have succeeded, for filemasks with dedup
+        self.fingerprint = None
+        self.states = [PENDING] * len(graph.plans)
+        self._waiting = [len(prerequisites) for prerequisites in graph.prerequisites]
+        self._remaining = len(graph.plans)
+        self._lock = threading.Lock()
+
+    @property
+    def failed(self):
+        """True if any action has failed"""
+        return FAILED in self.states
+
+    def start(self):
+        """Start run
+
+        :rtype: list
+        :returns: Indexes of actions to run"""
+        with self._lock:
+            for i in self.graph.roots:
+                self.states[i] = RUNNING
+            return list(self.graph.roots)
+
+    def complete(self, index, failed=False):
+        """Record action at index is done
+
+        :rtype: tuple
+        :returns: Indexes of actions to run now, True if all actions are done"""
+        ready = []
+        with self._lock:
+            if failed and self.graph.on_failure == ON_FAILURE_ABORT:
+                for i, state in enumerate(self.states):
+                    if state == PENDING:
+                        logger.info("Skipping action %s for %s as action %s failed",
+                                    self.graph.plans[i].name, self.event.pathname, self.graph.plans[index].name,)
+                        self.states[i] = SKIPPED
+                        self._remaining -= 1
+            self._done(index, FAILED if failed else SUCCEEDED, ready)
+            return ready, not self._remaining
+
+    def _done(self, index, state, ready):
+        self.states[index] = state
+        self._remaining -= 1
+        for i in self.graph.dependents[index]:
+            self._waiting[i] -= 1
+            if self._waiting[i] or self.states[i] != PENDING:
+                continue
+            if self.graph.on_failure == ON_FAILURE_SKIP and \
+                    [j for j in self.graph.prerequisites[i] if self.states[j] != SUCCEEDED]:
+                logger.info("Skipping action %s for %s as an action it depends on did not succeed",
+                            self.graph.plans[i].name, self.event.pathname,)
+                self._done(i, SKIPPED, ready)
+            else:
+                self.states[i] = RUNNING
+                ready.append(i)
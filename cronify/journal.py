@@ -0,0 +1,208 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Write-ahead journal of queued and scheduled actions so that they can be
+replayed after a restart"""
+
+import sqlite3
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    watch TEXT NOT NULL,
+    filemask TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mask INTEGER NOT NULL,
+    action_index INTEGER NOT NULL,
+    fire_time REAL)"""
+
+
+class JournalEntry(object):
+
+    """Pending action entry read back from journal"""
+
+    __slots__ = ('id', 'watch', 'filemask', 'path', 'name', 'mask', 'action_index', 'fire_time')
+
+    def __init__(self, id, watch, filemask, path, name, mask, action_index, fire_time):
+        self.id, self.watch, self.filemask = id, watch, filemask
+        self.path, self.name, self.mask = path, name, mask
+        self.action_index, self.fire_time = action_index, fire_time
+
+
+class Journal(object):
+
+    """SQLite journal in WAL mode with group commit.
+
+    Changes are buffered in memory and written by a single writer thread in one
+    transaction, and so one fsync, per batch. An entry that is added and completed
+    within the same batch never reaches the disk."""
+
+    def __init__(self, journal_file, flush_interval=0.05, max_batch_size=5000):
+        """
+        :param journal_file: Path to SQLite database file
+        :type journal_file: str
+        :param flush_interval: Maximum seconds changes are buffered before being committed
+        :type flush_interval: float
+        :param max_batch_size: Number of buffered changes that triggers a commit \
+        before flush_interval has passed
+        :type max_batch_size: int
+        """
+        self.journal_file = journal_file
+        self.flush_interval, self.max_batch_size = flush_interval, max_batch_size
+        self._connect()
+        max_id = self._conn.execute("SELECT MAX(id) FROM actions").fetchone()[0] or 0
+        self._start_id = max_id + 1
+        self._ids = itertools.count(self._start_id)
+        self._inserts, self._updates, self._deletes = {}, {}, set()
+        self._cond = threading.Condition()
+        self._flushed = threading.Condition(self._cond)
+        self._batch, self._committed_batch = 0, 0
+        self._stopped = False
+        self._start_thread()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.journal_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._writer_target_thread, name='Journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pending(self):
+        """Entries left pending by a previous run
+
+        :rtype: list
+        :returns: List of :class:`JournalEntry`"""
+        rows = self._conn.execute(
+            "SELECT id, watch, filemask, path, name, mask, action_index, fire_time "
+            "FROM actions WHERE id < ? ORDER BY id", (self._start_id,)).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def add(self, watch, filemask, event, action_index=0, fire_time=None):
+        """Record queued actions for event
+
+        :param watch: Watched directory as configured
+        :param filemask: Pattern of filemask event matched
+        :param event: Event that triggered actions
+        :type event: :mod:`pyinotify.Event`
+        :param action_index: Index of first action to run
+        :param fire_time: Time in seconds since the epoch actions are scheduled for, if any
+        :rtype: int
+        :returns: Journal entry id"""
+        with self._cond:
+            entry_id = next(self._ids)
+            self._inserts[entry_id] = [entry_id, watch, filemask, event.path, event.name, event.mask,
+                                       action_index, fire_time]
+            self._changed()
+        return entry_id
+
+    def defer(self, entry_id, action_index, fire_time):
+        """Record that actions from action_index onwards are scheduled for fire_time"""
+        with self._cond:
+            if entry_id in self._inserts:
+                self._inserts[entry_id][6:] = [action_index, fire_time]
+            else:
+                self._updates[entry_id] = (action_index, fire_time, entry_id)
+            self._changed()
+
+    def complete(self, entry_id):
+        """Remove entry once its actions have all been run"""
+        with self._cond:
+            self._updates.pop(entry_id, None)
+            if self._inserts.pop(entry_id, None) is None:
+                self._deletes.add(entry_id)
+            self._changed()
+
+    def flush(self):
+        """Block until all changes made so far are committed"""
+        with self._cond:
+            batch = self._batch + 1 if self._has_changes() else self._batch
+            self._cond.notify()
+            while self._committed_batch < batch and not self._stopped:
+                self._flushed.wait(self.flush_interval)
+
+    def close(self):
+        """Commit outstanding changes, stop writer thread and close database"""
+        self.flush()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._conn.close()
+
+    def open(self):
+        """Open journal again after :meth:`close`. Changes made while closed are committed
+        with the first batch, and entries added before closing are not :meth:`pending`"""
+        with self._cond:
+            if not self._stopped:
+                return
+            self._connect()
+            self._stopped = False
+            self._start_thread()
+
+    def _has_changes(self):
+        return self._inserts or self._updates or self._deletes
+
+    def _changed(self):
+        """Wake writer thread when first change of a batch is made or batch is full"""
+        changes = len(self._inserts) + len(self._updates) + len(self._deletes)
+        if changes == 1 or changes >= self.max_batch_size:
+            self._cond.notify()
+
+    def _writer_target_thread(self):
+        """Target function for writer thread. Commits buffered changes in batches"""
+        while True:
+            with self._cond:
+                if not self._has_changes() and not self._stopped:
+                    self._cond.wait()
+                # Group commit - wait for more changes to share this batch's fsync
+                if self._has_changes() and not self._stopped and \
+                        len(self._inserts) + len(self._updates) + len(self._deletes) < self.max_batch_size:
+                    self._cond.wait(self.flush_interval)
+                inserts, updates, deletes = self._inserts, self._updates, self._deletes
+                self._inserts, self._updates, self._deletes = {}, {}, set()
+                self._batch += 1
+                batch, stopped = self._batch, self._stopped
+            try:
+                self._commit(inserts, updates, deletes)
+            except sqlite3.Error as ex:
+                logger.error("Could not write to journal %s - %s", self.journal_file, ex,)
+            with self._cond:
+                self._committed_batch = batch
+                self._flushed.notify_all()
+            if stopped:
+                return
+
+    def _commit(self, inserts, updates, deletes):
+        if not (inserts or updates or deletes):
+            return
+        with self._conn:
+            self._conn.executemany("INSERT INTO actions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   sorted(inserts.values()))
+            self._conn.executemany("UPDATE actions SET action_index = ?, fire_time = ? WHERE id = ?",
+                                   updates.values())
+            self._conn.executemany("DELETE FROM actions WHERE id = ?",
+                                   [(entry_id,) for entry_id in deletes])
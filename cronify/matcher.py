@@ -0,0 +1,226 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Filemask dispatch index. Finds every filemask matching a filename without
+scanning each filemask regex in turn"""
+
+import re
+import fnmatch
+import logging
+
+logger = logging.getLogger(__name__)
+
+_GLOB_CHARS = '*?['
+_REGEX_CHARS = '.^$*+?{}[]\\|()'
+# Inline global flags, eg '(?ms)', as appended by fnmatch.translate on python 2
+_GLOBAL_FLAGS_RE = re.compile(r'^\(\?[aiLmsux]+\)|\(\?[aiLmsux]+\)$')
+# Named groups, group references and numbered backreferences cannot be
+# safely embedded in a combined regex
+_UNCOMBINABLE_RE = re.compile(r'\(\?P|\\[1-9]')
+# Python 2's sre only supports up to 100 groups per regex
+_MAX_GROUPS = 90
+_TERMINAL = None
+
+
+class _Trie(object):
+
+    """Character trie returning all keys stored on the path of a string"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, string, key):
+        """Store key at string's node"""
+        node = self.root
+        for char in string:
+            node = node.setdefault(char, {})
+        node.setdefault(_TERMINAL, []).append(key)
+
+    def find(self, string):
+        """Return keys of all stored strings that are a prefix of string
+
+        :rtype: list"""
+        node, keys = self.root, []
+        if _TERMINAL in node:
+            keys.extend(node[_TERMINAL])
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            if _TERMINAL in node:
+                keys.extend(node[_TERMINAL])
+        return keys
+
+
+class FilemaskIndex(object):
+
+    """Index of filemasks for single pass matching of filenames.
+
+    Filemasks are classified when added:
+
+    * Literal filenames are looked up in a hash table
+    * Globs of the form ``prefix*`` and ``*suffix`` are looked up in prefix and suffix tries
+    * Other globs and regexes starting with a literal prefix are looked up in a prefix trie
+      and only the candidates found are matched against their regex
+    * Everything else is matched by combined regexes with one named group per filemask,
+      each group being an optional lookahead so that all matching filemasks are found
+      by a single regex match
+
+    Keys returned by :meth:`match` are whatever objects were given to :meth:`add`,
+    in the order they were added.
+    """
+
+    def __init__(self, filemasks=None):
+        """
+        :param filemasks: Optional list of (filemask, compiled regex, key) tuples to add
+        :type filemasks: list
+        """
+        self._order = {}
+        self._literals = {}
+        self._prefixes = _Trie()
+        self._suffixes = _Trie()
+        self._candidates = _Trie()
+        self._regexes = []
+        self._combined = []
+        self._uncombined = []
+        for filemask, regex, key in filemasks or []:
+            self.add(filemask, regex, key, rebuild=False)
+        self._build_combined()
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, filemask, regex, key, rebuild=True):
+        """Add filemask to index
+
+        :param filemask: Filemask as given in configuration
+        :type filemask: str
+        :param regex: Compiled regex for filemask, either :func:`fnmatch.translate` of a glob \
+        or a regular expression
+        :type regex: :mod:`re` compiled pattern
+        :param key: Key to return when filemask matches
+        :param rebuild: Rebuild combined regexes. Set to False when adding many filemasks \
+        and call :meth:`rebuild` after
+        :type rebuild: bool
+        """
+        self._order[key] = len(self._order)
+        is_glob = regex.pattern == fnmatch.translate(filemask)
+        kind = self._classify_glob(filemask) if is_glob else None
+        if kind == 'literal':
+            self._literals.setdefault(filemask, []).append(key)
+            return
+        elif kind == 'prefix':
+            self._prefixes.add(filemask[:-1], key)
+            return
+        elif kind == 'suffix':
+            self._suffixes.add(filemask[:0:-1], key)
+            return
+        if is_glob:
+            prefix = self._literal_prefix(filemask, _GLOB_CHARS)
+        else:
+            prefix = self._literal_prefix(regex.pattern, _REGEX_CHARS)
+        if prefix:
+            self._candidates.add(prefix, (regex, key))
+            return
+        self._regexes.append((regex, key))
+        if rebuild:
+            self._build_combined()
+
+    def rebuild(self):
+        """Rebuild combined regexes after adding filemasks with rebuild=False"""
+        self._build_combined()
+
+    def _classify_glob(self, filemask):
+        """Classify a glob filemask as literal, prefix, suffix or None for any other glob"""
+        if not [char for char in filemask if char in _GLOB_CHARS]:
+            return 'literal'
+        if filemask.count('*') != 1 or '?' in filemask or '[' in filemask:
+            return
+        if filemask.endswith('*'):
+            return 'prefix'
+        if filemask.startswith('*'):
+            return 'suffix'
+
+    def _literal_prefix(self, pattern, special_chars):
+        """Return the literal characters any match of glob or regex pattern must start with"""
+        if special_chars is _REGEX_CHARS and '|' in pattern:
+            return ''
+        for i, char in enumerate(pattern):
+            if char in special_chars:
+                # A quantifier may make the preceding character optional
+                if special_chars is _REGEX_CHARS and char in '*?{':
+                    return pattern[:max(i - 1, 0)]
+                return pattern[:i]
+        return pattern
+
+    def _build_combined(self):
+        """Group non-glob regexes by flags and combine each group into as few regexes as possible"""
+        self._combined, self._uncombined = [], []
+        by_flags = {}
+        for regex, key in self._regexes:
+            if _UNCOMBINABLE_RE.search(regex.pattern):
+                self._uncombined.append((regex, key))
+                continue
+            by_flags.setdefault(regex.flags, []).append((regex, key))
+        for flags, regexes in by_flags.items():
+            chunk, groups = [], 0
+            for regex, key in regexes:
+                if chunk and groups + regex.groups + 1 > _MAX_GROUPS:
+                    self._combine(chunk, flags)
+                    chunk, groups = [], 0
+                chunk.append((regex, key))
+                groups += regex.groups + 1
+            if chunk:
+                self._combine(chunk, flags)
+
+    def _combine(self, regexes, flags):
+        """Compile regexes into a single regex of optional lookaheads, one named group each"""
+        parts = []
+        for i, (regex, key) in enumerate(regexes):
+            parts.append('(?:(?=(?P<m%d>%s))|)' % (i, _GLOBAL_FLAGS_RE.sub('', regex.pattern),))
+        try:
+            combined = re.compile(''.join(parts), flags)
+        except (re.error, AssertionError, OverflowError):
+            logger.debug("Could not combine filemask regexes, matching them individually")
+            self._uncombined.extend(regexes)
+            return
+        # Positions of each filemask's named group in match.groups()
+        group_keys = [(combined.groupindex['m%d' % (i,)] - 1, key)
+                      for i, (regex, key) in enumerate(regexes)]
+        self._combined.append((combined, group_keys))
+
+    def match(self, filename):
+        """Find all filemasks matching filename
+
+        :param filename: Filename to match
+        :type filename: str
+        :rtype: list
+        :returns: Keys of all matching filemasks
+        """
+        keys = []
+        if filename in self._literals:
+            keys.extend(self._literals[filename])
+        keys.extend(self._prefixes.find(filename))
+        keys.extend(self._suffixes.find(filename[::-1]))
+        keys.extend(key for regex, key in self._candidates.find(filename) if regex.match(filename))
+        for combined, group_keys in self._combined:
+            groups = combined.match(filename).groups()
+            keys.extend(key for i, key in group_keys if groups[i] is not None)
+        keys.extend(key for regex, key in self._uncombined if regex.match(filename))
+        if len(keys) > 1:
+            keys.sort(key=self._order.get)
+        return keys
@@ -0,0 +1,268 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Metrics registry with counters, histograms and gauges, rendered in Prometheus
+text exposition format"""
+
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+MATCH_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, float('inf'))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('\n', r'\n')
+                                          .replace('"', r'\"'))
+                              for name, value in labels),)
+
+
+class _CounterValue(object):
+
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramValue(object):
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum, self.count = 0.0, 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _Metric(object):
+
+    """Metric with optional labels. Values per label combination are made on first use
+    by :meth:`labels`, which callers on hot paths should keep a reference to"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        """Get value of metric for label values, eg ``metric.labels('/tmp/testdir').inc()``"""
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("Metric %s expects labels %s" % (self.name, self.labelnames,))
+        labelvalues = tuple('' if value is None else str(value) for value in labelvalues)
+        value = self._values.get(labelvalues)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(labelvalues, self._make_value())
+        return value
+
+    def _make_value(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Samples of metric as (name, labels, value) tuples, where labels is a tuple of (name, value) pairs"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+
+    """Monotonically increasing counter"""
+
+    type = 'counter'
+
+    def _make_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        """Increment counter without labels"""
+        self.labels().inc(amount)
+
+    def samples(self):
+        for labelvalues, value in sorted(self._values.items()):
+            yield self.name, tuple(zip(self.labelnames, labelvalues)), value.value
+
+
+class Histogram(_Metric):
+
+    """Histogram of observed values with cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        if self.buckets[-1] != float('inf'):
+            self.buckets += (float('inf'),)
+
+    def _make_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        """Observe value without labels"""
+        self.labels().observe(value)
+
+    def samples(self):
+        for labelvalues, value in sorted(self._values.items()):
+            labels = tuple(zip(self.labelnames, labelvalues))
+            with value._lock:
+                counts, total, count = list(value.counts), value.sum, value.count
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', labels + (('le', _format_value(bucket)),), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Gauge(_Metric):
+
+    """Gauge read from a function when metrics are collected. The function returns
+    the gauge's value, or for a gauge with labels a list of (label values, value) tuples"""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.func = func
+
+    def samples(self):
+        if not self.labelnames:
+            yield self.name, (), self.func()
+            return
+        for labelvalues, value in sorted(self.func()):
+            yield self.name, tuple(zip(self.labelnames, ('' if label is None else str(label)
+                                                         for label in labelvalues))), value
+
+
+class Metrics(object):
+
+    """Registry of cronify's metrics.
+
+    Components record to the metrics made here. Gauges of state owned by a
+    :class:`cronify.Watcher` are added with :meth:`gauge`"""
+
+    def __init__(self):
+        self._metrics = []
+        self.events = self.add(Counter(
+            'cronify_events_total', 'Events received', ('watch',)))
+        self.match_time = self.add(Histogram(
+            'cronify_filemask_match_seconds', 'Time taken to match file name against filemasks', ('watch',),
+            buckets=MATCH_BUCKETS))
+        self.queue_wait = self.add(Histogram(
+            'cronify_queue_wait_seconds', 'Time tasks waited in task queue before running', ('queue',)))
+        self.action_duration = self.add(Histogram(
+            'cronify_action_duration_seconds', 'Action run time', ('watch', 'action')))
+        self.action_exit_codes = self.add(Counter(
+            'cronify_action_exit_codes_total', 'Actions run by exit code', ('watch', 'action', 'code')))
+        self.deferred = self.add(Counter(
+            'cronify_actions_deferred_total', 'Actions deferred until their start time', ('watch',)))
+
+    def add(self, metric):
+        """Add metric to registry and return it"""
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, func, labelnames=()):
+        """Add :class:`Gauge` read from func to registry"""
+        return self.add(Gauge(name, documentation, func, labelnames))
+
+    def get(self, name):
+        """Get metric by name"""
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        raise KeyError(name)
+
+    def samples(self):
+        """All samples as (name, labels, value) tuples
+
+        :rtype: list"""
+        return [sample for metric in self._metrics for sample in metric.samples()]
+
+    def render(self):
+        """Render metrics in Prometheus text exposition format
+
+        :rtype: str"""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation,))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type,))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value),))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request from %s - %s", self.client_address[0], format % args,)
+
+
+def start_http_server(metrics, port, host='127.0.0.1'):
+    """Serve metrics in Prometheus text format on /metrics from a daemon thread
+
+    :param metrics: Metrics registry to serve
+    :type metrics: :class:`Metrics`
+    :param port: Port to listen on. Use 0 for any free port
+    :param host: Address to listen on, localhost only by default
+    :returns: HTTP server, stop with its shutdown method. Listening port is ``server.server_port``"""
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsRequestHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, name='MetricsServer')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, server.server_port,)
+    return server
@@ -0,0 +1,157 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Bounded memory capture of action output. Output is streamed in chunks to
+a logger or rotating output files while only a capped tail is kept in memory"""
+
+import os
+import re
+import errno
+import select
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8192
+TAIL_SIZE = 4096
+_unsafe_chars_rc = re.compile(r'[^\w.-]+')
+_output_files = {}
+_output_files_lock = threading.Lock()
+
+
+class RotatingOutputFile(object):
+
+    """Append only output file rotated once it reaches max_bytes, keeping backup_count
+    rotated files. Safe to write to from multiple threads"""
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.filename, self.max_bytes, self.backup_count = filename, max_bytes, backup_count
+        self._lock = threading.Lock()
+        self._fileh = open(filename, 'ab')
+
+    def write(self, data):
+        with self._lock:
+            if self.max_bytes and self._fileh.tell() + len(data) > self.max_bytes:
+                self._rotate()
+            self._fileh.write(data)
+            self._fileh.flush()
+
+    def _rotate(self):
+        self._fileh.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%d" % (self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.filename, i + 1))
+        if self.backup_count:
+            os.rename(self.filename, self.filename + '.1')
+        self._fileh = open(self.filename, 'wb')
+
+
+def output_file_name(watch, filemask, name, stream):
+    """Output file name of stream of named action of watch's filemask. Name is made from the
+    watched directory's base name, filemask and action name, with a hash of all three so that
+    names differing only in characters unsafe in file names do not share a file
+
+    :param stream: Stream name, eg 'stdout'
+    :rtype: str"""
+    parts = [part if isinstance(part, bytes) else part.encode('utf-8') for part in (watch, filemask, name)]
+    digest = hashlib.sha1(b'\0'.join(parts)).hexdigest()[:8]
+    return "%s.%s.%s" % ('.'.join(_unsafe_chars_rc.sub('_', part) for part in (
+        os.path.basename(watch.rstrip(os.path.sep)), filemask, name)), digest, stream,)
+
+
+def get_output_file(output_dir, watch, filemask, name, stream, **kwargs):
+    """Get shared rotating output file for stream of named action of watch's filemask in output_dir
+
+    :param stream: Stream name, eg 'stdout'
+    :rtype: :class:`RotatingOutputFile`"""
+    filename = os.path.join(output_dir, output_file_name(watch, filemask, name, stream))
+    with _output_files_lock:
+        if filename not in _output_files:
+            _output_files[filename] = RotatingOutputFile(filename, **kwargs)
+        return _output_files[filename]
+
+
+class OutputCapture(object):
+
+    """Capture of a single output stream of a process.
+
+    Data is passed on to an output file and/or logged in chunks of at most
+    :data:`CHUNK_SIZE` bytes as it is read. Only the last tail_size bytes are kept."""
+
+    def __init__(self, name, stream, output_file=None, log=True, tail_size=TAIL_SIZE):
+        """
+        :param name: Name of action output belongs to, used in log messages
+        :param stream: Stream name, eg 'stdout'
+        :param output_file: Optional file to write output to
+        :type output_file: :class:`RotatingOutputFile`
+        :param log: Log output chunks
+        :type log: bool
+        :param tail_size: Number of trailing output bytes to keep
+        :type tail_size: int
+        """
+        self.name, self.stream = name, stream
+        self.output_file, self.log, self.tail_size = output_file, log, tail_size
+        self.bytes = 0
+        self._tail = b''
+
+    @property
+    def tail(self):
+        """Last tail_size bytes of output"""
+        return self._tail
+
+    def feed(self, data):
+        """Pass on chunk of output data and update tail and byte count"""
+        self.bytes += len(data)
+        self._tail = (self._tail + data)[-self.tail_size:]
+        if self.output_file:
+            self.output_file.write(data)
+        if self.log:
+            logger.info("Action %s %s - %s", self.name, self.stream, data.rstrip(),)
+
+
+def stream_output(proc, captures):
+    """Read process output pipes until they are closed, passing data on to captures
+    in chunks of at most :data:`CHUNK_SIZE` bytes
+
+    :param proc: Process to read output of
+    :type proc: :mod:`subprocess.Popen`
+    :param captures: Dictionary of pipe file object -> :class:`OutputCapture`
+    :type captures: dict
+    """
+    fds = dict((pipe.fileno(), capture) for pipe, capture in captures.items())
+    poller = select.poll()
+    for fd in fds:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    while fds:
+        try:
+            ready = poller.poll()
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, _ in ready:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                poller.unregister(fd)
+                del fds[fd]
+                continue
+            fds[fd].feed(data)
+    for pipe in captures:
+        pipe.close()
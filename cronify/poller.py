@@ -0,0 +1,290 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Polling backend for directories inotify does not see changes of, eg NFS mounts
+written to by other hosts.
+
+Each polled directory has an in-memory snapshot of its files' inode, size and
+modified time. A directory whose own modified time has not changed since it was
+last listed has had no files added, removed or renamed, so only its files that
+have not settled yet are looked at. Otherwise it is listed with
+:func:`os.scandir`, which gives entries' inodes without a stat call, and only
+new or replaced files are stat'ed. All files are stat'ed every rescan_interval
+to find files rewritten in place.
+
+A new or modified file triggers an event once it is seen unchanged on two
+consecutive polls, so files still being written are not handled. Directories
+with changes are polled every min_interval seconds, and idle ones back off up
+to max_interval seconds.
+
+Files that exist when polling starts do not trigger events, as with inotify."""
+
+import os
+import stat
+import time
+import logging
+import threading
+from collections import namedtuple
+import pyinotify
+from catchup import scandir
+
+logger = logging.getLogger(__name__)
+
+BACKEND_INOTIFY, BACKEND_POLL = 'inotify', 'poll'
+BACKENDS = (BACKEND_INOTIFY, BACKEND_POLL)
+DEFAULT_MIN_INTERVAL = 1
+DEFAULT_MAX_INTERVAL = 30
+DEFAULT_RESCAN_INTERVAL = 300
+# Resolution of directory modified times that cannot be relied on
+_MTIME_RESOLUTION = 1
+
+PollConfig = namedtuple('PollConfig', ['min_interval', 'max_interval', 'rescan_interval'])
+"""Polling settings of a watch, in seconds"""
+
+
+def parse_poll_config(data):
+    """Parse watch's poll configuration
+
+    :param data: Dictionary with optional min_interval, max_interval and rescan_interval keys
+    :raises: :mod:`ValueError` on invalid intervals
+    :rtype: :class:`PollConfig`"""
+    data = data or {}
+    config = PollConfig(float(data.get('min_interval', DEFAULT_MIN_INTERVAL)),
+                        float(data.get('max_interval', DEFAULT_MAX_INTERVAL)),
+                        float(data.get('rescan_interval', DEFAULT_RESCAN_INTERVAL)))
+    if config.min_interval <= 0 or config.max_interval < config.min_interval:
+        raise ValueError("Poll intervals must be positive with max_interval at least min_interval, got %s" % (
+            data,))
+    return config
+
+
+def _list_entries(dirpath):
+    """List directory entries as (name, inode, is_dir, is_file) tuples without following symlinks"""
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            yield entry.name, entry.inode(), is_dir, not is_dir and entry.is_file(follow_symlinks=False)
+        return
+    for name in os.listdir(dirpath):
+        st = os.lstat(os.path.join(dirpath, name))
+        yield name, st.st_ino, stat.S_ISDIR(st.st_mode), stat.S_ISREG(st.st_mode)
+
+
+class _DirState(object):
+
+    """Snapshot of a polled directory"""
+
+    __slots__ = ('mtime', 'listed_at', 'rescanned_at', 'files', 'pending', 'subdirs', 'interval', 'due')
+
+    def __init__(self, interval, now):
+        self.mtime, self.listed_at, self.rescanned_at = None, 0, now
+        # (inode, size, mtime) by file name. Size and modified time are None until first stat'ed
+        self.files = {}
+        # Names of new or modified files not yet seen unchanged on two polls
+        self.pending = set()
+        self.subdirs = set()
+        self.interval, self.due = interval, now
+
+
+class Poller(object):
+
+    """Polls a watched directory, and its sub-directories if recursive, in a thread and
+    passes events of new and modified files to its event handler"""
+
+    def __init__(self, root, event_handler, config=None, tree=None):
+        """
+        :param root: Directory to poll
+        :type root: str
+        :param event_handler: Handler of events. Can be replaced while polling
+        :type event_handler: :class:`cronify.cronify.EventHandler`
+        :param config: Poll settings. Defaults are used if not given
+        :type config: :class:`PollConfig`
+        :param tree: Tree of sub-directories to poll for recursive watchers
+        :type tree: :class:`cronify.tree.WatchTree`
+        """
+        self.root, self.event_handler, self.tree = root, event_handler, tree
+        self.config = config if config else parse_poll_config(None)
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._dirs)
+
+    def start(self):
+        """Take initial snapshot of directories and start polling thread"""
+        self._add_dir(self.root, time.time(), snapshot=True)
+        logger.info("Polling %s directories of %s every %s to %s seconds",
+                    len(self._dirs), self.root, self.config.min_interval, self.config.max_interval,)
+        self._thread = threading.Thread(target=self._poll_target_thread, name='Poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _poll_target_thread(self):
+        while not self._closed.wait(self.config.min_interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Error polling %s", self.root,)
+
+    def poll(self, now=None):
+        """Poll directories that are due
+
+        :rtype: int
+        :returns: Number of events"""
+        now = now if now is not None else time.time()
+        events = 0
+        with self._lock:
+            for dirpath in [dirpath for dirpath, state in self._dirs.items() if state.due <= now]:
+                state = self._dirs.get(dirpath)
+                if state is not None:
+                    events += self._poll_dir(dirpath, state, now)
+        return events
+
+    def _add_dir(self, dirpath, now, snapshot=False):
+        """Add directory and its sub-directories. Files of snapshot directories do not trigger events"""
+        state = _DirState(self.config.min_interval, now)
+        self._dirs[dirpath] = state
+        if snapshot:
+            self._list(dirpath, state, now, snapshot=True)
+
+    def _remove_dir(self, dirpath):
+        state = self._dirs.pop(dirpath, None)
+        if state is None:
+            return
+        for name in state.subdirs:
+            self._remove_dir(os.path.join(dirpath, name))
+
+    def _poll_dir(self, dirpath, state, now):
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            if dirpath == self.root:
+                logger.error("Could not poll %s as it is no longer accessible", dirpath,)
+                state.due = now + self.config.max_interval
+            else:
+                self._remove_dir(dirpath)
+            return 0
+        rescan = now - state.rescanned_at >= self.config.rescan_interval
+        if mtime == state.mtime and state.listed_at > mtime + _MTIME_RESOLUTION and not rescan:
+            events, changed = self._check_pending(dirpath, state)
+        else:
+            events, changed = self._list(dirpath, state, now, mtime, rescan=rescan)
+        state.interval = self.config.min_interval if changed or state.pending \
+            else min(state.interval * 2, self.config.max_interval)
+        state.due = now + state.interval
+        return events
+
+    def _stat(self, dirpath, name):
+        st = os.stat(os.path.join(dirpath, name))
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def _check_pending(self, dirpath, state):
+        """Stat files that have not settled
+
+        :returns: Number of events, True if any file changed"""
+        events, changed = 0, False
+        for name in list(state.pending):
+            try:
+                signature = self._stat(dirpath, name)
+            except OSError:
+                state.pending.discard(name)
+                state.files.pop(name, None)
+                continue
+            if signature == state.files.get(name):
+                state.pending.discard(name)
+                self._emit(dirpath, name)
+                events += 1
+            else:
+                state.files[name] = signature
+                changed = True
+        return events, changed
+
+    def _list(self, dirpath, state, now, mtime=None, snapshot=False, rescan=False):
+        """List directory, stat new, replaced and pending files, and all files on rescan
+
+        :param mtime: Modified time of directory, stat'ed before listing if not given
+        :returns: Number of events, True if any file or sub-directory changed"""
+        try:
+            state.mtime = mtime if mtime is not None else os.stat(dirpath).st_mtime
+            entries = list(_list_entries(dirpath))
+        except OSError as ex:
+            logger.warning("Could not list directory %s - %s", dirpath, ex,)
+            return 0, False
+        state.listed_at = now
+        if rescan:
+            state.rescanned_at = now
+        events, changed = 0, False
+        names, subdirs = set(), set()
+        for name, inode, is_dir, is_file in entries:
+            if is_dir:
+                subdir = os.path.join(dirpath, name)
+                if self.tree is None or self.tree.excluded(subdir):
+                    continue
+                subdirs.add(name)
+                if subdir not in self._dirs:
+                    self._add_dir(subdir, now, snapshot=snapshot)
+                    changed = True
+                continue
+            if not is_file:
+                continue
+            names.add(name)
+            previous = state.files.get(name)
+            if snapshot:
+                state.files[name] = (inode, None, None)
+                continue
+            if previous is not None and previous[0] == inode and name not in state.pending and not rescan:
+                continue
+            try:
+                signature = self._stat(dirpath, name)
+            except OSError:
+                continue
+            if previous is not None and previous[1] is None and previous[0] == signature[0]:
+                # First stat of a file known from the initial snapshot
+                state.files[name] = signature
+            elif signature != previous:
+                state.files[name] = signature
+                state.pending.add(name)
+                changed = True
+            elif name in state.pending:
+                state.pending.discard(name)
+                self._emit(dirpath, name)
+                events += 1
+        for name in set(state.files) - names:
+            del state.files[name]
+            state.pending.discard(name)
+            changed = True
+        for name in state.subdirs - subdirs:
+            self._remove_dir(os.path.join(dirpath, name))
+            changed = True
+        state.subdirs = subdirs
+        return events, changed
+
+    def _emit(self, dirpath, name):
+        try:
+            self.event_handler.handle_event(pyinotify.Event({
+                'wd' : -1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                'path' : dirpath, 'name' : name, 'dir' : False}))
+        except Exception:
+            logger.exception("Error handling polled event for %s", os.path.join(dirpath, name),)
+
+    def close(self):
+        """Stop polling"""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,224 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Weighted fair task queue with concurrency limits on top of the shared thread pool"""
+
+import time
+import logging
+import threading
+from collections import deque
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE = None
+# Number of tasks at the head of a queue looked at for one that is not held back by a limit
+_LOOKAHEAD = 16
+
+
+class ConcurrencyLimit(object):
+
+    """Token pool limiting the number of concurrently running tasks holding it.
+    Only acquired and released by :class:`FairQueue` under its lock"""
+
+    def __init__(self, max_concurrency, name=None):
+        self.max_concurrency, self.name = max_concurrency, name
+        self.running = 0
+
+    def __repr__(self):
+        return "<ConcurrencyLimit %s %s/%s>" % (self.name, self.running, self.max_concurrency,)
+
+    def available(self):
+        return self.running < self.max_concurrency
+
+
+class _TaskQueue(object):
+
+    """Queue of one watcher's tasks with its share of the thread pool"""
+
+    __slots__ = ('name', 'weight', 'tasks', 'virtual_time', 'wait_time')
+
+    def __init__(self, name, wait_time, weight=1):
+        self.name, self.wait_time, self.weight = name, wait_time, weight
+        self.tasks = deque()
+        self.virtual_time = 0.0
+
+
+class FairQueue(object):
+
+    """Task queue in front of a thread pool giving each named queue, eg a watcher,
+    a share of workers proportional to its weight.
+
+    Tasks are dispatched by stride scheduling - the non-empty queue that has received
+    the least service relative to its weight runs next. A task only runs when all of
+    its concurrency limits have a free token, otherwise it stays queued without
+    holding a worker.
+
+    For every queued task one dispatch function is added to the thread pool queue.
+    A dispatch function that finds nothing it may run is owed back to the pool and
+    resubmitted when a running task releases its limits.
+
+    With max_queued and a spill queue, tasks offered with :meth:`spill_task` while
+    max_queued tasks are queued, or while earlier records are still spilled, are
+    written to the spill queue as records instead. Spilled records are paged back
+    in FIFO order, by passing them to unspill_func, as queued tasks drop to half of
+    max_queued."""
+
+    def __init__(self, thread_pool, metrics=None, max_queued=None, spill=None, unspill_func=None):
+        """
+        :param thread_pool: Thread pool to run tasks in
+        :type thread_pool: :mod:`threadpool.ThreadPool`
+        :param metrics: Optional metrics registry to record task wait times to
+        :type metrics: :class:`cronify.metrics.Metrics`
+        :param max_queued: Optional number of queued tasks beyond which tasks are spilled
+        :type max_queued: int
+        :param spill: Queue to spill task records to
+        :type spill: :class:`cronify.spill.SpillQueue`
+        :param unspill_func: Function to add the task of a record read back from spill queue
+        """
+        self.thread_pool = thread_pool
+        self.metrics = metrics if metrics else Metrics()
+        self.max_queued, self.spill, self.unspill_func = max_queued, spill, unspill_func
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+        self._virtual_time = 0.0
+        self._owed = 0
+        self.queued = 0
+
+    def __len__(self):
+        return self.queued
+
+    def set_weight(self, queue, weight):
+        """Set weight of named queue. Defaults to 1"""
+        with self._lock:
+            self._get_queue(queue).weight = weight
+
+    def add_task(self, queue, func, args, limits=()):
+        """Add task to named queue
+
+        :param queue: Queue name
+        :param func: Task function
+        :param args: Positional arguments for func
+        :type args: tuple
+        :param limits: Concurrency limits task must acquire before running
+        :type limits: tuple of :class:`ConcurrencyLimit`
+        """
+        with self._lock:
+            task_queue = self._get_queue(queue)
+            if not task_queue.tasks:
+                # Idle queues do not accumulate credit
+                task_queue.virtual_time = max(task_queue.virtual_time, self._virtual_time)
+            task_queue.tasks.append((func, args, limits, time.time()))
+            self.queued += 1
+        self.thread_pool.add_task_to_queue(self._dispatch)
+
+    def spill_task(self, record):
+        """Spill record of a task to be added to the spill queue if the queue is full
+        or earlier records are spilled, so that tasks are added in order
+
+        :rtype: bool
+        :returns: True if record was spilled, False if its task should be added now"""
+        if self.spill is None or not self.max_queued:
+            return False
+        if not len(self.spill) and self.queued < self.max_queued:
+            return False
+        try:
+            self.spill.put(record)
+        except (IOError, OSError) as ex:
+            logger.error("Could not spill task to %s, queueing in memory - %s", self.spill.spill_dir, ex,)
+            return False
+        self._refill()
+        return True
+
+    def _refill(self):
+        """Add tasks of spilled records while queue is at or below half of max_queued.
+        Only one thread refills at a time"""
+        if not self._refill_lock.acquire(False):
+            return
+        try:
+            while len(self.spill) and self.queued <= self.max_queued // 2:
+                for record in self.spill.get(self.max_queued - self.queued):
+                    try:
+                        self.unspill_func(record)
+                    except Exception:
+                        logger.exception("Error adding task of spilled record %s", record,)
+        except (IOError, OSError) as ex:
+            logger.error("Could not read spilled tasks from %s - %s", self.spill.spill_dir, ex,)
+        finally:
+            self._refill_lock.release()
+
+    def add_task_to_queue(self, func, *args):
+        """Add task without limits to default queue. Same signature as the thread pool's"""
+        self.add_task(DEFAULT_QUEUE, func, args)
+
+    def depths(self):
+        """Number of queued tasks per named queue
+
+        :rtype: list
+        :returns: List of ((queue,), depth) tuples"""
+        with self._lock:
+            return [((name,), len(task_queue.tasks)) for name, task_queue in self._queues.items()]
+
+    def _get_queue(self, queue):
+        if queue not in self._queues:
+            self._queues[queue] = _TaskQueue(queue, self.metrics.queue_wait.labels(queue))
+        return self._queues[queue]
+
+    def _next_task(self):
+        """Pop next runnable task and acquire its limits, or return None if all queued
+        tasks are held back by limits"""
+        candidates = sorted((task_queue for task_queue in self._queues.values() if task_queue.tasks),
+                            key=lambda task_queue: task_queue.virtual_time)
+        for task_queue in candidates:
+            for i in range(min(len(task_queue.tasks), _LOOKAHEAD)):
+                func, args, limits, queued_at = task_queue.tasks[i]
+                if not all(limit.available() for limit in limits):
+                    continue
+                del task_queue.tasks[i]
+                task_queue.wait_time.observe(time.time() - queued_at)
+                for limit in limits:
+                    limit.running += 1
+                self._virtual_time = task_queue.virtual_time
+                task_queue.virtual_time += 1.0 / task_queue.weight
+                self.queued -= 1
+                return func, args, limits
+
+    def _dispatch(self):
+        """Run next task from thread pool worker"""
+        with self._lock:
+            task = self._next_task()
+            if task is None:
+                self._owed += 1
+                return
+        if self.spill is not None and len(self.spill):
+            self._refill()
+        func, args, limits = task
+        try:
+            func(*args)
+        finally:
+            if limits:
+                self._release(limits)
+
+    def _release(self, limits):
+        with self._lock:
+            for limit in limits:
+                limit.running -= 1
+            resubmit = min(self._owed, len(limits))
+            self._owed -= resubmit
+        for _ in range(resubmit):
+            self.thread_pool.add_task_to_queue(self._dispatch)
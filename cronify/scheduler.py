@@ -0,0 +1,126 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Timer scheduler for deferred actions. Holds actions until their fire time
+and only then hands them to the thread pool"""
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+
+    """Heap based scheduler of deferred tasks with a single timer thread.
+
+    Tasks are keyed by their fire time in seconds since the epoch (UTC) and are
+    added to the thread pool's queue when that time comes, so no worker is held
+    while a task waits. Inserts are O(log n)."""
+
+    def __init__(self, thread_pool):
+        """
+        :param thread_pool: Thread pool to dispatch tasks to when they are due
+        :type thread_pool: :mod:`threadpool.ThreadPool`
+        """
+        self.thread_pool = thread_pool
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def schedule(self, fire_time, func, *args):
+        """Schedule func to be added to the thread pool queue at fire_time
+
+        :param fire_time: Time to run task at, in seconds since the epoch
+        :type fire_time: float
+        :param func: Task function
+        :param args: Positional arguments for func
+        :rtype: list
+        :returns: Scheduled entry, can be passed to :meth:`cancel`
+        """
+        entry = [fire_time, next(self._counter), func, args]
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+            if self._stopped:
+                return entry
+            if self._thread is None:
+                self._start_thread()
+            elif self._queue[0] is entry:
+                # New earliest entry, timer thread needs to wake up sooner
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Cancel a scheduled entry. Cancelled entries are discarded when due"""
+        entry[2] = None
+
+    def start(self):
+        """Start timer thread again after :meth:`stop`. Tasks scheduled while stopped,
+        and tasks that became due, are run"""
+        with self._cond:
+            if not self._stopped:
+                return
+            self._stopped = False
+            if self._queue:
+                self._start_thread()
+
+    def stop(self):
+        """Stop timer thread. Tasks not yet due are not run until :meth:`start` is called"""
+        with self._cond:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            self._cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._timer_target_thread, name='Scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _timer_target_thread(self):
+        """Target function for timer thread. Waits for the earliest entry to be due
+        and dispatches all due entries to the thread pool"""
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._queue:
+                        self._cond.wait()
+                        continue
+                    delay = self._queue[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if self._stopped:
+                    return
+                now = time.time()
+                due = []
+                while self._queue and self._queue[0][0] <= now:
+                    due.append(heapq.heappop(self._queue))
+            for _, _, func, args in due:
+                if func is None:
+                    continue
+                logger.debug("Scheduled task %s is due, adding to queue", func)
+                self.thread_pool.add_task_to_queue(func, *args)
@@ -0,0 +1,337 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Spawn server - a small, long-lived helper process launching action commands.
+
+Forking the daemon for every action copies page tables that grow with its
+queues and caches, and forking a multithreaded process can leave locks held
+in the child. The spawn server is a new interpreter that only runs this module,
+so it stays small. It is sent command requests over a pipe and launches them
+with ``posix_spawn`` where available, or fork and exec otherwise.
+
+Commands' stdin, stdout and stderr are named pipes made by the requesting
+worker in a private directory, so output is read by the worker exactly as for
+its own child process. The server reports each command's process id once it is
+started and its exit code once it is reaped.
+
+This module only imports the standard library as it is also run as the server script."""
+
+import os
+import sys
+import errno
+import fcntl
+import shutil
+import signal
+import struct
+import select
+import logging
+import tempfile
+import itertools
+import threading
+import subprocess
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+logger = logging.getLogger(__name__)
+
+# Exit code of commands that could not be started, as in shells
+SPAWN_FAILED = 127
+_SERVER_SCRIPT = os.path.abspath(__file__)
+if _SERVER_SCRIPT.endswith('.pyc') and os.path.exists(_SERVER_SCRIPT[:-1]):
+    _SERVER_SCRIPT = _SERVER_SCRIPT[:-1]
+_HEADER = struct.Struct('!I')
+# Signals commands are started with default handling of, as the server ignores them
+_DEFAULT_SIGNALS = tuple(getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ', 'SIGINT')
+                         if hasattr(signal, name))
+try:
+    _MAXFD = os.sysconf('SC_OPEN_MAX')
+except (AttributeError, ValueError):
+    _MAXFD = 256
+
+
+def _set_nonblocking(fd, nonblocking):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK if nonblocking else flags & ~os.O_NONBLOCK)
+
+
+class SpawnedProcess(object):
+
+    """Command launched by the spawn server. Like :mod:`subprocess.Popen`, has
+    stdin, stdout and stderr pipes, pid and returncode attributes and a wait method"""
+
+    def __init__(self, args):
+        self.args = args
+        self.pid, self.returncode = None, None
+        self.stdin, self.stdout, self.stderr = None, None, None
+        self._started, self._exited = threading.Event(), threading.Event()
+
+    def wait(self):
+        """Wait for command to exit
+
+        :raises: :mod:`IOError` if spawn server exited before command did
+        :rtype: int
+        :returns: Exit code, negative signal number if command was killed by a signal"""
+        self._exited.wait()
+        if self.returncode is None:
+            raise IOError("Spawn server exited before command %s finished" % (self.args[0],))
+        return self.returncode
+
+
+class SpawnServer(object):
+
+    """Starts a spawn server process and launches commands through it. Thread safe.
+
+    Start before worker threads are started, as starting the server is itself a fork"""
+
+    def __init__(self):
+        self._fifo_dir = tempfile.mkdtemp(prefix='cronify-spawn-')
+        self._proc = subprocess.Popen([sys.executable, _SERVER_SCRIPT], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, close_fds=True)
+        self.pid = self._proc.pid
+        self.closed, self._closing = False, False
+        self._requests, self._ids = {}, itertools.count(1)
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_responses, name='SpawnServerReader')
+        self._reader.daemon = True
+        self._reader.start()
+        logger.info("Started spawn server with pid %s", self.pid,)
+
+    def spawn(self, cmd_args, stdin=False):
+        """Launch command. Stdout and stderr of returned process must be read until
+        closed, see :func:`cronify.output.stream_output`
+
+        :param cmd_args: List of command and arguments, eg ['ls', '-l']
+        :type cmd_args: list
+        :param stdin: Open a pipe to command's stdin. Stdin is /dev/null otherwise
+        :type stdin: bool
+        :raises: :mod:`IOError` if spawn server is not running, :mod:`OSError` if \
+        named pipes could not be made
+        :rtype: :class:`SpawnedProcess`"""
+        request_id = next(self._ids)
+        proc = SpawnedProcess(cmd_args)
+        paths = [os.path.join(self._fifo_dir, '%d.%s' % (request_id, stream,)) if stream != 'stdin' or stdin
+                 else None for stream in ('stdin', 'stdout', 'stderr')]
+        fds, stdin_hold = [], None
+        try:
+            for path in paths:
+                if path:
+                    os.mkfifo(path, 0o600)
+            # Read ends are opened without blocking so the server can open write ends without blocking
+            for path in paths[1:]:
+                fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            if stdin:
+                # Keeps a writer on command's stdin until the write end is opened,
+                # so the command cannot read end of file before then
+                stdin_hold = os.open(paths[0], os.O_RDWR)
+            payload = pickle.dumps((request_id, list(cmd_args)) + tuple(paths), 2)
+            with self._lock:
+                if self.closed:
+                    raise IOError("Spawn server is not running")
+                self._requests[request_id] = proc
+                try:
+                    self._proc.stdin.write(_HEADER.pack(len(payload)) + payload)
+                    self._proc.stdin.flush()
+                except (IOError, OSError, ValueError) as ex:
+                    del self._requests[request_id]
+                    raise IOError("Could not send request to spawn server - %s" % (ex,))
+            proc._started.wait()
+            if proc.pid is None:
+                raise IOError("Spawn server exited before starting command %s" % (cmd_args[0],))
+            if stdin:
+                # Does not block as the held end is a reader
+                proc.stdin = os.fdopen(os.open(paths[0], os.O_WRONLY), 'wb')
+        except Exception:
+            for fd in fds:
+                os.close(fd)
+            raise
+        finally:
+            if stdin_hold is not None:
+                os.close(stdin_hold)
+            for path in paths:
+                if path and os.path.exists(path):
+                    os.unlink(path)
+        for fd in fds:
+            _set_nonblocking(fd, False)
+        proc.stdout, proc.stderr = [os.fdopen(fd, 'rb') for fd in fds]
+        return proc
+
+    def _read_responses(self):
+        for line in iter(self._proc.stdout.readline, b''):
+            request_id, event, value = line.split()
+            request_id, value = int(request_id), int(value)
+            with self._lock:
+                proc = self._requests.pop(request_id) if event == b'exited' else self._requests[request_id]
+            if event == b'started':
+                proc.pid = value
+                proc._started.set()
+            else:
+                proc.returncode = value
+                proc._exited.set()
+        with self._lock:
+            self.closed = True
+            pending, self._requests = list(self._requests.values()), {}
+        for proc in pending:
+            proc._started.set()
+            proc._exited.set()
+        returncode = self._proc.wait()
+        if not self._closing:
+            logger.error("Spawn server exited unexpectedly with exit code %s", returncode,)
+
+    def close(self):
+        """Stop spawn server. It exits once commands it launched have exited"""
+        self._closing = True
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        shutil.rmtree(self._fifo_dir, ignore_errors=True)
+
+
+def _spawn_process(args, std_fds):
+    """Start command with std_fds as its stdin, stdout and stderr
+
+    :rtype: int
+    :returns: Process id"""
+    if hasattr(os, 'posix_spawnp'):
+        return os.posix_spawnp(args[0], args, os.environ,
+                               file_actions=[(os.POSIX_SPAWN_DUP2, fd, i) for i, fd in enumerate(std_fds)],
+                               setsigdef=_DEFAULT_SIGNALS)
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        for i, fd in enumerate(std_fds):
+            os.dup2(fd, i)
+        os.closerange(3, _MAXFD)
+        for signum in _DEFAULT_SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+        os.execvp(args[0], args)
+    except OSError as ex:
+        os.write(2, ("%s: %s\n" % (args[0], ex.strerror,)).encode('utf-8', 'replace'))
+    finally:
+        os._exit(SPAWN_FAILED)
+
+
+def _start(args, stdin_path, stdout_path, stderr_path):
+    """Open command's named pipes and start it
+
+    :rtype: int
+    :returns: Process id, or None if command could not be started"""
+    fds = []
+    try:
+        fds.append(os.open(stdin_path, os.O_RDONLY | os.O_NONBLOCK) if stdin_path
+                   else os.open(os.devnull, os.O_RDONLY))
+        for path in (stdout_path, stderr_path):
+            fds.append(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+        for fd in fds:
+            _set_nonblocking(fd, False)
+        try:
+            return _spawn_process(args, fds)
+        except OSError as ex:
+            os.write(fds[2], ("%s: %s\n" % (args[0], ex.strerror,)).encode('utf-8', 'replace'))
+    except OSError as ex:
+        sys.stderr.write("cronify spawn server: could not open pipes of %s - %s\n" % (args[0], ex,))
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _respond(response_fd, request_id, event, value):
+    try:
+        os.write(response_fd, ("%d %s %d\n" % (request_id, event, value,)).encode('ascii'))
+    except OSError:
+        pass
+
+
+def _returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _reap(children, response_fd):
+    """Respond with exit codes of exited children"""
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as ex:
+            if ex.errno == errno.EINTR:
+                continue
+            if ex.errno == errno.ECHILD:
+                return
+            raise
+        if not pid:
+            return
+        if pid in children:
+            _respond(response_fd, children.pop(pid), 'exited', _returncode(status))
+
+
+def serve(request_fd=0, response_fd=1):
+    """Serve spawn requests read from request_fd until it is closed, then wait
+    for running commands to exit"""
+    # The daemon handles interrupts, the server exits once its request pipe is closed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    wakeup_r, wakeup_w = os.pipe()
+    for fd in (wakeup_r, wakeup_w):
+        _set_nonblocking(fd, True)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wakeup_w)
+    poller = select.poll()
+    poller.register(request_fd, select.POLLIN)
+    poller.register(wakeup_r, select.POLLIN)
+    children, buf, reading = {}, b'', True
+    while reading or children:
+        try:
+            ready = poller.poll()
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, _ in ready:
+            if fd == wakeup_r:
+                try:
+                    while os.read(wakeup_r, 512):
+                        pass
+                except OSError:
+                    pass
+                continue
+            data = os.read(request_fd, 65536)
+            if not data:
+                poller.unregister(request_fd)
+                reading = False
+                continue
+            buf += data
+            while len(buf) >= _HEADER.size:
+                size = _HEADER.unpack(buf[:_HEADER.size])[0]
+                if len(buf) < _HEADER.size + size:
+                    break
+                request = pickle.loads(buf[_HEADER.size:_HEADER.size + size])
+                buf = buf[_HEADER.size + size:]
+                request_id, args = request[:2]
+                pid = _start(args, *request[2:])
+                if pid is None:
+                    _respond(response_fd, request_id, 'started', 0)
+                    _respond(response_fd, request_id, 'exited', SPAWN_FAILED)
+                else:
+                    children[pid] = request_id
+                    _respond(response_fd, request_id, 'started', pid)
+        _reap(children, response_fd)
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,138 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""On-disk FIFO queue of task records spilled from a full task queue.
+
+Records are appended to segment files and read back in the order they were
+added. A segment is removed once all of its records have been read. Spilled
+records only live as long as the process - segments left by a previous run are
+removed on startup, as actions that must survive restarts are in the journal."""
+
+import os
+import struct
+import marshal
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+_SEGMENT_SUFFIX = '.spill'
+
+
+class SpillQueue(object):
+
+    """FIFO queue of records kept in segment files in a directory. Thread safe.
+
+    Records are tuples of strings, numbers and None"""
+
+    def __init__(self, spill_dir, segment_size=4*1024*1024):
+        """
+        :param spill_dir: Directory to keep segment files in. Created if it does not exist
+        :type spill_dir: str
+        :param segment_size: Size in bytes after which a new segment file is started
+        :type segment_size: int
+        """
+        self.spill_dir, self.segment_size = spill_dir, segment_size
+        if not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+        for name in os.listdir(spill_dir):
+            if name.endswith(_SEGMENT_SUFFIX):
+                logger.warning("Removing spill segment %s left by a previous run", name,)
+                os.unlink(os.path.join(spill_dir, name))
+        self._lock = threading.Lock()
+        self._segments = []
+        self._writer, self._reader = None, None
+        self._segment_ids = 0
+        self._written = 0
+        self._count = 0
+        # Bytes written to segments and not yet read
+        self.backlog_bytes = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return self._count
+
+    def _path(self, segment_id):
+        return os.path.join(self.spill_dir, '%08d%s' % (segment_id, _SEGMENT_SUFFIX,))
+
+    def put(self, record):
+        """Append record to queue
+
+        :raises: :mod:`IOError` if record could not be written"""
+        data = marshal.dumps(record)
+        with self._lock:
+            if self._writer is None or self._written >= self.segment_size:
+                self._start_segment()
+            self._writer.write(_HEADER.pack(len(data)) + data)
+            self._written += _HEADER.size + len(data)
+            self.backlog_bytes += _HEADER.size + len(data)
+            self._count += 1
+            self.spilled += 1
+
+    def _start_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._segment_ids += 1
+        self._segments.append(self._segment_ids)
+        self._writer = open(self._path(self._segment_ids), 'wb')
+        self._written = 0
+
+    def get(self, max_records):
+        """Read and remove up to max_records records from the head of the queue
+
+        :rtype: list"""
+        records = []
+        with self._lock:
+            while self._count and len(records) < max_records:
+                if self._reader is None:
+                    self._reader = open(self._path(self._segments[0]), 'rb')
+                if len(self._segments) == 1:
+                    # Reading the segment being written
+                    self._writer.flush()
+                header = self._reader.read(_HEADER.size)
+                if not header:
+                    self._next_segment()
+                    continue
+                size = _HEADER.unpack(header)[0]
+                records.append(marshal.loads(self._reader.read(size)))
+                self.backlog_bytes -= _HEADER.size + size
+                self._count -= 1
+            if not self._count and self._segments:
+                # Start again from an empty segment rather than growing a drained one
+                self._writer.close()
+                self._writer = None
+                while self._segments:
+                    self._next_segment()
+        return records
+
+    def _next_segment(self):
+        """Remove fully read head segment"""
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        os.unlink(self._path(self._segments.pop(0)))
+
+    def close(self):
+        """Remove segment files. Records not yet read are lost"""
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            while self._segments:
+                self._next_segment()
+            self._count, self.backlog_bytes = 0, 0
@@ -0,0 +1,154 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Lifecycle tracing of events through the event to action pipeline.
+
+Each traced event records a monotonic timestamp at every stage it goes through:
+
+* ``read`` - event read from inotify file descriptor
+* ``match`` - event matched against filemasks
+* ``queued`` - actions added to task queue
+* ``spilled`` - actions spilled to disk as the task queue was full. Trace ends here
+* ``pickup`` - actions picked up by a thread pool worker
+* ``deferred`` - action deferred until its start time
+* ``batched`` - action added to a batch
+* ``spawn`` - action process about to be started
+* ``exit`` - action process exited
+
+Traces are passed to hooks, callables taking a :class:`Trace`, once an event's
+action sequence is done."""
+
+import time
+import json
+import random
+import logging
+import threading
+import pyinotify
+
+logger = logging.getLogger(__name__)
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Trace(object):
+
+    """Stage timestamps of one event's action sequence"""
+
+    __slots__ = ('watch', 'filemask', 'pathname', 'start', 'stages')
+
+    def __init__(self, watch, filemask, pathname):
+        self.watch, self.filemask, self.pathname = watch, filemask, pathname
+        # Wall clock time trace started at, for correlating with logs
+        self.start = time.time()
+        self.stages = []
+
+    def mark(self, stage, action=None, timestamp=None):
+        """Record stage of action, if any, at timestamp or now"""
+        self.stages.append((stage, timestamp if timestamp is not None else monotonic(), action))
+
+    def to_dict(self):
+        """Trace as a dictionary with stage times in seconds relative to the first stage"""
+        first = self.stages[0][1] if self.stages else 0
+        return {'watch' : self.watch, 'filemask' : self.filemask, 'path' : self.pathname,
+                'start' : self.start,
+                'stages' : [[stage, round(timestamp - first, 6), action]
+                            for stage, timestamp, action in self.stages]}
+
+
+class Tracer(object):
+
+    """Starts traces for a sample of events and passes finished traces to hooks"""
+
+    def __init__(self, hooks, sample_rate=1.0):
+        """
+        :param hooks: Callables to pass finished :class:`Trace` objects to
+        :type hooks: list
+        :param sample_rate: Fraction of events to trace
+        :type sample_rate: float
+        """
+        self.hooks, self.sample_rate = list(hooks), sample_rate
+        # Notifier to read time of current event batch from, see :class:`TimedAsyncNotifier`
+        self.notifier = None
+
+    def start(self, watch, filemask, event, matched):
+        """Start trace of event's actions for filemask, or return None if event is not sampled
+
+        :param matched: Monotonic time event was matched at
+        :rtype: :class:`Trace`"""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        trace = Trace(watch, filemask, event.pathname)
+        read_time = getattr(self.notifier, 'read_time', None)
+        # Events made by catch-up scans and resyncs were not read from inotify
+        if read_time is not None and event.wd != -1:
+            trace.mark('read', timestamp = read_time)
+        trace.mark('match', timestamp = matched)
+        return trace
+
+    def finish(self, trace):
+        """Pass finished trace to hooks"""
+        for hook in self.hooks:
+            try:
+                hook(trace)
+            except Exception:
+                logger.exception("Trace hook %s failed", hook,)
+
+
+class JSONLinesExporter(object):
+
+    """Trace hook writing one JSON object per trace to a file"""
+
+    def __init__(self, filename):
+        """
+        :param filename: File to append traces to
+        :type filename: str
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._fileh = open(filename, 'a')
+
+    def __call__(self, trace):
+        line = json.dumps(trace.to_dict()) + '\n'
+        with self._lock:
+            self._fileh.write(line)
+            self._fileh.flush()
+
+    def close(self):
+        with self._lock:
+            self._fileh.close()
+
+
+class TimedAsyncNotifier(pyinotify.AsyncNotifier):
+
+    """Asyncore notifier recording the time each batch of events was read"""
+
+    read_time = None
+
+    def read_events(self):
+        pyinotify.AsyncNotifier.read_events(self)
+        self.read_time = monotonic()
+
+
+class TimedAsyncioNotifier(pyinotify.AsyncioNotifier):
+
+    """Asyncio notifier recording the time each batch of events was read"""
+
+    read_time = None
+
+    def read_events(self):
+        pyinotify.AsyncioNotifier.read_events(self)
+        self.read_time = monotonic()
@@ -0,0 +1,124 @@
+# This file is part of cronify
+
+# Copyright (C) 2016 Panos Kittenis
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, version 2.1.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Directory trees of recursive watchers.
+
+Sub-directories matching one of a watcher's ``exclude_dirs`` globs, or deeper
+than its ``max_depth``, are neither watched nor walked into. Globs are matched
+against both a directory's name and its path relative to the watched directory.
+
+inotify watches are limited per user, so watches are added within a global
+budget. Directories that do not fit in it are scanned periodically instead,
+along with their sub-directories."""
+
+import os
+import time
+import fnmatch
+import logging
+import threading
+from collections import deque
+from catchup import _list_dir
+
+logger = logging.getLogger(__name__)
+
+
+class WatchTree(object):
+
+    """Directories of one recursive watcher and the ones left to scanning"""
+
+    def __init__(self, root, exclude_dirs=None, max_depth=None, budget_func=None):
+        """
+        :param root: Watched directory
+        :type root: str
+        :param exclude_dirs: Globs of directories not to watch
+        :type exclude_dirs: list
+        :param max_depth: Depth of deepest sub-directories to watch, 0 for root only
+        :type max_depth: int
+        :param budget_func: Function returning True while another watch can be added
+        :raises: :mod:`ValueError` on invalid exclude_dirs or max_depth
+        """
+        if exclude_dirs is not None and (not isinstance(exclude_dirs, list)
+                                         or [glob for glob in exclude_dirs if not isinstance(glob, basestring)]):
+            raise ValueError("exclude_dirs must be a list of globs, got %s" % (exclude_dirs,))
+        if max_depth is not None and (not isinstance(max_depth, int) or max_depth < 0):
+            raise ValueError("max_depth must be a positive integer, got %s" % (max_depth,))
+        self.root = root.rstrip(os.path.sep) or os.path.sep
+        self.exclude_dirs, self.max_depth = tuple(exclude_dirs or ()), max_depth
+        self.budget_func = budget_func if budget_func else lambda: True
+        # Directories scanned instead of watched, with their sub-directories
+        self.unwatched = set()
+        # Modified time files of unwatched directories have been scanned up to. Files
+        # modified before the tree was made are left to catch-up scans
+        self.scanned_until = time.time()
+        self._lock = threading.Lock()
+
+    def excluded(self, path):
+        """True if directory at path is excluded by exclude_dirs or max_depth"""
+        relpath = os.path.relpath(path, self.root)
+        if relpath == os.curdir:
+            return False
+        if self.max_depth is not None and relpath.count(os.path.sep) + 1 > self.max_depth:
+            return True
+        name = os.path.basename(path)
+        for glob in self.exclude_dirs:
+            if fnmatch.fnmatch(name, glob) or fnmatch.fnmatch(relpath, glob):
+                return True
+        return False
+
+    def exclude_filter(self, path):
+        """Filter of directories pyinotify adds watches for automatically as they are created.
+        Directories outside the watch budget are left to scanning"""
+        if self.excluded(path):
+            return True
+        if self.budget_func():
+            return False
+        self.add_unwatched(path)
+        return True
+
+    def add_unwatched(self, path):
+        """Leave directory at path and its sub-directories to scanning"""
+        with self._lock:
+            self.unwatched.add(path)
+        logger.warning("Could not watch %s within watch budget, scanning it and its sub-directories instead",
+                       path,)
+
+    def unwatched_dirs(self):
+        """Directories left to scanning
+
+        :rtype: list"""
+        with self._lock:
+            return list(self.unwatched)
+
+    def walk(self, path=None):
+        """Directories under path, root by default, that are not excluded, breadth first
+        so that shallower directories are watched first when the budget runs out.
+
+        Directories the caller adds to :attr:`unwatched` while iterating are not walked into"""
+        directories = deque([path or self.root])
+        while directories:
+            dirpath = directories.popleft()
+            yield dirpath
+            with self._lock:
+                if dirpath in self.unwatched:
+                    continue
+            try:
+                for name, is_dir, _, _ in _list_dir(dirpath):
+                    subdir = os.path.join(dirpath, name)
+                    if is_dir and not self.excluded(subdir):
+                        directories.append(subdir)
+            except OSError as ex:
+                logger.warning("Could not list directory %s - %s", dirpath, ex,)
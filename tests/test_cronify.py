@@ -4,14 +4,83 @@
 
 import unittest
 from cronify import Watcher
-from cronify.common import read_cfg
+from cronify.cronify import EventHandler, run_script, load_cfg
+from cronify.catchup import CatchupState
+from cronify.output import OutputCapture, RotatingOutputFile
+from cronify.common import read_cfg, ConfigCache, cfg_key
+from cronify.matcher import FilemaskIndex
+from cronify.scheduler import Scheduler
+from cronify.journal import Journal
+from cronify.pool import FairQueue, ConcurrencyLimit
+from cronify.metrics import start_http_server
+from cronify.tracing import JSONLinesExporter
+from cronify.fingerprint import FingerprintCache
+from cronify.callables import ProcessPool
+from cronify.spawner import SpawnServer
+from cronify.cluster import ClusterConfig, DirectoryClaimStore
+from cronify.spill import SpillQueue
+from cronify.tree import WatchTree
+from cronify.poller import Poller, PollConfig
 import os
+import re
+import json
+import fnmatch
+import logging
+import multiprocessing
 import shutil
 import Queue
+import urllib2
+import time
 import datetime
 import pytz
 import yaml
+import pyinotify
 from cStringIO import StringIO
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+class ImmediateThreadPool(object):
+
+    """Thread pool stand-in that runs tasks as soon as they are queued"""
+
+    def add_task_to_queue(self, func, *args):
+        func(*args)
+
+class ManualThreadPool(object):
+
+    """Thread pool stand-in that queues tasks until run_one is called"""
+
+    def __init__(self):
+        self.tasks = []
+
+    def add_task_to_queue(self, func, *args):
+        self.tasks.append((func, args))
+
+    def run_one(self):
+        func, args = self.tasks.pop(0)
+        func(*args)
+
+def _callable_action(args, file_metadata):
+    """Callable action for tests, appends its args, file metadata and process id as JSON to file
+    named by its first argument"""
+    with open(args[0], 'a') as fh:
+        fh.write(json.dumps([args[1:], file_metadata['pathname'], str(file_metadata.get('datestamp')),
+                             os.getpid()]) + '\n')
+    return 3 if 'fail' in file_metadata['pathname'] else None
+
+def _handle_claimed_files(watch_dir, claim_dir, output_file, names, node_id):
+    """Handle events for files with a claim store, for cluster tests run in several processes"""
+    claim_store = DirectoryClaimStore(ClusterConfig(claim_dir, 60, 3600, None), node_id)
+    event_handler = EventHandler({ '*.dat' : { 'actions' : [{ 'Append filename' : {
+        'cmd' : 'sh', 'args' : ['-c', 'echo "$0 $1" >> %s' % (output_file,), '$filename', node_id] } }] } },
+                                 ImmediateThreadPool(), watch = watch_dir, claim_store = claim_store)
+    for name in names:
+        event_handler.handle_event(pyinotify.Event({
+            'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+            'path' : watch_dir, 'name' : name, 'dir' : False}))
+    claim_store.close()
 
 class CronifyTestCase(unittest.TestCase):
 
@@ -52,6 +121,8 @@ class CronifyTestCase(unittest.TestCase):
                      { self.setup_test_dir : { 'name' : 'Fake', 'filemasks' : { } } },
                      { self.setup_test_dir : { 'name' : 'Fake', 'filemasks' : { 'somefilemask' : {} } } },
                      { self.setup_test_dir : { 'name' : 'Fake', 'filemasks' : { 'somefilemask' : { 'actions' : [] } } } },
+                     { self.setup_test_dir : { 'name' : 'Fake', 'filemasks' : { 'somefilemask' : { 'actions' : [
+                         { 'Fake' : { 'cmd' : 'echo', 'callable' : 'os.path:exists', 'args' : [] } }] } } } },
                      ]:
             try:
                 Watcher(data)
@@ -97,6 +168,124 @@ class CronifyTestCase(unittest.TestCase):
                              msg = "Expected action to be triggered for filemask %s with file %s" % (test_filemask,
                                                                                                      file_to_test))
 
+    def test_multiple_watch_dirs(self):
+        """Can watch multiple directories with a single inotify instance and trigger
+        actions of the correct watcher"""
+        other_test_dir = os.path.sep.join([self.setup_test_dir, 'other'])
+        os.mkdir(other_test_dir)
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': {
+                    'testfilemask.txt' : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }},
+            other_test_dir : {
+                'name': 'Other test watch',
+                'filemasks': {
+                    'otherfilemask.txt' : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        watcher = Watcher(watch_data, callback_func = self.callback_func)
+        try:
+            self.assertEqual(2, len(watcher.watch_manager.watches),
+                             msg = "Expected both directories to be watched by one watch manager")
+            open(os.path.sep.join([other_test_dir, 'testfilemask.txt']), 'w').close()
+            open(os.path.sep.join([other_test_dir, 'otherfilemask.txt']), 'w').close()
+            self.assertEqual('otherfilemask.txt', self.q.get(timeout = 30),
+                             msg = "Expected action of other directory's watcher to be triggered")
+            self.assertRaises(Queue.Empty, self.q.get, timeout = 1)
+        finally:
+            watcher.cleanup()
+
+    @unittest.skipIf(asyncio is None, "asyncio not available")
+    def test_asyncio_watcher(self):
+        """Can watch a directory from an asyncio event loop without an asyncore thread"""
+        test_filemask = 'testfilemask.txt'
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': {
+                    test_filemask : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        loop = asyncio.new_event_loop()
+        watcher = Watcher(watch_data, callback_func = self.callback_func, loop = loop)
+        self.assertEqual(None, watcher.asyncore_thread,
+                         msg = "Expected no asyncore thread when using an asyncio event loop")
+        def check_result():
+            if self.q.empty():
+                loop.call_later(0.1, check_result)
+                return
+            watcher.cleanup()
+        loop.call_soon(self._make_test_file, test_filemask)
+        loop.call_later(0.1, check_result)
+        loop.call_later(30, watcher.cleanup)
+        try:
+            loop.run_until_complete(watcher.run())
+            self.assertEqual(test_filemask, self.q.get(timeout = 1),
+                             msg = "Expected action to be triggered for filemask %s" % (test_filemask,))
+        finally:
+            loop.close()
+
+    def test_debounce(self):
+        """Test multiple events for the same file within debounce window trigger actions once"""
+        test_filemask = 'testfilemask.txt'
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': {
+                    test_filemask : {
+                        'debounce_ms': 500,
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        watcher = Watcher(watch_data, callback_func = self.callback_func)
+        try:
+            for _ in range(3):
+                self._make_test_file(test_filemask)
+            self.assertEqual(test_filemask, self.q.get(timeout = 30),
+                             msg = "Expected action to be triggered for filemask %s" % (test_filemask,))
+            self.assertRaises(Queue.Empty, self.q.get, timeout = 1)
+        finally:
+            watcher.cleanup()
+
+    def test_restart_after_cleanup(self):
+        """Test deferred actions and journal work again when watchers are started after cleanup"""
+        test_filemask = 'testfilemask.txt'
+        journal_file = os.path.sep.join([self.setup_test_dir, 'journal.db'])
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': {
+                    test_filemask : {
+                        'debounce_ms': 100,
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        watcher = Watcher(watch_data, callback_func = self.callback_func, journal_file = journal_file)
+        try:
+            watcher.cleanup()
+            watcher.update_watchers(watch_data)
+            self._make_test_file(test_filemask)
+            self.assertEqual(test_filemask, self.q.get(timeout = 30),
+                             msg = "Expected debounced action to be triggered after restart")
+            journal_id = watcher.journal.add(self.setup_test_dir, test_filemask, pyinotify.Event({
+                'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                'path' : self.setup_test_dir, 'name' : test_filemask, 'dir' : False}))
+            watcher.journal.flush()
+            journal = Journal(journal_file)
+            try:
+                self.assertTrue(journal_id in [entry.id for entry in journal.pending()],
+                                msg = "Expected journal to be written to after restart")
+            finally:
+                journal.close()
+        finally:
+            watcher.cleanup()
+
     def test_delayed_action(self):
         """Test that an action with start_time in the future is not triggered"""
         test_filemask = 'testfilemask.txt'
@@ -223,6 +412,33 @@ class CronifyTestCase(unittest.TestCase):
         parsed_yaml = read_cfg(yaml_data_file)
         self.assertEqual(parsed_yaml, expected, msg = "Parsed yaml does not match what we expected it to be")
 
+    def test_config_cache(self):
+        """Test validated configuration is cached and reused while configuration file is unchanged"""
+        cfg_file = os.path.sep.join([self.setup_test_dir, 'cronify.yaml'])
+        cache_file = os.path.sep.join([self.setup_test_dir, 'config.cache'])
+        cfg = """
+/tmp/testdir :
+    name : Access log watcher
+    local_tz : Europe/London
+    filemasks :
+      somefile.* :
+        actions :
+          - processFile :
+              args: [$filename]
+              cmd: echo
+"""
+        with open(cfg_file, 'w') as fh:
+            fh.write(cfg)
+        watch_data = load_cfg(cfg_file, cache_file)
+        self.assertEqual(pytz.timezone('Europe/London'), watch_data['/tmp/testdir']['local_tz'])
+        with open(cfg_file, 'rb') as fh:
+            self.assertEqual(watch_data, ConfigCache(cache_file).get(cfg_key(fh.read())))
+        self.assertEqual(watch_data, load_cfg(cfg_file, cache_file))
+        with open(cfg_file, 'w') as fh:
+            fh.write(cfg.replace('cmd: echo', 'args2: []'))
+        self.assertEqual(None, load_cfg(cfg_file, cache_file),
+                         msg = "Expected changed configuration to be validated instead of read from cache")
+
     def test_reload(self):
         test_filemask = 'testfilemask.txt'
         watch_data = {
@@ -253,5 +469,689 @@ class CronifyTestCase(unittest.TestCase):
         finally:
             watcher.cleanup()
 
+    def test_incremental_reload(self):
+        """Test reload keeps inotify watches of changed and unchanged watchers and only
+        replaces event handlers of changed ones"""
+        other_test_dir = os.path.sep.join([self.setup_test_dir, 'other'])
+        os.mkdir(other_test_dir)
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': {
+                    'testfilemask.txt' : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }},
+            other_test_dir : {
+                'name': 'Other test watch',
+                'filemasks': {
+                    'otherfilemask.txt' : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        watcher = Watcher(watch_data, callback_func = self.callback_func)
+        try:
+            watch_descriptors = sorted(watcher.watch_manager.watches)
+            unchanged_handler = watcher.event_handlers[other_test_dir]
+            changed_handler = watcher.event_handlers[self.setup_test_dir]
+            new_watch_data = {
+                self.setup_test_dir : {
+                    'name': 'Test watch',
+                    'filemasks': {
+                        'testfilemask.txt' : {
+                            'actions': [self.echo_test_action,],
+                            },
+                        'testy.txt' : {
+                            'actions': [self.echo_test_action,],
+                            },
+                        }},
+                other_test_dir : watch_data[other_test_dir].copy()}
+            watcher.update_watchers(new_watch_data)
+            self.assertEqual(watch_descriptors, sorted(watcher.watch_manager.watches),
+                             msg = "Expected inotify watches to be kept on reload")
+            self.assertTrue(unchanged_handler is watcher.event_handlers[other_test_dir])
+            self.assertFalse(changed_handler is watcher.event_handlers[self.setup_test_dir])
+            unchanged_filemask = [filemask for filemask in changed_handler.action_plans
+                                  if filemask.pattern == fnmatch.translate('testfilemask.txt')][0]
+            self.assertTrue(changed_handler.action_plans[unchanged_filemask] in
+                            watcher.event_handlers[self.setup_test_dir].action_plans.values(),
+                            msg = "Expected compiled actions of unchanged filemask to be reused")
+            self.assertTrue(unchanged_filemask is
+                            watcher.event_handlers[self.setup_test_dir]._filemask_regexes['testfilemask.txt'],
+                            msg = "Expected compiled regex of unchanged filemask to be reused")
+            self.assertEqual(['testfilemask.txt'], list(changed_handler._filemask_regexes),
+                             msg = "Expected handler to only keep regexes of its own filemasks")
+            self._make_test_file('testy.txt')
+            self.assertEqual('testy.txt', self.q.get(timeout = 30))
+            del new_watch_data[other_test_dir]
+            watcher.update_watchers(new_watch_data)
+            self.assertEqual(1, len(watcher.watch_manager.watches))
+            open(os.path.sep.join([other_test_dir, 'otherfilemask.txt']), 'w').close()
+            self.assertRaises(Queue.Empty, self.q.get, timeout = 1)
+        finally:
+            watcher.cleanup()
+
+    def test_catchup(self):
+        """Test files written while watcher was not running trigger actions on next start"""
+        catchup_file = os.path.sep.join([self.setup_test_dir, 'catchup.json'])
+        watch_dir = os.path.sep.join([self.setup_test_dir, 'watch'])
+        os.makedirs(os.path.sep.join([watch_dir, 'subdir']))
+        watch_data = {
+            watch_dir : {
+                'name': 'Test watch',
+                'recurse' : True,
+                'filemasks': {
+                    'testfilemask*.txt' : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        open(os.path.sep.join([watch_dir, 'testfilemask_old.txt']), 'w').close()
+        watcher = Watcher(watch_data, callback_func = self.callback_func, catchup_file = catchup_file)
+        watcher.cleanup()
+        self.assertRaises(Queue.Empty, self.q.get, timeout = 1)
+        CatchupState(catchup_file).save([watch_dir], time.time())
+        time.sleep(.1)
+        open(os.path.sep.join([watch_dir, 'subdir', 'testfilemask1.txt']), 'w').close()
+        open(os.path.sep.join([watch_dir, 'testfilemask2.txt']), 'w').close()
+        watcher = Watcher(watch_data, callback_func = self.callback_func, catchup_file = catchup_file)
+        try:
+            self.assertEqual(['testfilemask1.txt', 'testfilemask2.txt'],
+                             sorted([self.q.get(timeout = 30), self.q.get(timeout = 30)]))
+            self.assertRaises(Queue.Empty, self.q.get, timeout = 1)
+        finally:
+            watcher.cleanup()
+
+    def test_watch_tree(self):
+        """Test recursive watch prunes excluded and deep directories and scans directories
+        beyond the watch budget"""
+        for subdir in ['a/b/c', 'archive/x', 'd']:
+            os.makedirs(os.path.sep.join([self.setup_test_dir, subdir]))
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'recurse' : True,
+                'exclude_dirs' : ['archive'],
+                'max_depth' : 2,
+                'filemasks': {
+                    'testfilemask*.txt' : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        watcher = Watcher(watch_data, callback_func = self.callback_func, max_watches = 3)
+        try:
+            tree = watcher.watch_trees[self.setup_test_dir]
+            self.assertEqual(sorted([self.setup_test_dir] + [os.path.sep.join([self.setup_test_dir, subdir])
+                                                             for subdir in ['a', 'd']]),
+                             sorted(watch_.path for watch_ in watcher.watch_manager.watches.values()))
+            self.assertEqual([os.path.sep.join([self.setup_test_dir, 'a', 'b'])], tree.unwatched_dirs())
+            os.mkdir(os.path.sep.join([self.setup_test_dir, 'e']))
+            for _ in range(50):
+                if len(tree.unwatched) == 2:
+                    break
+                time.sleep(.1)
+            self.assertTrue(os.path.sep.join([self.setup_test_dir, 'e']) in tree.unwatched,
+                            msg = "Expected directory created beyond watch budget to be scanned")
+            modified = time.time() - 30
+            for subdir in ['a/b', 'a/b/c', 'archive']:
+                filename = os.path.sep.join([self.setup_test_dir, subdir, 'testfilemask.txt'])
+                open(filename, 'w').close()
+                os.utime(filename, (modified, modified))
+            tree.scanned_until = modified - 30
+            watcher._scan_unwatched()
+            self.assertEqual('testfilemask.txt', self.q.get(timeout = 30))
+            self.assertRaises(Queue.Empty, self.q.get, timeout = 1)
+        finally:
+            watcher.cleanup()
+
+    def test_watch_budget_warning(self):
+        """Test directories left out of the watch budget are logged through the package logger
+        the daemon writes to its log file"""
+        os.makedirs(os.path.sep.join([self.setup_test_dir, 'a', 'b']))
+        records = []
+        class Capture(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler, package_logger = Capture(logging.WARNING), logging.getLogger('cronify')
+        package_logger.addHandler(handler)
+        try:
+            tree = WatchTree(self.setup_test_dir, budget_func = lambda: False)
+            for dirpath in tree.walk():
+                tree.add_unwatched(dirpath)
+        finally:
+            package_logger.removeHandler(handler)
+        self.assertEqual([self.setup_test_dir], tree.unwatched_dirs())
+        self.assertEqual(['cronify.tree'], [record.name for record in records])
+        self.assertTrue(self.setup_test_dir in records[0].getMessage())
+
+    def test_poller(self):
+        """Test poller triggers events for new files once they have settled and not for existing files"""
+        os.makedirs(os.path.sep.join([self.setup_test_dir, 'sub', 'archive']))
+        self._make_test_file('old.txt')
+        class Handler(object):
+            def __init__(self):
+                self.names = []
+            def handle_event(self, event):
+                self.names.append(event.name)
+        handler = Handler()
+        # Intervals longer than the test so that only explicit polls run
+        poller = Poller(self.setup_test_dir, handler, PollConfig(1000, 4000, 100000),
+                        WatchTree(self.setup_test_dir, exclude_dirs = ['archive']))
+        now = time.time()
+        poller.start()
+        try:
+            self.assertEqual(2, len(poller), msg = "Expected excluded directory not to be polled")
+            self._make_test_file('new.txt')
+            for subdir in ['sub', 'sub/archive']:
+                open(os.path.sep.join([self.setup_test_dir, subdir, 'new2.txt']), 'w').close()
+            self.assertEqual(0, poller.poll(now + 1000), msg = "Expected new files to settle before events")
+            self.assertEqual(2, poller.poll(now + 2000))
+            self.assertEqual(['new.txt', 'new2.txt'], sorted(handler.names))
+            self.assertEqual(0, poller.poll(now + 3000))
+        finally:
+            poller.close()
+
+    def test_overflow_resync(self):
+        """Test files whose events were lost to a queue overflow are handled once on resync,
+        and only directories with recent events are rescanned"""
+        idle_dir = os.path.sep.join([self.setup_test_dir, 'idle'])
+        os.mkdir(idle_dir)
+        filemasks = {
+            'testfilemask*.txt' : {
+                'actions': [self.echo_test_action,],
+                }
+            }
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': filemasks},
+            idle_dir : {
+                'name': 'Idle watch',
+                'filemasks': filemasks}}
+        watcher = Watcher(watch_data, callback_func = self.callback_func)
+        try:
+            self._make_test_file('testfilemask1.txt')
+            self.assertEqual('testfilemask1.txt', self.q.get(timeout = 30))
+            watcher.watch_manager.ignore_events = True
+            self._make_test_file('testfilemask2.txt')
+            self._make_test_file(os.path.sep.join(['idle', 'testfilemask3.txt']))
+            time.sleep(.5)
+            watcher.watch_manager.ignore_events = False
+            watcher.notifier._default_proc_fun(pyinotify.Event({
+                'wd' : -1, 'mask' : pyinotify.IN_Q_OVERFLOW, 'cookie' : 0, 'path' : '', 'name' : '', 'dir' : False}))
+            self.assertEqual(1, watcher.overflows)
+            self.assertEqual('testfilemask2.txt', self.q.get(timeout = 30),
+                             msg = "Expected lost event to be found by resync")
+            # Idle watch has had no events so is not rescanned
+            self.assertRaises(Queue.Empty, self.q.get, timeout = 2)
+        finally:
+            watcher.cleanup()
+
+    def test_metrics(self):
+        """Test event and action metrics are recorded and served in Prometheus text format"""
+        test_filemask = 'testfilemask.txt'
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': {
+                    test_filemask : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        watcher = Watcher(watch_data, callback_func = self.callback_func)
+        server = start_http_server(watcher.metrics, 0)
+        try:
+            self._make_test_file(test_filemask)
+            self.assertEqual(test_filemask, self.q.get(timeout = 30))
+            time.sleep(.5)
+            self.assertEqual(1, watcher.metrics.events.labels(self.setup_test_dir).value)
+            self.assertEqual(1, watcher.metrics.match_time.labels(self.setup_test_dir).count)
+            self.assertEqual(1, watcher.metrics.queue_wait.labels(self.setup_test_dir).count)
+            action_name = list(self.echo_test_action.keys())[0]
+            self.assertEqual(1, watcher.metrics.action_exit_codes.labels(self.setup_test_dir, action_name, 0).value)
+            body = urllib2.urlopen('http://127.0.0.1:%s/metrics' % (server.server_port,)).read().decode('utf-8')
+            self.assertTrue('cronify_events_total{watch="%s"} 1.0' % (self.setup_test_dir,) in body.splitlines())
+            self.assertTrue('# TYPE cronify_action_duration_seconds histogram' in body)
+            self.assertTrue('cronify_watches 1' in body)
+        finally:
+            server.shutdown()
+            server.server_close()
+            watcher.cleanup()
+
+    def test_tracing(self):
+        """Test event lifecycle stages are traced and exported as JSON lines"""
+        test_filemask = 'testfilemask.txt'
+        trace_file = os.path.sep.join([self.setup_test_dir, 'traces.jsonl'])
+        watch_data = {
+            self.setup_test_dir : {
+                'name': 'Test watch',
+                'filemasks': {
+                    test_filemask : {
+                        'actions': [self.echo_test_action,],
+                        }
+                    }}}
+        traces = Queue.Queue()
+        exporter = JSONLinesExporter(trace_file)
+        watcher = Watcher(watch_data, callback_func = self.callback_func,
+                          trace_hooks = [traces.put, exporter])
+        try:
+            self._make_test_file(test_filemask)
+            trace = traces.get(timeout = 30)
+            self.assertEqual(['read', 'match', 'queued', 'pickup', 'spawn', 'exit'],
+                             [stage for stage, _, _ in trace.stages])
+            timestamps = [timestamp for _, timestamp, _ in trace.stages]
+            self.assertEqual(sorted(timestamps), timestamps)
+        finally:
+            watcher.cleanup()
+            exporter.close()
+        with open(trace_file) as fh:
+            exported = [json.loads(line) for line in fh]
+        self.assertEqual(1, len(exported))
+        self.assertEqual(os.path.sep.join([self.setup_test_dir, test_filemask]), exported[0]['path'])
+        self.assertEqual(0, exported[0]['stages'][0][1])
+
+    def test_dedup(self):
+        """Test actions are skipped for files unchanged since their actions last ran successfully"""
+        output_file = os.path.sep.join([self.setup_test_dir, 'dedup.out'])
+        cache_file = os.path.sep.join([self.setup_test_dir, 'fingerprints.json'])
+        test_action = { 'Append filename' : {
+            'cmd': 'sh',
+            'args': ['-c', 'echo "$0" >> %s' % (output_file,), '$filename'] } }
+        event_handler = EventHandler({ 'somefile*.txt' : { 'dedup' : True, 'actions' : [test_action] },
+                                       'other*.txt' : { 'dedup' : { 'content_hash' : True },
+                                                        'actions' : [test_action] } },
+                                     ImmediateThreadPool(),
+                                     fingerprints = FingerprintCache(cache_file = cache_file))
+        def make_event(name, data):
+            with open(os.path.sep.join([self.setup_test_dir, name]), 'w') as fh:
+                fh.write(data)
+            event_handler.handle_event(pyinotify.Event({
+                'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                'path' : self.setup_test_dir, 'name' : name, 'dir' : False}))
+        def runs():
+            with open(output_file) as fh:
+                return len(fh.read().splitlines())
+        make_event('somefile.txt', 'data')
+        event_handler.handle_event(pyinotify.Event({
+            'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+            'path' : self.setup_test_dir, 'name' : 'somefile.txt', 'dir' : False}))
+        self.assertEqual(1, runs(), msg = "Expected actions to be skipped for unchanged file")
+        make_event('somefile.txt', 'changed data')
+        self.assertEqual(2, runs(), msg = "Expected actions to run for changed file")
+        make_event('otherfile.txt', 'data')
+        make_event('otherfile.txt', 'data')
+        self.assertEqual(3, runs(), msg = "Expected actions to be skipped for file rewritten with same content")
+        event_handler.fingerprints.save()
+        self.assertEqual(len(event_handler.fingerprints), len(FingerprintCache(cache_file = cache_file)))
+
+    def test_callable_action(self):
+        """Test Python callable actions are called with expanded args and file metadata in a thread or process"""
+        output_file = os.path.sep.join([self.setup_test_dir, 'callable.out'])
+        entry_point = '%s:_callable_action' % (__name__,)
+        process_pool = ProcessPool(1)
+        event_handler = EventHandler({
+            'somefile_YYYYMMDD.txt' : { 'actions' : [
+                { 'In thread' : { 'callable' : entry_point, 'args' : [output_file, '$filename', 'YYYYMMDD'] } },
+                { 'In process' : { 'callable' : entry_point, 'process_pool' : True,
+                                   'args' : [output_file, '$filename'] } }] },
+            'failfile.txt' : { 'actions' : [
+                { 'Failing' : { 'callable' : entry_point, 'args' : [output_file] } }] } },
+                                     ImmediateThreadPool(), watch = self.setup_test_dir,
+                                     process_pool = process_pool)
+        try:
+            for name in ['somefile_20130326.txt', 'failfile.txt']:
+                event_handler.handle_event(pyinotify.Event({
+                    'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                    'path' : self.setup_test_dir, 'name' : name, 'dir' : False}))
+        finally:
+            process_pool.close()
+        with open(output_file) as fh:
+            calls = [json.loads(line) for line in fh]
+        pathname = os.path.sep.join([self.setup_test_dir, 'somefile_20130326.txt'])
+        self.assertEqual([[pathname, '20130326'], pathname, '2013-03-26', os.getpid()], calls[0],
+                         msg = "Expected callable to be called in this process with expanded args and metadata")
+        self.assertEqual([[pathname], pathname], calls[1][:2])
+        self.assertNotEqual(os.getpid(), calls[1][3], msg = "Expected callable to be called in process pool")
+        self.assertEqual(1, event_handler.metrics.action_exit_codes.labels(self.setup_test_dir, 'Failing', 3).value)
+
+    def test_spawn_server(self):
+        """Test commands launched by spawn server have their output, input and exit code passed back"""
+        spawner = SpawnServer()
+        try:
+            self.assertEqual((0, b'hello\n', b''), run_script(['echo', 'hello'], spawner = spawner))
+            self.assertEqual((3, b'a\nb\n', b'err\n'),
+                             run_script(['sh', '-c', 'cat; echo err >&2; exit 3'], stdin_data = 'a\nb\n',
+                                        spawner = spawner))
+            returncode, _, stderr = run_script(['/nonexistent/command'], spawner = spawner)
+            self.assertEqual(127, returncode)
+            self.assertTrue(stderr, msg = "Expected error message on stderr of command that could not be started")
+            self.assertEqual(str(spawner.pid).encode('ascii'),
+                             run_script(['sh', '-c', 'echo $PPID'], spawner = spawner)[1].strip(),
+                             msg = "Expected command to be a child of spawn server")
+        finally:
+            spawner.close()
+        returncode, stdout, _ = run_script(['echo', 'hello'], spawner = spawner)
+        self.assertEqual(b'hello\n', stdout, msg = "Expected command to run directly once spawn server is stopped")
+
+    def test_action_graph(self):
+        """Test independent actions run as separate tasks, dependents run once their
+        prerequisites succeed and dependents of failed actions are skipped"""
+        output_file = os.path.sep.join([self.setup_test_dir, 'graph.out'])
+        def make_action(name, exit_code=0, depends_on=None):
+            action = { 'cmd' : 'sh', 'args' : ['-c', 'echo %s >> %s; exit %s' % (name, output_file, exit_code,)] }
+            if depends_on:
+                action['depends_on'] = depends_on
+            return { name : action }
+        thread_pool = ManualThreadPool()
+        event_handler = EventHandler({ 'somefile.txt' : { 'actions' : [
+            make_action('upload', depends_on = ['compress', 'checksum']),
+            make_action('compress'), make_action('checksum'), make_action('broken', exit_code = 1),
+            make_action('notify', depends_on = 'broken'), make_action('cleanup', depends_on = ['notify'])] } },
+                                     thread_pool)
+        event_handler.handle_event(pyinotify.Event({
+            'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+            'path' : self.setup_test_dir, 'name' : 'somefile.txt', 'dir' : False}))
+        self.assertEqual(3, len(thread_pool.tasks), msg = "Expected actions without dependencies to be queued together")
+        while thread_pool.tasks:
+            thread_pool.run_one()
+        with open(output_file) as fh:
+            ran = fh.read().splitlines()
+        self.assertEqual(['compress', 'checksum', 'broken', 'upload'], ran)
+        for depends_on, on_failure in [(['missing'], 'skip'), (['compress'], 'explode')]:
+            event_handler = EventHandler({ 'somefile.txt' : { 'on_failure' : on_failure, 'actions' : [
+                make_action('compress'), make_action('upload', depends_on = depends_on)] } },
+                                         ImmediateThreadPool())
+            self.assertFalse(event_handler.action_graphs.values()[0],
+                             msg = "Expected invalid action dependencies to be rejected")
+            self.assertTrue([plan.error for plan in event_handler.action_plans.values()[0]])
+
+    def test_cluster_claims(self):
+        """Test files in a directory shared by several processes are processed once, and
+        expired claims of a stopped process are taken over"""
+        claim_dir = os.path.sep.join([self.setup_test_dir, '.claims'])
+        output_file = os.path.sep.join([self.setup_test_dir, 'cluster.out'])
+        names = ['file%d.dat' % (i,) for i in range(20)]
+        for name in names:
+            open(os.path.sep.join([self.setup_test_dir, name]), 'w').close()
+        procs = [multiprocessing.Process(target = _handle_claimed_files,
+                                         args = (self.setup_test_dir, claim_dir, output_file, names, 'node%d' % (i,)))
+                 for i in range(4)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        with open(output_file) as fh:
+            handled = [line.split()[0] for line in fh.read().splitlines()]
+        self.assertEqual(sorted(os.path.sep.join([self.setup_test_dir, name]) for name in names), sorted(handled),
+                         msg = "Expected each file to be processed exactly once")
+        # Claim of a process that stops renewing it expires and is taken over
+        open(os.path.sep.join([self.setup_test_dir, 'late.dat']), 'w').close()
+        dead_store = DirectoryClaimStore(ClusterConfig(claim_dir, .2, 3600, None), 'dead')
+        dead_handler = EventHandler({ '*.dat' : { 'actions' : [{ 'Never runs' : { 'cmd' : 'true', 'args' : [] } }] } },
+                                    ImmediateThreadPool(), watch = self.setup_test_dir, claim_store = dead_store)
+        self.assertTrue(dead_handler._claim(list(dead_handler.filemask_actions)[0].pattern, pyinotify.Event({
+            'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+            'path' : self.setup_test_dir, 'name' : 'late.dat', 'dir' : False})))
+        dead_store.close()
+        claim_store = DirectoryClaimStore(ClusterConfig(claim_dir, 60, 3600, None), 'alive')
+        event_handler = EventHandler({ '*.dat' : { 'actions' : [{ 'Append filename' : {
+            'cmd' : 'sh', 'args' : ['-c', 'echo "$0" >> %s' % (output_file,), '$filename'] } }] } },
+                                     ImmediateThreadPool(), watch = self.setup_test_dir, claim_store = claim_store)
+        try:
+            self.assertEqual(0, event_handler.take_over_claims(), msg = "Expected unexpired claim to be kept")
+            time.sleep(.5)
+            self.assertEqual(1, event_handler.take_over_claims())
+            self.assertEqual(0, event_handler.take_over_claims(), msg = "Expected done claim to not be taken over")
+        finally:
+            claim_store.close()
+        with open(output_file) as fh:
+            self.assertEqual(os.path.sep.join([self.setup_test_dir, 'late.dat']), fh.read().splitlines()[-1])
+
+    def test_claim_store_retire(self):
+        """Test retired claim store renews claims still held until they are released"""
+        claim_dir = os.path.sep.join([self.setup_test_dir, 'claims'])
+        info = {'filemask' : 'pattern', 'path' : 'retired.dat', 'mask' : pyinotify.IN_CLOSE_WRITE}
+        retired_store = DirectoryClaimStore(ClusterConfig(claim_dir, .3, 3600, None), 'retired')
+        other_store = DirectoryClaimStore(ClusterConfig(claim_dir, .3, 3600, None), 'other')
+        try:
+            claim = retired_store.claim('retired', info)
+            retired_store.retire()
+            time.sleep(.6)
+            self.assertEqual([], other_store.expired(),
+                             msg = "Expected claim held by retired store to be renewed")
+            retired_store.release(claim)
+            self.assertTrue(retired_store._renew_thread is None,
+                            msg = "Expected retired store to stop renewing once claims are released")
+            claim = retired_store.claim('late', dict(info, path = 'late.dat'))
+            time.sleep(.6)
+            self.assertEqual([], other_store.expired(),
+                             msg = "Expected claim made after retiring to be renewed")
+            retired_store.release(claim)
+            self.assertTrue(retired_store._renew_thread is None)
+        finally:
+            retired_store.close()
+            other_store.close()
+
+    def test_filemask_index(self):
+        """Test filemask index finds the same filemasks as matching each filemask regex in turn"""
+        filemasks = ['*', 'somefile.txt', 'somefile.*', '*.txt', 'some?ile.*', 'other_log_YYYYMMDD.*',
+                     '(access|error)_YYYYMMDD']
+        regexes = []
+        for filemask in filemasks:
+            if 'YYYYMMDD' in filemask:
+                regexes.append(re.compile(filemask.replace('YYYYMMDD', r'\d{8}')))
+            else:
+                regexes.append(re.compile(fnmatch.translate(filemask)))
+        index = FilemaskIndex(zip(filemasks, regexes, filemasks))
+        for filename in ['somefile.txt', 'somefile.pdf', 'other.txt', 'other_log_20130326.gz',
+                         'error_20130326', 'nomatch']:
+            expected = [filemask for filemask, regex in zip(filemasks, regexes) if regex.match(filename)]
+            self.assertEqual(expected, index.match(filename),
+                             msg = "Filemask index matches for %s differ from regex matches" % (filename,))
+
+    def test_action_plan(self):
+        """Test actions are compiled into plans with placeholder positions and time window"""
+        test_action = { 'Echo filename and file datestamp' : {
+            'cmd': 'echo',
+            'start_time' : '08:00:00',
+            'end_time' : '10:00:00',
+            'args': ['-n', '$filename', 'YYYYMMDD'] } }
+        event_handler = EventHandler({ 'somefile_YYYYMMDD.txt' : { 'actions' : [test_action] } },
+                                     ImmediateThreadPool())
+        plan = list(event_handler.action_plans.values())[0][0]
+        self.assertEqual(((1,), (2,)), (plan.filename_positions, plan.datestamp_positions))
+        self.assertEqual((datetime.time(8, 0, 0), datetime.time(10, 0, 0)), (plan.start_time, plan.end_time))
+        self.assertTrue(os.path.isabs(plan.cmd), msg = "Expected action command to be resolved to absolute path")
+        event = pyinotify.Event({'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                                 'path' : self.setup_test_dir, 'name' : 'somefile_20130326.txt', 'dir' : False})
+        action_args, file_metadata = event_handler._parse_action_args(event, plan)
+        self.assertEqual(['-n', event.pathname, '20130326'], action_args)
+        self.assertEqual(datetime.date(2013, 3, 26), file_metadata['datestamp'])
+
+    def test_run_script_output(self):
+        """Test action output is streamed to output file with only its tail kept in memory"""
+        output_file = os.path.sep.join([self.setup_test_dir, 'action.stdout'])
+        stdout_capture = OutputCapture('test', 'stdout', log = False, tail_size = 10,
+                                       output_file = RotatingOutputFile(output_file))
+        stderr_capture = OutputCapture('test', 'stderr', log = False)
+        returncode, stdout, stderr = run_script(['sh', '-c', 'head -c 1000000 /dev/zero; echo error >&2; exit 3'],
+                                                stdout_capture, stderr_capture)
+        self.assertEqual(3, returncode)
+        self.assertEqual(b'\0' * 10, stdout)
+        self.assertEqual(b'error\n', stderr)
+        self.assertEqual((1000000, 6), (stdout_capture.bytes, stderr_capture.bytes))
+        self.assertEqual(1000000, os.stat(output_file).st_size)
+
+    def test_batch_action(self):
+        """Test batched action runs once for a full batch and once more when batch latency is reached"""
+        output_file = os.path.sep.join([self.setup_test_dir, 'batch.out'])
+        test_action = { 'Append filenames' : {
+            'cmd': 'sh',
+            'batch' : { 'max_batch_size' : 2, 'max_batch_latency_ms' : 100 },
+            'args': ['-c', 'echo "$@" >> %s' % (output_file,), 'sh', '$filename'] } }
+        event_handler = EventHandler({ 'somefile*.txt' : { 'actions' : [test_action] } },
+                                     ImmediateThreadPool())
+        for name in ['somefile1.txt', 'somefile2.txt', 'somefile3.txt']:
+            event_handler.handle_event(pyinotify.Event({
+                'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                'path' : self.setup_test_dir, 'name' : name, 'dir' : False}))
+        with open(output_file) as fh:
+            self.assertEqual(["%s/somefile1.txt %s/somefile2.txt" % (self.setup_test_dir, self.setup_test_dir)],
+                             fh.read().splitlines())
+        time.sleep(.5)
+        with open(output_file) as fh:
+            self.assertEqual("%s/somefile3.txt" % (self.setup_test_dir,), fh.read().splitlines()[-1])
+
+    def test_batch_action_stdin(self):
+        """Test batched action with stdin option reads file names from stdin"""
+        output_file = os.path.sep.join([self.setup_test_dir, 'batch.out'])
+        test_action = { 'Append filenames' : {
+            'cmd': 'sh',
+            'batch' : { 'max_batch_size' : 2, 'stdin' : True },
+            'args': ['-c', 'cat >> %s' % (output_file,), '$filename'] } }
+        event_handler = EventHandler({ 'somefile*.txt' : { 'actions' : [test_action] } },
+                                     ImmediateThreadPool())
+        for name in ['somefile1.txt', 'somefile2.txt']:
+            event_handler.handle_event(pyinotify.Event({
+                'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                'path' : self.setup_test_dir, 'name' : name, 'dir' : False}))
+        with open(output_file) as fh:
+            self.assertEqual(["%s/somefile1.txt" % (self.setup_test_dir,), "%s/somefile2.txt" % (self.setup_test_dir,)],
+                             fh.read().splitlines())
+
+    def test_fair_queue_weights(self):
+        """Test fair queue dispatches tasks from queues in proportion to their weights"""
+        thread_pool = ManualThreadPool()
+        fair_queue = FairQueue(thread_pool)
+        fair_queue.set_weight('heavy', 3)
+        ran = []
+        for _ in range(8):
+            fair_queue.add_task('light', ran.append, ('light',))
+            fair_queue.add_task('heavy', ran.append, ('heavy',))
+        for _ in range(8):
+            thread_pool.run_one()
+        self.assertEqual(6, ran.count('heavy'),
+                         msg = "Expected queue with weight 3 to get three quarters of dispatches, got %s" % (ran,))
+
+    def test_fair_queue_concurrency_limit(self):
+        """Test task held back by a concurrency limit runs once the limit is released"""
+        thread_pool = ManualThreadPool()
+        fair_queue = FairQueue(thread_pool)
+        limit = ConcurrencyLimit(1)
+        ran = []
+        def first_task():
+            # Second task must not run while this one holds the limit
+            thread_pool.run_one()
+            ran.append('first')
+        fair_queue.add_task('watcher', first_task, (), (limit,))
+        fair_queue.add_task('watcher', ran.append, ('second',), (limit,))
+        thread_pool.run_one()
+        self.assertEqual(['first'], ran)
+        thread_pool.run_one()
+        self.assertEqual(['first', 'second'], ran)
+        self.assertEqual(0, len(fair_queue))
+
+    def test_fair_queue_spill(self):
+        """Test tasks beyond fair queue's maximum are spilled to disk and added back in order"""
+        spill_dir = os.path.sep.join([self.setup_test_dir, 'spill'])
+        thread_pool = ManualThreadPool()
+        fair_queue = FairQueue(thread_pool, max_queued = 4, spill = SpillQueue(spill_dir, segment_size = 64),
+                               unspill_func = lambda record: fair_queue.add_task('watcher', ran.append, record))
+        ran, max_queued = [], 0
+        for i in range(20):
+            if not fair_queue.spill_task((i,)):
+                fair_queue.add_task('watcher', ran.append, (i,))
+        self.assertEqual(4, len(fair_queue))
+        self.assertEqual(16, len(fair_queue.spill))
+        self.assertTrue(len(os.listdir(spill_dir)) > 1, msg = "Expected spilled tasks to fill several segments")
+        while thread_pool.tasks:
+            thread_pool.run_one()
+            max_queued = max(max_queued, len(fair_queue))
+        self.assertEqual(list(range(20)), ran, msg = "Expected spilled tasks to run in order they were added")
+        self.assertTrue(max_queued <= 4)
+        self.assertEqual(0, fair_queue.spill.backlog_bytes)
+        self.assertEqual([], os.listdir(spill_dir), msg = "Expected read segments to be removed")
+
+    def test_output_files(self):
+        """Test actions of the same name of different watchers and filemasks write to separate output files"""
+        output_dir = os.path.sep.join([self.setup_test_dir, 'output'])
+        other_test_dir = os.path.sep.join([self.setup_test_dir, 'other'])
+        os.mkdir(output_dir)
+        filemasks = { '*.txt' : { 'actions' : [self.echo_test_action] },
+                      '*.dat' : { 'actions' : [self.echo_test_action] } }
+        handlers = [EventHandler(filemasks.copy(), ImmediateThreadPool(), watch = watch, output_dir = output_dir)
+                    for watch in [self.setup_test_dir, other_test_dir]]
+        filenames = set()
+        for event_handler in handlers:
+            for plans in event_handler.action_plans.values():
+                capture = event_handler._make_output_capture(plans[0], 'stdout')
+                filenames.add(os.path.basename(capture.output_file.filename))
+        self.assertEqual(4, len(filenames),
+                         msg = "Expected an output file per watcher and filemask, got %s" % (sorted(filenames),))
+        prefix = '%s._.txt.Echo_filename_and_file_datestamp.' % (os.path.basename(self.setup_test_dir),)
+        self.assertEqual(1, len([filename for filename in filenames if filename.startswith(prefix)]),
+                         msg = "Expected output file names to include watcher, filemask and action, got %s" % (
+                             sorted(filenames),))
+
+    def test_scheduler(self):
+        """Test scheduler dispatches deferred tasks in fire time order and skips cancelled tasks"""
+        scheduler = Scheduler(ImmediateThreadPool())
+        now = time.time()
+        scheduler.schedule(now + 0.2, self.q.put, 'second')
+        cancelled = scheduler.schedule(now + 0.1, self.q.put, 'cancelled')
+        scheduler.schedule(now + 0.1, self.q.put, 'first')
+        scheduler.cancel(cancelled)
+        self.assertEqual(len(scheduler), 3)
+        try:
+            self.assertEqual(['first', 'second'], [self.q.get(timeout = 5), self.q.get(timeout = 5)],
+                             msg = "Expected scheduled tasks to run in fire time order")
+            self.assertTrue(self.q.empty(), msg = "Cancelled task was run")
+        finally:
+            scheduler.stop()
+
+    def test_journal(self):
+        """Test journal returns actions left pending by a previous run"""
+        journal_file = os.path.sep.join([self.setup_test_dir, 'journal.db'])
+        journal = Journal(journal_file)
+        events = [pyinotify.Event({'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                                   'path' : self.setup_test_dir, 'name' : name, 'dir' : False})
+                  for name in ['done.txt', 'queued.txt', 'scheduled.txt']]
+        done, _, scheduled = [journal.add(self.setup_test_dir, 'pattern', event) for event in events]
+        journal.complete(done)
+        journal.flush()
+        journal.defer(scheduled, 1, 1234.0)
+        journal.close()
+        journal = Journal(journal_file)
+        try:
+            pending = journal.pending()
+            self.assertEqual(['queued.txt', 'scheduled.txt'], [entry.name for entry in pending],
+                             msg = "Expected completed action to be removed from journal")
+            self.assertEqual((1, 1234.0), (pending[1].action_index, pending[1].fire_time),
+                             msg = "Expected deferred action to be recorded in journal")
+        finally:
+            journal.close()
+
+    def test_journal_reopen(self):
+        """Test changes made while journal is closed are committed once it is opened again"""
+        journal_file = os.path.sep.join([self.setup_test_dir, 'journal.db'])
+        journal = Journal(journal_file)
+        event = pyinotify.Event({'wd' : 1, 'mask' : pyinotify.IN_CLOSE_WRITE, 'cookie' : 0,
+                                 'path' : self.setup_test_dir, 'name' : 'queued.txt', 'dir' : False})
+        first = journal.add(self.setup_test_dir, 'pattern', event)
+        journal.close()
+        second = journal.add(self.setup_test_dir, 'pattern', event)
+        journal.open()
+        try:
+            self.assertEqual([], journal.pending(),
+                             msg = "Expected entries of this run not to be pending after reopening")
+            journal.flush()
+        finally:
+            journal.close()
+        journal = Journal(journal_file)
+        try:
+            self.assertEqual([first, second], [entry.id for entry in journal.pending()],
+                             msg = "Expected entry added while closed to be committed after reopening")
+        finally:
+            journal.close()
+
 if __name__ == '__main__':
     unittest.main()